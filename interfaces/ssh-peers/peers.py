@@ -25,6 +25,7 @@ class SshPeers(RelationBase):
         local_public_key = flags.State('{relation_name}.local-public-key')
         new_remote_public_key = flags.State(
             '{relation_name}.new-remote-public-key')
+        departed = flags.State('{relation_name}.departed')
 
     @hook('{peers:ssh-peers}-relation-{joined}')
     def joined(self):
@@ -51,6 +52,16 @@ class SshPeers(RelationBase):
         # Remove the state that our relationship is now connected to our
         # principal layer(s)
         self.remove_state(self.states.connected)
+        self.remove_state(self.states.new_remote_public_key)
+        # Let the charm revoke access for the departing peer. The state must
+        # be handled in this hook, as the conversation ends with it.
+        self.set_state(self.states.departed)
+
+    def get_departed_peer(self):
+        """Return the address and public key of the departing peer."""
+        return (
+            self.get_remote('private-address'),
+            self.get_local('remote-public-ssh-key'))
 
     def set_local_public_key(self, public_key):
         relation_info = {'public-ssh-key': public_key}
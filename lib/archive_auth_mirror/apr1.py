@@ -0,0 +1,76 @@
+"""Hash and check passwords in the Apache MD5 (apr1) format.
+
+This is the default format used by htpasswd, and it's supported by nginx.
+"""
+
+import hashlib
+import hmac
+import random
+
+MAGIC = '$apr1$'
+
+# Alphabet for salts and encoded hashes.
+_ITOA64 = './0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+
+def hash_password(password, salt=None):
+    """Return the apr1 hash for a password.
+
+    If a salt is not provided, a random one is generated.
+    """
+    if salt is None:
+        rand = random.SystemRandom()
+        salt = ''.join(rand.choice(_ITOA64) for _ in range(8))
+    salt = salt[:8]
+    return '{}{}${}'.format(
+        MAGIC, salt, _md5_crypt(password.encode('utf8'), salt.encode('ascii')))
+
+
+def check_password(password, hashed):
+    """Return whether the password matches the apr1 hash.
+
+    False is returned if the hash is in a different format.
+    """
+    if not hashed.startswith(MAGIC):
+        return False
+    salt = hashed[len(MAGIC):].split('$', 1)[0]
+    return hmac.compare_digest(hash_password(password, salt=salt), hashed)
+
+
+def _md5_crypt(password, salt):
+    """Return the encoded MD5-crypt digest for the password and salt."""
+    magic = MAGIC.encode('ascii')
+    alternate = hashlib.md5(password + salt + password).digest()
+    context = password + magic + salt
+    for length in range(len(password), 0, -16):
+        context += alternate[:min(length, 16)]
+    length = len(password)
+    while length:
+        context += b'\0' if length & 1 else password[:1]
+        length >>= 1
+    digest = hashlib.md5(context).digest()
+
+    for i in range(1000):
+        context = password if i & 1 else digest
+        if i % 3:
+            context += salt
+        if i % 7:
+            context += password
+        context += digest if i & 1 else password
+        digest = hashlib.md5(context).digest()
+
+    encoded = ''
+    for first, second, third in (
+            (0, 6, 12), (1, 7, 13), (2, 8, 14), (3, 9, 15), (4, 10, 5)):
+        encoded += _to64(
+            digest[first] << 16 | digest[second] << 8 | digest[third], 4)
+    return encoded + _to64(digest[11], 2)
+
+
+def _to64(value, length):
+    """Encode the lowest 6 * length bits of value."""
+    chars = []
+    for _ in range(length):
+        chars.append(_ITOA64[value & 0x3f])
+        value >>= 6
+    return ''.join(chars)
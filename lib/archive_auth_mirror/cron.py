@@ -12,6 +12,12 @@ CRONTAB_TEMPLATE = textwrap.dedent(
     */15 *   *   *   * root  {paths[bin]}/mirror-archive > /var/log/mirror-archive.log 2>&1
     ''')
 
+PULL_CRONTAB_TEMPLATE = textwrap.dedent(
+    '''
+    #  m h dom mon dow user  command
+    */5  *   *   *   * root  {paths[bin]}/pull-archive > /var/log/pull-archive.log 2>&1
+    ''')
+
 
 def install_crontab(paths=None):
     """Install the crontab file to periodically run the job."""
@@ -22,6 +28,15 @@ def install_crontab(paths=None):
         fh.write(CRONTAB_TEMPLATE.format(paths=paths))
 
 
+def install_pull_crontab(paths=None):
+    """Install the crontab file to periodically pull the repository."""
+    if paths is None:
+        paths = get_paths()
+
+    with paths['cron'].open('w') as fh:
+        fh.write(PULL_CRONTAB_TEMPLATE.format(paths=paths))
+
+
 def remove_crontab(paths=None):
     """Remove the crontab file for the job."""
     if paths is None:
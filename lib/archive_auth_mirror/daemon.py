@@ -0,0 +1,105 @@
+"""Run mirroring cycles continuously, adapting the interval between them."""
+
+import threading
+from collections import namedtuple
+
+# Default bounds, in seconds, for the interval between mirroring cycles.
+MIN_INTERVAL = 60
+MAX_INTERVAL = 900
+
+
+class AdaptiveInterval:
+    """Compute the delay before the next mirroring cycle.
+
+    Upstream repositories tend to publish in bursts, so after a cycle which
+    found changes the next one runs after min_interval. Every idle or failed
+    cycle doubles the delay, up to max_interval.
+    """
+
+    def __init__(self, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL,
+                 factor=2):
+        self._factor = factor
+        self._current = min_interval
+        self.set_bounds(min_interval, max_interval)
+
+    def set_bounds(self, min_interval, max_interval):
+        """Change the minimum and maximum delay between cycles."""
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self._current = min(
+            max(self._current, self.min_interval), self.max_interval)
+
+    def next(self, result):
+        """Return the delay after a cycle with the given CycleResult."""
+        if result.changed and result.success:
+            self._current = self.min_interval
+            return self._current
+        delay = self._current
+        self._current = min(self._current * self._factor, self.max_interval)
+        return delay
+
+
+class Daemon:
+    """Run a mirroring cycle until stopped.
+
+    The run_cycle callable must return a CycleResult. The interval between
+    cycles is computed through an AdaptiveInterval.
+    """
+
+    def __init__(self, run_cycle, logger, interval=None):
+        self._run_cycle = run_cycle
+        self._logger = logger
+        self._interval = interval or AdaptiveInterval()
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+    def run(self):
+        """Run cycles until stop() is called."""
+        self._logger.info('starting mirroring daemon')
+        while not self._stopped:
+            result = self._run_cycle()
+            if self._stopped:
+                break
+            delay = self._interval.next(result)
+            self._logger.info('next mirroring run in {} seconds'.format(delay))
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+        self._logger.info('mirroring daemon stopped')
+
+    def wakeup(self):
+        """Run the next cycle immediately."""
+        self._wakeup.set()
+
+    def stop(self):
+        """Stop the daemon once the current cycle completes."""
+        self._stopped = True
+        self._wakeup.set()
+
+
+class ConfigWatcher:
+    """Keep the parsed scripts configuration between mirroring cycles.
+
+    The configuration file is parsed again only when it's modified.
+    """
+
+    def __init__(self, path, loader):
+        self._path = path
+        self._loader = loader
+        self._mtime = None
+        self._config = None
+
+    def get(self):
+        """Return the current configuration."""
+        try:
+            mtime = self._path.stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if self._config is None or mtime != self._mtime:
+            self._config = self._loader(config_path=self._path)
+            self._mtime = mtime
+        return self._config
+
+
+# CycleResult holds the outcome of a mirroring cycle. If changed is True,
+# upstream changes were found.
+CycleResult = namedtuple('CycleResult', 'changed success')
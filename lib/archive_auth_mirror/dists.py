@@ -0,0 +1,193 @@
+"""Publish the repository dists directory atomically, in generations.
+
+The dists directory served to clients is a symlink to a generation directory.
+Each export creates a new generation, seeded with hard links to the files of
+suites which are not exported, so that no data is copied. Once it's complete,
+the symlink is switched to the new generation with a single rename, so that
+clients never see index files from different generations.
+
+The same functions are used for snapshots of the whole repository tree, when
+changes are staged before being published.
+"""
+
+import os
+import shlex
+import shutil
+import time
+
+# Default number of generations kept, including the published one.
+KEEP_GENERATIONS = 3
+
+# Prefix for generations which are not complete yet.
+_NEW_PREFIX = '.new-'
+
+# Prefix for generations being created, until all their files are linked.
+_COPY_PREFIX = '.copy-'
+
+
+def get_published(link):
+    """Return the name of the published generation, or None."""
+    if not link.is_symlink():
+        return None
+    return os.path.basename(os.readlink(str(link)))
+
+
+def get_incomplete(generations_dir):
+    """Return the path of the latest incomplete generation, or None."""
+    if not generations_dir.exists():
+        return None
+    names = [
+        name for name in os.listdir(str(generations_dir))
+        if name.startswith(_NEW_PREFIX) and name[len(_NEW_PREFIX):].isdigit()]
+    if not names:
+        return None
+    return generations_dir / max(
+        names, key=lambda name: int(name[len(_NEW_PREFIX):]))
+
+
+def create_generation(link, generations_dir, exclude=(), now=time.time):
+    """Create a new generation and return its path.
+
+    The generation holds hard links to the files in the directory currently
+    linked, except for top-level entries (suites, for dists) listed in
+    exclude. It's not published until publish_generation is called.
+
+    Links are created under a temporary name, and the generation is renamed
+    once they're all in place, so that a partial copy is never taken for an
+    incomplete generation.
+    """
+    generations_dir.mkdir(parents=True, exist_ok=True)
+    name = _new_name(generations_dir, now)
+    copy = generations_dir / (_COPY_PREFIX + name)
+    if copy.exists():
+        shutil.rmtree(str(copy))
+    copy.mkdir()
+    try:
+        if link.is_dir():
+            _link_tree(link, copy, exclude)
+    except BaseException:
+        shutil.rmtree(str(copy), ignore_errors=True)
+        raise
+    path = generations_dir / (_NEW_PREFIX + name)
+    copy.rename(path)
+    return path
+
+
+def publish_generation(link, path):
+    """Publish a generation created by create_generation.
+
+    Return the path of the published generation.
+    """
+    if path.name.startswith(_NEW_PREFIX):
+        published = path.with_name(path.name[len(_NEW_PREFIX):])
+        path.rename(published)
+        path = published
+    switch_link(link, path)
+    return path
+
+
+def adopt_directory(link, generations_dir, now=time.time):
+    """Turn a plain directory into the published generation.
+
+    This is only needed once, for repositories exported before generations
+    were used. Return whether the directory was adopted.
+    """
+    if link.is_symlink() or not link.is_dir():
+        return False
+    generations_dir.mkdir(parents=True, exist_ok=True)
+    path = generations_dir / _new_name(generations_dir, now)
+    # The directory is briefly missing between the two renames.
+    link.rename(path)
+    switch_link(link, path)
+    return True
+
+
+def prune_generations(generations_dir, published, keep=KEEP_GENERATIONS):
+    """Remove generations older than the latest keep ones.
+
+    Generations named in published are never removed, while incomplete or
+    partially created ones left over by failures always are. Return the
+    names of removed generations.
+    """
+    if not generations_dir.exists():
+        return []
+    names = os.listdir(str(generations_dir))
+    complete = sorted(
+        (name for name in names if name.isdigit()), key=int, reverse=True)
+    removed = [
+        name for name in complete[max(1, keep):] if name not in published]
+    removed.extend(
+        name for name in names
+        if name.startswith(_NEW_PREFIX) or name.startswith(_COPY_PREFIX))
+    for name in removed:
+        shutil.rmtree(str(generations_dir / name))
+    return sorted(removed)
+
+
+def switch_link(link, target):
+    """Point the symlink to target, atomically.
+
+    If link is a plain directory, it's replaced by the symlink.
+    """
+    link.parent.mkdir(parents=True, exist_ok=True)
+    new_link = link.with_name('.' + link.name + '.new')
+    if new_link.is_symlink() or new_link.exists():
+        new_link.unlink()
+    new_link.symlink_to(target)
+    old_dir = None
+    if link.is_dir() and not link.is_symlink():
+        old_dir = link.with_name('.' + link.name + '.old')
+        if old_dir.exists():
+            shutil.rmtree(str(old_dir))
+        link.rename(old_dir)
+    os.replace(str(new_link), str(link))
+    if old_dir is not None:
+        shutil.rmtree(str(old_dir))
+
+
+def switch_link_command(link, target):
+    """Return a shell command doing the same as switch_link.
+
+    The command fails without changes if target is not a directory.
+    """
+    names = {
+        'link': link,
+        'new_link': link.with_name('.' + link.name + '.new'),
+        'old_dir': link.with_name('.' + link.name + '.old'),
+        'target': target}
+    names = {key: shlex.quote(str(value)) for key, value in names.items()}
+    return (
+        'test -d {target} && '
+        'ln -sfn {target} {new_link} && '
+        'if test -d {link} && ! test -L {link}; then '
+        'rm -rf {old_dir} && mv {link} {old_dir}; fi && '
+        'mv -T {new_link} {link} && '
+        'rm -rf {old_dir}').format(**names)
+
+
+def _link_tree(source_dir, target_dir, exclude):
+    """Hard-link the entries of source_dir not in exclude into target_dir."""
+    for name in sorted(os.listdir(str(source_dir))):
+        if name in exclude:
+            continue
+        source = source_dir / name
+        if source.is_symlink():
+            (target_dir / name).symlink_to(os.readlink(str(source)))
+        elif source.is_dir():
+            shutil.copytree(
+                str(source), str(target_dir / name), symlinks=True,
+                copy_function=os.link)
+        else:
+            os.link(str(source), str(target_dir / name))
+
+
+def _new_name(generations_dir, now):
+    """Return a name for a new generation, newer than existing ones.
+
+    Names are based on the current time, in milliseconds.
+    """
+    names = [
+        name[len(_NEW_PREFIX):] if name.startswith(_NEW_PREFIX) else name
+        for name in os.listdir(str(generations_dir))]
+    latest = max((int(name) for name in names if name.isdigit()), default=0)
+    return str(max(int(now() * 1000), latest + 1))
@@ -0,0 +1,88 @@
+"""Track the health of peer units across mirroring runs."""
+
+import json
+import time
+from collections import namedtuple
+
+from .utils import write_atomic
+
+# Bounds, in seconds, for the delay before probing an unhealthy peer again.
+MIN_PROBE_DELAY = 60
+MAX_PROBE_DELAY = 3600
+
+
+class PeerHealth:
+    """Registry of peer units which failed to sync.
+
+    A peer is marked unhealthy when it can't be reached or synced, and it's
+    skipped for the rest of the run. In later runs it's probed again after a
+    delay, doubling for each consecutive failure up to max_delay. Peers are
+    healthy again as soon as they're synced successfully.
+
+    The registry is saved to a JSON file between runs.
+    """
+
+    def __init__(self, path, now=time.time, min_delay=MIN_PROBE_DELAY,
+                 max_delay=MAX_PROBE_DELAY):
+        self._path = path
+        self._now = now
+        self._min_delay = min_delay
+        self._max_delay = max_delay
+        self._peers = self._load()
+
+    def status(self, host):
+        """Return the PeerStatus for an unhealthy host, or None."""
+        return self._peers.get(host)
+
+    def available(self, host):
+        """Return whether the host should be synced in this run."""
+        status = self._peers.get(host)
+        return status is None or (
+            not status.skip and status.next_probe <= self._now())
+
+    def select(self, hosts):
+        """Return a list with the hosts to sync in this run."""
+        return [host for host in hosts if self.available(host)]
+
+    def mark_failed(self, host, error):
+        """Mark the host as unhealthy, skipping it for the rest of the run."""
+        status = self._peers.get(host)
+        failures = status.failures + 1 if status else 1
+        delay = min(
+            self._min_delay * 2 ** (failures - 1), self._max_delay)
+        self._peers[host] = PeerStatus(
+            failures=failures, next_probe=self._now() + delay, error=error,
+            skip=True)
+
+    def mark_healthy(self, host):
+        """Mark the host as healthy."""
+        self._peers.pop(host, None)
+
+    def prune(self, hosts):
+        """Forget about hosts which are not peer units anymore."""
+        for host in set(self._peers).difference(hosts):
+            del self._peers[host]
+
+    def _load(self):
+        """Return unhealthy peers saved by previous runs."""
+        if not self._path.exists():
+            return {}
+        try:
+            return {
+                host: PeerStatus(**status) for host, status in
+                json.loads(self._path.read_text()).items()}
+        except (AttributeError, TypeError, ValueError):
+            # Start afresh if the file is invalid.
+            return {}
+
+    def save(self):
+        """Save the registry, for hosts to be skipped in later runs too."""
+        write_atomic(self._path, json.dumps({
+            host: status._replace(skip=False)._asdict()
+            for host, status in sorted(self._peers.items())}, indent=2))
+
+
+# PeerStatus holds the state of an unhealthy peer unit: the number of
+# consecutive failures, the time after which it can be probed again and the
+# last error. If skip is True, the peer failed in the current run.
+PeerStatus = namedtuple('PeerStatus', 'failures next_probe error skip')
@@ -0,0 +1,38 @@
+"""Track files added to and removed from the repository pool."""
+
+import os
+from collections import namedtuple
+
+
+def snapshot(root):
+    """Return a frozenset with the paths of files under root.
+
+    Paths are relative to root. If root doesn't exist, the set is empty.
+    """
+    root = str(root)
+    files = set()
+    for dirpath, _, filenames in os.walk(root):
+        reldir = os.path.relpath(dirpath, root)
+        for filename in filenames:
+            files.add(os.path.normpath(os.path.join(reldir, filename)))
+    return frozenset(files)
+
+
+def diff(before, after):
+    """Return a Manifest of the changes between two snapshots."""
+    return Manifest(
+        added=sorted(after - before), removed=sorted(before - after))
+
+
+def write_file_list(files, path):
+    """Write a list of files to path, one per line.
+
+    The resulting file can be passed to rsync via --files-from.
+    """
+    with path.open('w') as fh:
+        for name in files:
+            fh.write(name + '\n')
+
+
+# Manifest lists paths of files added and removed between two snapshots.
+Manifest = namedtuple('Manifest', 'added removed')
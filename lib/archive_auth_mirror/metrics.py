@@ -0,0 +1,193 @@
+"""Collect and save timing and transfer metrics for mirroring runs."""
+
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from .utils import write_atomic
+
+# Prefix for metric names in the Prometheus textfile.
+PREFIX = 'archive_auth_mirror'
+
+
+class RunMetrics:
+    """Metrics for a single mirroring run.
+
+    Wall time, file counts and transferred bytes are recorded per phase, per
+    updated suite and per peer unit.
+    """
+
+    def __init__(self, clock=time.monotonic, now=time.time):
+        self._clock = clock
+        self._start = clock()
+        self.timestamp = now()
+        self.seconds = None
+        self.success = None
+        self.phases = OrderedDict()
+        self.pool_added = None
+        self.pool_removed = None
+        self.suites = {}
+        self.peers = {}
+        self.unhealthy_peers = {}
+
+    @contextmanager
+    def phase(self, name):
+        """Time the execution of a phase of the run.
+
+        The yielded Phase can be used to set file and byte counts.
+        """
+        phase = self.phases.setdefault(name, Phase())
+        start = self._clock()
+        try:
+            yield phase
+        finally:
+            phase.seconds += self._clock() - start
+
+    def set_pool_changes(self, added, removed):
+        """Record the number of files added to and removed from the pool."""
+        self.pool_added = added
+        self.pool_removed = removed
+
+    def add_suite(self, status):
+        """Record the SuiteStatus of a suite update."""
+        self.suites[status.suite] = {
+            'seconds': status.seconds, 'success': status.success}
+
+    def add_peer(self, host, result):
+        """Record the SyncResult of the sync to a peer unit.
+
+        Transferred files and bytes are added to the sync phase.
+        """
+        stats = result.stats
+        if stats is not None:
+            phase = self.phases.setdefault('sync', Phase())
+            phase.files = (phase.files or 0) + stats.files
+            phase.bytes = (phase.bytes or 0) + stats.bytes
+        self.peers[host] = {
+            'seconds': result.seconds,
+            'success': result.success,
+            'files': stats.files if stats else None,
+            'bytes': stats.bytes if stats else None}
+
+    def add_unhealthy_peer(self, host, status):
+        """Record the PeerStatus of a peer unit which failed to sync."""
+        self.unhealthy_peers[host] = {
+            'failures': status.failures, 'next-probe': status.next_probe}
+
+    def finish(self, success):
+        """Mark the run as completed."""
+        self.seconds = self._clock() - self._start
+        self.success = success
+
+    def as_dict(self):
+        """Return metrics as a JSON-serializable dict."""
+        return {
+            'timestamp': self.timestamp,
+            'seconds': self.seconds,
+            'success': self.success,
+            'phases': OrderedDict(
+                (name, phase.as_dict())
+                for name, phase in self.phases.items()),
+            'pool': {'added': self.pool_added, 'removed': self.pool_removed},
+            'suites': self.suites,
+            'peers': self.peers,
+            'unhealthy-peers': self.unhealthy_peers}
+
+    def write(self, json_path=None, textfile_path=None):
+        """Save metrics as JSON and/or as a Prometheus textfile."""
+        if json_path is not None:
+            write_atomic(
+                json_path, json.dumps(self.as_dict(), indent=2) + '\n')
+        if textfile_path is not None:
+            write_atomic(textfile_path, self.as_prometheus())
+
+    def as_prometheus(self):
+        """Return metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def add(name, description, samples):
+            samples = [
+                (labels, value) for labels, value in samples
+                if value is not None]
+            if not samples:
+                return
+            name = '{}_{}'.format(PREFIX, name)
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} gauge'.format(name))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(
+                    name, _format_labels(labels), _format_value(value)))
+
+        add('last_run_timestamp_seconds', 'Start time of the last run.',
+            [({}, self.timestamp)])
+        add('last_run_seconds', 'Duration of the last run.',
+            [({}, self.seconds)])
+        add('last_run_success', 'Whether the last run succeeded.',
+            [({}, self.success)])
+        phases = self.phases.items()
+        add('phase_seconds', 'Time spent in each phase.',
+            [({'phase': name}, phase.seconds) for name, phase in phases])
+        add('phase_files', 'Files handled in each phase.',
+            [({'phase': name}, phase.files) for name, phase in phases])
+        add('phase_bytes', 'Bytes handled in each phase.',
+            [({'phase': name}, phase.bytes) for name, phase in phases])
+        add('pool_files_added', 'Files added to the pool.',
+            [({}, self.pool_added)])
+        add('pool_files_removed', 'Files removed from the pool.',
+            [({}, self.pool_removed)])
+        suites = sorted(self.suites.items())
+        for key, description in (
+                ('seconds', 'Time spent updating each suite.'),
+                ('success', 'Whether each suite was updated.')):
+            add('suite_update_' + key, description,
+                [({'suite': suite}, value[key]) for suite, value in suites])
+        peers = sorted(self.peers.items())
+        for key, description in (
+                ('seconds', 'Time spent syncing each peer unit.'),
+                ('files', 'Files transferred to each peer unit.'),
+                ('bytes', 'Bytes transferred to each peer unit.'),
+                ('success', 'Whether each peer unit was synced.')):
+            add('peer_sync_' + key, description,
+                [({'peer': peer}, value[key]) for peer, value in peers])
+        unhealthy_peers = sorted(self.unhealthy_peers.items())
+        for key, name, description in (
+                ('failures', 'peer_consecutive_failures',
+                 'Consecutive failed syncs for each unhealthy peer unit.'),
+                ('next-probe', 'peer_next_probe_timestamp_seconds',
+                 'Time after which each unhealthy peer unit is synced.')):
+            add(name, description,
+                [({'peer': peer}, value[key])
+                 for peer, value in unhealthy_peers])
+        return ''.join(line + '\n' for line in lines)
+
+
+class Phase:
+    """Metrics for a phase of a mirroring run."""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.files = None
+        self.bytes = None
+
+    def as_dict(self):
+        """Return phase metrics as a dict."""
+        return {'seconds': self.seconds, 'files': self.files,
+                'bytes': self.bytes}
+
+
+def _format_labels(labels):
+    """Return Prometheus labels for a sample."""
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(
+            key, value.replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in sorted(labels.items())))
+
+
+def _format_value(value):
+    """Return a Prometheus sample value."""
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(value)
@@ -0,0 +1,95 @@
+"""Check upstream repositories for changes before mirroring them."""
+
+import base64
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+from urllib.error import URLError
+from urllib.parse import unquote, urlsplit, urlunsplit
+from urllib.request import Request, urlopen
+
+
+def fetch_release(url, suite, timeout=30):
+    """Return the content of the InRelease file for a repository suite.
+
+    If the InRelease file can't be fetched, the Release file is returned.
+    Credentials in the URL are used for basic authentication.
+    """
+    error = None
+    for name in ('InRelease', 'Release'):
+        request = _make_request(
+            '{}/dists/{}/{}'.format(url.rstrip('/'), suite, name))
+        try:
+            with urlopen(request, timeout=timeout) as response:
+                return response.read()
+        except URLError as err:
+            error = err
+    raise error
+
+
+def get_release_fingerprints(upstreams, logger, salt=b'', max_workers=4):
+    """Return a dict mapping suites to fingerprints of their upstream release.
+
+    upstreams maps local suites to a dict with the "url" and "suite" of the
+    upstream repository. The salt is included in all fingerprints, so that
+    they change when the salt does.
+
+    If the release for a suite can't be fetched, the error is logged via the
+    provided logger and the fingerprint for the suite is None.
+    """
+    def fingerprint(suite):
+        upstream = upstreams[suite]
+        try:
+            content = fetch_release(upstream['url'], upstream['suite'])
+        except (URLError, OSError) as error:
+            logger.warning(
+                'cannot fetch upstream release for {}: {}'.format(
+                    suite, error))
+            return suite, None
+        return suite, hashlib.sha256(salt + content).hexdigest()
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        return dict(executor.map(fingerprint, upstreams))
+
+
+def changed_suites(suites, fingerprints, previous):
+    """Return the suites whose upstream changed since the previous run.
+
+    Suites with no known fingerprint are always considered changed.
+    """
+    changed = []
+    for suite in suites:
+        fingerprint = fingerprints.get(suite)
+        if fingerprint is None or fingerprint != previous.get(suite):
+            changed.append(suite)
+    return changed
+
+
+def load_fingerprints(path):
+    """Return release fingerprints saved in the specified path."""
+    if not path.exists():
+        return {}
+    with path.open() as fh:
+        return json.load(fh)
+
+
+def save_fingerprints(path, fingerprints):
+    """Save release fingerprints to the specified path."""
+    with path.open('w') as fh:
+        json.dump(fingerprints, fh, indent=2, sort_keys=True)
+
+
+def _make_request(url):
+    """Return a Request for the URL, handling credentials in it."""
+    parts = urlsplit(url)
+    if not parts.username:
+        return Request(url)
+    netloc = parts.hostname
+    if parts.port:
+        netloc += ':{}'.format(parts.port)
+    request = Request(urlunsplit(parts._replace(netloc=netloc)))
+    credentials = '{}:{}'.format(
+        unquote(parts.username), unquote(parts.password or ''))
+    token = base64.b64encode(credentials.encode('utf8')).decode('ascii')
+    request.add_header('Authorization', 'Basic ' + token)
+    return request
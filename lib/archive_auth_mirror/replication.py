@@ -0,0 +1,113 @@
+"""Pull-based replication of the repository among units.
+
+In pull mode the leader doesn't push the repository to peer units. Instead,
+it publishes a generation marker, bumped every time the repository changes.
+Peer units periodically compare it with the generation they have, and pull
+the repository when it differs. Once a pull completes, a unit publishes the
+generation it got, so that other units can pull from it in turn.
+
+The marker also holds the name of the dists generation published along with
+the repository generation, which pulling units switch to once they got it.
+"""
+
+from collections import namedtuple
+import json
+import shlex
+import subprocess
+import time
+
+from .utils import write_atomic
+
+# Replication modes.
+PUSH = 'push'
+PULL = 'pull'
+
+
+def read_generation(path):
+    """Return the Generation in the marker file, or None."""
+    if not path.exists():
+        return None
+    return _parse_generation(path.read_text())
+
+
+def write_generation(path, generation, now=time.time):
+    """Write the Generation to the marker file."""
+    write_atomic(path, json.dumps(
+        {'generation': generation.number, 'dists': generation.dists,
+         'timestamp': now()}) + '\n')
+
+
+def bump_generation(path, dists=None, now=time.time):
+    """Publish a new Generation in the marker file and return it.
+
+    dists is the name of the published dists generation. Generation numbers
+    are based on the current time, so that they're not reused even if the
+    marker file is removed.
+    """
+    previous = read_generation(path)
+    generation = Generation(
+        number=max(
+            int(now() * 1000), (previous.number if previous else 0) + 1),
+        dists=dists)
+    write_generation(path, generation, now=now)
+    return generation
+
+
+def invalidate_generation(path):
+    """Remove the marker file, if it exists.
+
+    This is done before the repository changes, so that pulling units don't
+    take a repository which is being updated for the published generation.
+    """
+    if path.exists():
+        path.unlink()
+
+
+def fetch_generation(host, path, rsh):
+    """Return the Generation published by a remote host.
+
+    None is returned if the host hasn't published a generation yet. If the
+    host can't be reached, CalledProcessError is raised.
+    """
+    command = shlex.split(rsh) + [
+        host, 'cat {} 2>/dev/null || true'.format(shlex.quote(str(path)))]
+    return _parse_generation(
+        subprocess.check_output(command, stdin=subprocess.DEVNULL).decode(
+            'utf8', errors='replace'))
+
+
+def get_pull_sources(leader, units, unit, fanout=0):
+    """Return the addresses of units to pull the repository from, in order.
+
+    With a fanout of 0 all units pull from the leader. Otherwise, units form
+    a tree rooted at the leader, where each unit is pulled from by at most
+    fanout others (a fanout of 1 makes a chain). In this case, the leader is
+    returned as fallback after the parent unit in the tree.
+
+    All units compute the same tree, given the same set of unit addresses.
+    No sources are returned for the leader itself.
+    """
+    if not leader or unit == leader:
+        return []
+    if not fanout:
+        return [leader]
+    nodes = [leader] + sorted(set(units).union([unit]).difference([leader]))
+    parent = nodes[(nodes.index(unit) - 1) // fanout]
+    if parent == leader:
+        return [leader]
+    return [parent, leader]
+
+
+def _parse_generation(content):
+    """Return the Generation from marker content, or None."""
+    try:
+        marker = json.loads(content)
+        return Generation(
+            number=int(marker['generation']), dists=marker.get('dists'))
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+# Generation holds the repository generation number and the name of the
+# dists generation published with it, if any.
+Generation = namedtuple('Generation', 'number dists')
@@ -1,39 +1,108 @@
 """Wrapper around the reprepro tool."""
 
+from collections import namedtuple
+import os
+import re
+import selectors
 from subprocess import Popen, PIPE, CalledProcessError
 
 from .utils import get_paths
 
 
+# Match percentages printed by reprepro when called with --show-percent.
+_PERCENT_RE = re.compile(r'(?<![\d.])(\d{1,3})(?:\.\d+)?%')
+
+
 class Reprepro:
-    """Wrapper to execute reprepro commands."""
+    """Wrapper to execute reprepro commands.
+
+    If a progress callable is provided, it's called with a ProgressEvent for
+    each line of output reporting a percentage of completion. Files are
+    written to the served repository tree, unless a different outdir is
+    provided.
+    """
 
-    def __init__(self, logger, binary='/usr/bin/reprepro'):
+    def __init__(self, logger, binary='/usr/bin/reprepro', progress=None,
+                 outdir=None):
         self._logger = logger
         self._binary = binary
+        self._progress = progress
+        self._outdir = outdir
 
-    def execute(self, *args):
-        """Execute the specified reprepro command."""
+    def execute(self, *args, env=None):
+        """Execute the specified reprepro command.
+
+        Both stdout and stderr are logged while the command runs. If env is
+        provided, it's used as the command environment.
+        """
         command = self._get_command(args)
 
         self._logger.debug('running "{}"'.format(' '.join(command)))
-        with Popen(command, stdout=PIPE, stderr=PIPE) as process:
-            for line in iter(process.stdout.readline, b''):
-                self._logger.info(' ' + line.strip().decode('utf8'))
+        with Popen(command, stdout=PIPE, stderr=PIPE, env=env) as process:
+            for stream, line in _read_lines(process):
+                if stream == 'stdout':
+                    self._logger.info(' ' + line)
+                else:
+                    self._logger.warning(' ' + line)
+                self._report_progress(line)
 
             return_code = process.wait()
             if return_code:
-                for line in process.stderr.readlines():
-                    self._logger.error(' ' + line.strip().decode('utf8'))
                 raise CalledProcessError(return_code, command)
 
     def _get_command(self, args):
         paths = get_paths()
+        outdir = self._outdir
+        if outdir is None:
+            outdir = paths['static'] / 'ubuntu'
         command = [
             self._binary,
             '--basedir', str(paths['reprepro']),
             '--confdir', str(paths['reprepro-conf']),
-            '--outdir', str(paths['static'] / 'ubuntu'),
+            '--outdir', str(outdir),
             '--gnupghome', str(paths['gnupghome'])]
         command.extend(args)
         return command
+
+    def _report_progress(self, line):
+        if self._progress is None:
+            return
+        match = _PERCENT_RE.search(line)
+        if match is None:
+            return
+        percent = int(match.group(1))
+        if percent <= 100:
+            self._progress(ProgressEvent(percent=percent, message=line))
+
+
+def _read_lines(process):
+    """Yield lines written by the process to its stdout and stderr.
+
+    Both pipes are read as data becomes available, so that the process never
+    blocks writing to either of them. Lines are yielded as (stream, line)
+    tuples, with stream being either "stdout" or "stderr". Carriage returns
+    are treated as line separators, and blank lines are skipped.
+    """
+    buffers = {'stdout': b'', 'stderr': b''}
+    with selectors.DefaultSelector() as selector:
+        selector.register(process.stdout, selectors.EVENT_READ, 'stdout')
+        selector.register(process.stderr, selectors.EVENT_READ, 'stderr')
+        while selector.get_map():
+            for key, _ in selector.select():
+                stream = key.data
+                data = os.read(key.fileobj.fileno(), 65536)
+                if data:
+                    *lines, buffers[stream] = re.split(
+                        b'[\r\n]', buffers[stream] + data)
+                else:
+                    # The pipe was closed, flush any partial line.
+                    selector.unregister(key.fileobj)
+                    lines, buffers[stream] = [buffers[stream]], b''
+                for line in lines:
+                    line = line.strip().decode('utf8', errors='replace')
+                    if line:
+                        yield stream, line
+
+
+# ProgressEvent is reported while reprepro runs with --show-percent.
+ProgressEvent = namedtuple('ProgressEvent', 'percent message')
@@ -1,40 +1,269 @@
 """Wrapper around the rsync tool."""
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import re
+import shlex
 import subprocess
+import time
 
 
-def rsync(host, path, rsh=None, delete=False):
-    """Copy a filesytem tree using rsync.
+# Match transfer statistics printed by rsync when called with --stats.
+_STATS_RE = re.compile(
+    r'^(Number of regular files transferred|Total transferred file size):'
+    r'\s*([\d,]+)', re.MULTILINE)
 
-    The path is synced at the same location on the remote host.
 
-    path must be a pathlib.Path instance.
+def rsync_trees(host, paths, rsh=None, delete=False, pull=False,
+                hard_links=False):
+    """Copy multiple filesystem trees using a single rsync run.
 
-    If delete is specified, files not found in the source path are removed from
+    Each path is synced at the same location on the remote host. If pull is
+    True, paths are copied from the remote host instead.
+
+    paths must be a sequence of pathlib.Path instances.
+
+    If delete is specified, files not found in the source paths are removed
+    from the destination, but only after all files have been transferred.
+
+    If hard_links is specified, files hard-linked together in the source are
+    hard-linked in the destination too, and transferred only once.
+
+    Return TransferStats for the run.
+
+    """
+    command = ['/usr/bin/rsync', '-a', '--relative', '--stats']
+    if hard_links:
+        command.append('--hard-links')
+    if rsh is not None:
+        command.extend(['--rsh', rsh])
+    if delete:
+        command.append('--delete-after')
+    sources = [str(path.absolute()) + '/' for path in paths]
+    if pull:
+        # Further sources from the same remote host only need the colon.
+        command.append('{}:{}'.format(host, sources[0]))
+        command.extend(':' + source for source in sources[1:])
+        command.append('/')
+    else:
+        command.extend(sources)
+        command.append('{}:/'.format(host))
+    return _parse_stats(subprocess.check_output(command))
+
+
+def rsync_files(host, root, files_from, rsh=None, delete=False):
+    """Copy the files listed in a file using rsync.
+
+    root is synced at the same location on the remote host, but only the files
+    listed in files_from are transferred. Listed paths are relative to root.
+
+    root and files_from must be pathlib.Path instances.
+
+    If delete is specified, listed files not found in root are removed from
     the destination.
 
+    Return TransferStats for the run.
+
     """
-    path = str(path.absolute()) + '/'
-    command = ['/usr/bin/rsync', '-a']
+    root = str(root.absolute()) + '/'
+    command = [
+        '/usr/bin/rsync', '-a', '--stats', '--files-from', str(files_from)]
     if rsh is not None:
         command.extend(['--rsh', rsh])
     if delete:
-        command.append('--delete')
-    command.extend([path, '{}:{}'.format(host, path)])
-    subprocess.check_output(command)
+        command.append('--delete-missing-args')
+    command.extend([root, '{}:{}'.format(host, root)])
+    return _parse_stats(subprocess.check_output(command))
 
 
-def rsync_multi(hosts, path, logger, rsh=None, delete=False):
-    """Copy a filesystem tree using rsync to multiple hosts.
+class SyncPlan:
+    """An ordered list of rsync runs to perform against each host.
 
-    If a call to rsync to a host fails, the error is logged via the provided
-    logger and the next host is attempted.
+    Each step is a single rsync invocation, transferring either one or more
+    filesystem trees or a list of files from a tree, or a shell command run
+    on the destination. Steps are run in order for each host, and if a step
+    fails the following ones are skipped for that host, so that later steps
+    can rely on earlier ones having completed (for instance, indexes are never
+    pushed without the packages they reference).
 
     """
-    for host in hosts:
-        try:
-            logger.info('rsyncing {} to {}'.format(path, host))
-            rsync(host, path, rsh=rsh, delete=delete)
-        except subprocess.CalledProcessError as error:
-            logger.error(
-                'rsync to {} failed: {}'.format(host, error.output))
+
+    def __init__(self):
+        self.steps = []
+
+    def add_step(self, *paths, delete=False, hard_links=False):
+        """Add a step syncing the given paths.
+
+        If delete is specified, files not found in the source paths are
+        removed from the destination once all files have been transferred.
+        If hard_links is specified, hard links among files are preserved.
+
+        """
+        self.steps.append(SyncStep(
+            paths=paths, delete=delete, files_from=None,
+            hard_links=hard_links, command=None, check=None))
+
+    def add_files_step(self, root, files_from, delete=False):
+        """Add a step syncing only the files listed in files_from.
+
+        Listed paths are relative to root. If delete is specified, listed
+        files not found in root are removed from the destination.
+
+        """
+        self.steps.append(SyncStep(
+            paths=(root,), delete=delete, files_from=files_from,
+            hard_links=False, command=None, check=None))
+
+    def add_command_step(self, command):
+        """Add a step running a shell command on the destination.
+
+        The command is run on the host when pushing, and locally when
+        pulling.
+
+        """
+        self.steps.append(SyncStep(
+            paths=(), delete=False, files_from=None, hard_links=False,
+            command=command, check=None))
+
+    def add_check_step(self, check):
+        """Add a step checking whether the following steps can run.
+
+        check is called with the host when the step runs. It returns None if
+        syncing can go on, or an error message otherwise.
+
+        """
+        self.steps.append(SyncStep(
+            paths=(), delete=False, files_from=None, hard_links=False,
+            command=None, check=check))
+
+    def run(self, hosts, logger, rsh=None, max_workers=1):
+        """Run the plan against the given hosts.
+
+        Up to max_workers hosts are synced concurrently. Source paths that
+        don't exist are skipped.
+
+        Return a dict mapping each host to its SyncResult.
+
+        """
+        return run_plans(
+            {host: self for host in hosts}, logger, rsh=rsh,
+            max_workers=max_workers)
+
+    def sync(self, host, logger, rsh=None, pull=False):
+        """Run the plan against a single host and return its SyncResult.
+
+        If pull is True, paths are copied from the host instead. Only steps
+        syncing whole trees can be pulled.
+
+        Transfer statistics in the result are the totals for all steps.
+        """
+        start = time.monotonic()
+        stats = TransferStats(files=0, bytes=0)
+        for step in self.steps:
+            if step.check is not None:
+                error = step.check(host)
+                if error is not None:
+                    logger.error('sync {} {} stopped: {}'.format(
+                        'from' if pull else 'to', host, error))
+                    return SyncResult(
+                        host=host, success=False, error=error,
+                        seconds=time.monotonic() - start, stats=stats)
+                continue
+            if step.command is not None:
+                try:
+                    logger.info('running {} on {}'.format(
+                        step.command, 'local host' if pull else host))
+                    run_command(host, step.command, rsh=rsh, local=pull)
+                except subprocess.CalledProcessError as error:
+                    logger.error('command on {} failed: {}'.format(
+                        'local host' if pull else host, error.output))
+                    return SyncResult(
+                        host=host, success=False, error=error.output,
+                        seconds=time.monotonic() - start, stats=stats)
+                continue
+            if pull and step.files_from is not None:
+                raise ValueError('steps with a list of files can\'t be pulled')
+            # Source paths are remote when pulling, so they can't be checked.
+            paths = [path for path in step.paths if pull or path.exists()]
+            if not paths:
+                continue
+            try:
+                logger.info('rsyncing {} {} {}'.format(
+                    ', '.join(str(path) for path in paths),
+                    'from' if pull else 'to', host))
+                if step.files_from is None:
+                    step_stats = rsync_trees(
+                        host, paths, rsh=rsh, delete=step.delete, pull=pull,
+                        hard_links=step.hard_links)
+                else:
+                    step_stats = rsync_files(
+                        host, paths[0], step.files_from, rsh=rsh,
+                        delete=step.delete)
+            except subprocess.CalledProcessError as error:
+                logger.error('rsync {} {} failed: {}'.format(
+                    'from' if pull else 'to', host, error.output))
+                return SyncResult(
+                    host=host, success=False, error=error.output,
+                    seconds=time.monotonic() - start, stats=stats)
+            stats = TransferStats(
+                files=stats.files + step_stats.files,
+                bytes=stats.bytes + step_stats.bytes)
+        return SyncResult(
+            host=host, success=True, error=None,
+            seconds=time.monotonic() - start, stats=stats)
+
+
+def run_command(host, command, rsh=None, local=False):
+    """Run a shell command on the remote host, or locally if local is True.
+
+    CalledProcessError is raised if the command fails, with its output.
+
+    """
+    if local:
+        argv = ['/bin/sh', '-c', command]
+    else:
+        argv = shlex.split(rsh or 'ssh') + [host, command]
+    subprocess.check_output(
+        argv, stdin=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+
+
+def run_plans(plans, logger, rsh=None, max_workers=1):
+    """Run a SyncPlan against each host.
+
+    plans is a dict mapping hosts to the SyncPlan to run for them. Up to
+    max_workers hosts are synced concurrently.
+
+    Return a dict mapping each host to its SyncResult.
+
+    """
+    def sync(host):
+        return plans[host].sync(host, logger, rsh=rsh)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        results = list(executor.map(sync, plans))
+    return {result.host: result for result in results}
+
+
+def _parse_stats(output):
+    """Return TransferStats from the output of rsync --stats."""
+    values = {}
+    for match in _STATS_RE.finditer(output.decode('utf8', errors='replace')):
+        values[match.group(1)] = int(match.group(2).replace(',', ''))
+    return TransferStats(
+        files=values.get('Number of regular files transferred', 0),
+        bytes=values.get('Total transferred file size', 0))
+
+
+# SyncResult holds the outcome of syncing to a single host, including the
+# time it took and, when available, TransferStats.
+SyncResult = namedtuple('SyncResult', 'host success error seconds stats')
+
+# TransferStats holds the number of files and bytes transferred by rsync.
+TransferStats = namedtuple('TransferStats', 'files bytes')
+
+# SyncStep is a single rsync run in a SyncPlan. If files_from is not None,
+# only the files listed there are synced from the single path in paths. If
+# command is not None, the step runs the shell command instead, and if check
+# is not None, the step calls it to decide whether to go on.
+SyncStep = namedtuple(
+    'SyncStep', 'paths delete files_from hard_links command check')
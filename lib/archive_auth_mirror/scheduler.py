@@ -0,0 +1,86 @@
+"""Schedule repository updates on a per-suite basis."""
+
+import logging
+from collections import namedtuple
+from subprocess import CalledProcessError
+import time
+
+from .reprepro import Reprepro
+
+
+class SuiteScheduler:
+    """Update suites independently from each other.
+
+    Each suite is updated by a separate reprepro run, so that a failing
+    upstream doesn't abort updates for the other suites, and the outcome of
+    each suite is reported separately.
+
+    Suites are updated one after the other: reprepro locks its database for
+    the whole update, including downloads, so concurrent runs wouldn't make
+    updates any faster.
+    """
+
+    def __init__(self, logger, reprepro_factory=Reprepro):
+        self._logger = logger
+        self._reprepro_factory = reprepro_factory
+
+    def update(self, suites):
+        """Fetch new packages for the given suites.
+
+        Return a dict mapping each suite to its SuiteStatus.
+        """
+        statuses = [self._update_suite(suite) for suite in suites]
+        return {status.suite: status for status in statuses}
+
+    def _update_suite(self, suite):
+        logger = _SuiteLogger(self._logger, {'suite': suite})
+        reprepro = self._reprepro_factory(
+            logger, progress=_ProgressReporter(logger))
+        start = time.monotonic()
+        try:
+            reprepro.execute(
+                '--show-percent', '--export=never', '--keepunreferencedfiles',
+                'update', suite)
+        except CalledProcessError as error:
+            logger.error('update failed: {}'.format(error))
+            return SuiteStatus(
+                suite=suite, success=False, error=str(error),
+                seconds=time.monotonic() - start)
+        return SuiteStatus(
+            suite=suite, success=True, error=None,
+            seconds=time.monotonic() - start)
+
+
+class _ProgressReporter:
+    """Log reprepro progress events.
+
+    Events are logged in steps of at least 10%, and on completion. A lower
+    percentage starts a new sequence of events (for instance, when reprepro
+    moves to the next download).
+    """
+
+    step = 10
+
+    def __init__(self, logger):
+        self._logger = logger
+        self._last_percent = None
+
+    def __call__(self, event):
+        percent, last = event.percent, self._last_percent
+        if last is not None and last <= percent < last + self.step:
+            if percent != 100 or last == 100:
+                return
+        self._last_percent = percent
+        self._logger.info('progress: {}%'.format(percent))
+
+
+class _SuiteLogger(logging.LoggerAdapter):
+    """Prefix log messages with the suite name."""
+
+    def process(self, msg, kwargs):
+        return '[{}] {}'.format(self.extra['suite'], msg), kwargs
+
+
+# SuiteStatus holds the outcome of updating a single suite, and the time it
+# took.
+SuiteStatus = namedtuple('SuiteStatus', 'suite success error seconds')
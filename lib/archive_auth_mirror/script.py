@@ -19,3 +19,13 @@ def setup_logger(level=logging.DEBUG, echo=False):
     if echo:
         logger.addHandler(logging.StreamHandler())
     return logger
+
+
+def load_site():
+    """Load the site module, if the script was started without it.
+
+    This makes packages installed in the virtualenv available.
+    """
+    if sys.flags.no_site:
+        import site
+        site.main()
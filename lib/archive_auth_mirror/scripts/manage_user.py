@@ -2,8 +2,25 @@
 
 import subprocess
 import argparse
+from collections import OrderedDict
+import csv
+import hashlib
+import json
+import os
+import sys
 
-from ..utils import get_paths
+from ..apr1 import check_password, hash_password
+from ..sorted_index import (
+    get_stamp,
+    index_contains,
+    index_count,
+    index_prefix,
+    write_index,
+)
+from ..utils import get_paths, write_atomic
+
+# Minimum number of users for the basic-auth file to be indexed.
+INDEX_MIN_USERS = 1000
 
 
 def add_user(auth_file, user, passwd):
@@ -12,14 +29,84 @@ def add_user(auth_file, user, passwd):
         ['htpasswd', '-i', str(auth_file), user],
         input=passwd.encode('utf8'), stderr=subprocess.DEVNULL,
         check=True)
+    update_index(auth_file)
+
 
+def iter_users(auth_file, prefix=''):
+    """Yield existing users, optionally only those starting with prefix.
 
-def list_users(auth_file):
-    """List existing users."""
+    The file is read one line at a time.
+    """
     if not auth_file.exists():
-        return []
+        return
     with auth_file.open() as fh:
-        return [line.split(':')[0] for line in fh]
+        for line in fh:
+            user = line.split(':', 1)[0].rstrip('\n')
+            if user and user.startswith(prefix):
+                yield user
+
+
+def list_users(auth_file, prefix=''):
+    """List existing users, optionally only those starting with prefix.
+
+    Users with a prefix are looked up in the index if available, and listed
+    sorted, without duplicates. Otherwise, they're listed as in the file.
+    """
+    if prefix:
+        users = index_prefix(
+            get_index_path(auth_file), prefix, get_stamp(auth_file))
+        if users is None:
+            users = sorted(set(iter_users(auth_file, prefix=prefix)))
+        return users
+    return list(iter_users(auth_file))
+
+
+def count_users(auth_file):
+    """Return the number of existing users, not counting duplicates."""
+    count = index_count(get_index_path(auth_file), get_stamp(auth_file))
+    if count is None:
+        count = len(set(iter_users(auth_file)))
+    return count
+
+
+def user_exists(auth_file, user):
+    """Return whether a user exists.
+
+    The index is used if available, otherwise the file is scanned.
+    """
+    found = index_contains(get_index_path(auth_file), user,
+                           get_stamp(auth_file))
+    if found is None:
+        found = any(existing == user for existing in iter_users(auth_file))
+    return found
+
+
+def get_index_path(auth_file):
+    """Return the path of the sorted index for the basic-auth file."""
+    return auth_file.with_name(auth_file.name + '.index')
+
+
+def get_verified_path(auth_file):
+    """Return the path of the file caching passwords verified by imports."""
+    return auth_file.with_name(auth_file.name + '.verified')
+
+
+def update_index(auth_file, users=None):
+    """Rebuild the sorted index of users after the file is written.
+
+    Only files with at least INDEX_MIN_USERS users are indexed, otherwise
+    the index is removed. If users are not passed, they're read from the
+    file.
+    """
+    index_path = get_index_path(auth_file)
+    stamp = get_stamp(auth_file)
+    if users is None:
+        users = list(iter_users(auth_file))
+    if stamp is None or len(users) < INDEX_MIN_USERS:
+        if index_path.exists():
+            index_path.unlink()
+        return
+    write_index(index_path, users, stamp, indexed_path=auth_file)
 
 
 def remove_user(auth_file, user):
@@ -27,6 +114,129 @@ def remove_user(auth_file, user):
     subprocess.check_call(
         ['htpasswd', '-D', str(auth_file), user],
         stderr=subprocess.DEVNULL)
+    update_index(auth_file)
+
+
+def read_users(auth_file):
+    """Return an OrderedDict mapping users to their password hashes."""
+    users = OrderedDict()
+    if not auth_file.exists():
+        return users
+    with auth_file.open() as fh:
+        for line in fh:
+            line = line.rstrip('\n')
+            if line:
+                user, _, hashed = line.partition(':')
+                users[user] = hashed
+    return users
+
+
+def write_users(auth_file, users):
+    """Write users and password hashes to the file, atomically.
+
+    The ownership and permissions of the existing file are preserved, and
+    the index is rebuilt.
+    """
+    tmp_file = auth_file.with_name('.' + auth_file.name + '.tmp')
+    fd = os.open(
+        str(tmp_file), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, 'w') as fh:
+        fh.writelines(
+            '{}:{}\n'.format(user, hashed) for user, hashed in users.items())
+    if auth_file.exists():
+        stat = auth_file.stat()
+        os.chown(str(tmp_file), stat.st_uid, stat.st_gid)
+        os.chmod(str(tmp_file), stat.st_mode & 0o7777)
+    os.replace(str(tmp_file), str(auth_file))
+    update_index(auth_file, users=users)
+
+
+def read_credentials(fh):
+    """Return a list of (user, password) tuples from CSV content.
+
+    Each row must contain the user and the password. Empty rows are ignored.
+    """
+    credentials = []
+    reader = csv.reader(fh)
+    for row in reader:
+        if not row:
+            continue
+        if len(row) != 2:
+            raise ValueError('line {}: expected user and password'.format(
+                reader.line_num))
+        user, passwd = row
+        if not user or ':' in user:
+            raise ValueError('line {}: invalid user name {!r}'.format(
+                reader.line_num, user))
+        credentials.append((user, passwd))
+    return credentials
+
+
+def import_users(auth_file, credentials, remove_others=False):
+    """Add or update users in bulk, from (user, password) tuples.
+
+    If remove_others is True, users not in credentials are removed. The file
+    is read and written once, and only if changes are made. Return a tuple
+    with the number of added, updated and removed users.
+
+    Checking a password against its apr1 hash is slow, so passwords found
+    unchanged are recorded in a cache, and not checked again as long as the
+    same password and hash are imported.
+    """
+    users = read_users(auth_file)
+    verified_path = get_verified_path(auth_file)
+    verified = _read_verified(verified_path)
+    new_verified = {
+        user: digest for user, digest in verified.items() if user in users}
+    added = updated = removed = 0
+    for user, passwd in credentials:
+        hashed = users.get(user)
+        if hashed is None:
+            added += 1
+        else:
+            digest = _password_digest(passwd, hashed)
+            if (verified.get(user) == digest or
+                    check_password(passwd, hashed)):
+                new_verified[user] = digest
+                continue
+            updated += 1
+        hashed = hash_password(passwd)
+        users[user] = hashed
+        new_verified[user] = _password_digest(passwd, hashed)
+    if remove_others:
+        keep = set(user for user, _ in credentials)
+        for user in list(users):
+            if user not in keep:
+                del users[user]
+                new_verified.pop(user, None)
+                removed += 1
+    if added or updated or removed:
+        write_users(auth_file, users)
+    if new_verified != verified:
+        # The cache allows checking passwords faster than the hashes in the
+        # auth file do, so it's only readable by the owner.
+        write_atomic(
+            verified_path, json.dumps(new_verified, sort_keys=True),
+            mode=0o600)
+    return added, updated, removed
+
+
+def _password_digest(passwd, hashed):
+    """Return a digest of a password and its apr1 hash.
+
+    The hash is salted, so digests differ for each user and hashing.
+    """
+    return hashlib.sha256(
+        (hashed + '\n' + passwd).encode('utf8')).hexdigest()
+
+
+def _read_verified(path):
+    """Return the cache of verified passwords, as a dict."""
+    try:
+        verified = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return {}
+    return verified if isinstance(verified, dict) else {}
 
 
 def get_parser():
@@ -41,11 +251,29 @@ def get_parser():
     add_action.add_argument('user', help='the username to add')
     add_action.add_argument('password', help='the password for the user')
 
-    subparsers.add_parser('list', help='list users')
+    list_action = subparsers.add_parser('list', help='list users')
+    list_action.add_argument(
+        '--prefix', default='', help='only list users with this prefix')
+
+    subparsers.add_parser('count', help='print the number of users')
+
+    exists_action = subparsers.add_parser(
+        'exists', help='exit with status 0 if a user exists, 1 otherwise')
+    exists_action.add_argument('user', help='the user to look up')
 
     remove_action = subparsers.add_parser('remove', help='remove a user')
     remove_action.add_argument('user', help='the user to remove')
 
+    for name, description in (
+            ('import', 'add or update users in bulk'),
+            ('sync', 'set the exact list of users, removing any other')):
+        bulk_action = subparsers.add_parser(
+            name, help='{}, from CSV "user,password" lines'.format(
+                description))
+        bulk_action.add_argument(
+            'file', nargs='?', type=argparse.FileType('r'), default='-',
+            help='the CSV file to read, standard input by default')
+
     return parser
 
 
@@ -58,5 +286,23 @@ def main():
     elif args.action == 'remove':
         remove_user(auth_file, args.user)
     elif args.action == 'list':
-        for user in list_users(auth_file):
+        # Without a prefix, users are streamed from the file.
+        users = (
+            list_users(auth_file, prefix=args.prefix) if args.prefix
+            else iter_users(auth_file))
+        for user in users:
             print(user)
+    elif args.action == 'count':
+        print(count_users(auth_file))
+    elif args.action == 'exists':
+        sys.exit(0 if user_exists(auth_file, args.user) else 1)
+    elif args.action in ('import', 'sync'):
+        with args.file as fh:
+            try:
+                credentials = read_credentials(fh)
+            except ValueError as error:
+                sys.exit('invalid input: {}'.format(error))
+        added, updated, removed = import_users(
+            auth_file, credentials, remove_others=args.action == 'sync')
+        print('{} added, {} updated, {} removed'.format(
+            added, updated, removed))
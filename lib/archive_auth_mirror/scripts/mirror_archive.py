@@ -1,27 +1,113 @@
 """Mirror and update a repository."""
 
-import functools
+import argparse
+from functools import partial
+import hashlib
+import json
+import os
+import shutil
+import signal
 import subprocess
 import sys
+import tempfile
+from pathlib import Path
 
+from ..daemon import (
+    MAX_INTERVAL,
+    MIN_INTERVAL,
+    AdaptiveInterval,
+    ConfigWatcher,
+    CycleResult,
+    Daemon,
+)
+from ..dists import (
+    KEEP_GENERATIONS,
+    adopt_directory,
+    create_generation,
+    get_incomplete,
+    get_published,
+    prune_generations,
+    publish_generation,
+    switch_link_command,
+)
+from ..health import PeerHealth
 from ..utils import get_paths, get_config
 from ..lock import LockFile, AlreadyLocked
+from ..manifest import diff, snapshot, write_file_list
+from ..metrics import RunMetrics
+from ..preflight import (
+    changed_suites,
+    get_release_fingerprints,
+    load_fingerprints,
+    save_fingerprints,
+)
+from ..replication import (
+    PULL,
+    PUSH,
+    bump_generation,
+    invalidate_generation,
+    read_generation,
+)
 from ..reprepro import Reprepro
-from ..rsync import rsync_multi
+from ..rsync import SyncPlan, run_plans
+from ..scheduler import SuiteScheduler
 from ..script import setup_logger
+from ..signing import SPOOL_ENV, SigningAgent, SigningError, read_spool
+from ..ssh import ConnectionPool
+from .reprepro_sign_helper import patch_release, sign_release
+
+
+def get_sync_plan(paths, dists=None, check=None):
+    """Return the SyncPlan used to push the whole repository to peer units.
+
+    dists is the name of the dists generation to publish on peer units, by
+    default the one published locally. If check is given, it's run as a check
+    step before old files are deleted.
+    """
+    pool = paths['static'] / 'ubuntu' / 'pool'
+    plan = SyncPlan()
+    # Push new pool packages first, so that peer units never serve indexes
+    # referencing packages they don't have yet.
+    plan.add_step(pool)
+    _add_dists_steps(plan, paths, dists)
+    # Delete old pool packages and generations only once everything else has
+    # been transferred.
+    if check is not None:
+        plan.add_check_step(check)
+    plan.add_step(
+        pool, paths['dists-generations'], *_get_reprepro_dirs(paths),
+        delete=True, hard_links=True)
+    return plan
+
+
+def get_delta_sync_plan(paths, manifest, workdir):
+    """Return a SyncPlan pushing only pool files changed in the manifest.
+
+    The lists of files to transfer are written in workdir. Peer units must be
+    already in sync with the repository as it was before the changes.
+    """
+    pool = paths['static'] / 'ubuntu' / 'pool'
+    plan = SyncPlan()
+    if manifest.added:
+        added = workdir / 'added'
+        write_file_list(manifest.added, added)
+        plan.add_files_step(pool, added)
+    _add_dists_steps(plan, paths, None)
+    plan.add_step(
+        paths['dists-generations'], *_get_reprepro_dirs(paths),
+        delete=True, hard_links=True)
+    if manifest.removed:
+        removed = workdir / 'removed'
+        write_file_list(manifest.removed, removed)
+        plan.add_files_step(pool, removed, delete=True)
+    return plan
 
 
 def main():
+    args = get_parser().parse_args()
     logger = setup_logger(echo=True)
     paths = get_paths()
-    config = get_config()
-    suites = config['suites']
-    other_units = config.get('ssh-peers', {}).keys()
-    # Using StrictHostKeyChecking=no isn't ideal, but we don't yet
-    # popolate known_hosts with the right keys. But we trust the
-    # network, and we don't push any sensitive data.
-    rsh = 'ssh -o StrictHostKeyChecking=no -i {}'.format(paths['ssh-key'])
-    remote_sync = functools.partial(rsync_multi, other_units, rsh=rsh)
+    connections = ConnectionPool(paths['ssh-key'], paths['ssh-control'])
     lockfile = LockFile(paths['lockfile'])
 
     try:
@@ -30,41 +116,401 @@ def main():
         logger.error('another process is already running, exiting')
         sys.exit(1)
 
+    try:
+        if args.daemon:
+            _run_daemon(logger, paths, connections)
+            return
+        result = run_cycle(logger, paths, get_config(), connections)
+        if not result.success:
+            sys.exit(1)
+    finally:
+        connections.close()
+        lockfile.release()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--daemon', action='store_true',
+        help='keep running, mirroring again when upstream changes are found')
+    return parser
+
+
+def run_cycle(logger, paths, config, connections):
+    """Mirror upstream changes and replicate them to peer units.
+
+    Return a CycleResult.
+    """
+    suites = config['suites']
+    other_units = config.get('ssh-peers', {}).keys()
+    # In pull mode, peer units fetch the repository on their own.
+    pull_mode = config.get('replication-mode', PUSH) == PULL
     logger.info('starting mirroring')
 
-    reprepro = Reprepro(logger)
+    metrics = RunMetrics()
+    health = PeerHealth(paths['peer-health'])
+    health.prune(other_units)
+    changed = []
+    success = False
+    served = paths['static'] / 'ubuntu'
+    pool = served / 'pool'
     try:
-        logger.info('fetching new pool packages')
-        reprepro.execute(
-            '--show-percent', '--export=never', '--keepunreferencedfiles',
-            'update', *suites)
+        logger.info('checking upstream repositories for changes')
+        with metrics.phase('preflight'):
+            fingerprints = get_release_fingerprints(
+                config.get('upstreams', {}), logger,
+                salt=_get_config_digest(paths, config))
+        saved_fingerprints = load_fingerprints(paths['release-fingerprints'])
+        changed = changed_suites(suites, fingerprints, saved_fingerprints)
+        synced_units = _read_synced_units(paths['synced-peers'])
+        # Unhealthy peer units are only synced once their probe delay is over.
+        available_units = health.select(other_units)
+        skipped_units = sorted(set(other_units) - set(available_units))
+        if skipped_units:
+            logger.warning('skipping unhealthy peer units: {}'.format(
+                ', '.join(skipped_units)))
+        if pull_mode:
+            up_to_date = read_generation(paths['generation']) is not None
+        else:
+            up_to_date = synced_units.issuperset(available_units)
+            # Units in pull mode would otherwise keep pulling a generation
+            # which is not updated anymore.
+            invalidate_generation(paths['generation'])
+        # A stage left over by a failed run holds changes already recorded in
+        # the reprepro database, so it must be published in any case.
+        staged = get_incomplete(paths['snapshots'])
+        if not changed and up_to_date and staged is None:
+            logger.info('no upstream changes, nothing to do')
+            success = True
+            return CycleResult(changed=False, success=True)
+        # Until peer units are synced again, none of them can be considered
+        # in sync, as the local repository is about to change.
+        _write_synced_units(paths['synced-peers'], [])
+
+        if pull_mode:
+            # Units pulling while the repository changes notice the marker
+            # is gone, and don't delete files the previous generation has.
+            invalidate_generation(paths['generation'])
+        else:
+            logger.info('opening ssh connections to peer units')
+            for unit in connections.open(available_units, logger):
+                health.mark_failed(unit, 'cannot open ssh connection')
+
+        stage = None
+        if staged is not None or (
+                changed and config.get('snapshot-staging', False)):
+            stage = _get_stage(logger, paths)
+        reprepro = Reprepro(logger, outdir=stage)
+        pool_before = snapshot(pool)
 
-        logger.info('rsyncing new pool packages to peer units')
-        remote_sync(paths['static'] / 'ubuntu', logger)
+        failed_suites = []
+        if changed:
+            logger.info('fetching new pool packages')
+            scheduler = SuiteScheduler(
+                logger, reprepro_factory=partial(Reprepro, outdir=stage))
+            with metrics.phase('update'):
+                statuses = scheduler.update(changed)
+            for status in statuses.values():
+                metrics.add_suite(status)
+            failed_suites = sorted(
+                suite for suite, status in statuses.items()
+                if not status.success)
+            if failed_suites:
+                logger.error('failed to update suites: {}'.format(
+                    ', '.join(failed_suites)))
 
-        logger.info('generating new dists directory')
-        reprepro.execute('export', *suites)
+            logger.info('generating new dists directory')
+            with metrics.phase('export'):
+                export(logger, paths, config, reprepro, changed, outdir=stage)
 
-        logger.info('rsyncing new dists directory to peer units')
-        remote_sync(paths['static'] / 'ubuntu' / 'dists', logger)
+            # Only save fingerprints for updated suites, so that failed ones
+            # are attempted again at the next run.
+            saved_fingerprints.update(
+                (suite, fingerprints[suite]) for suite in changed
+                if statuses[suite].success and fingerprints.get(suite))
+            save_fingerprints(
+                paths['release-fingerprints'], saved_fingerprints)
+        else:
+            logger.info('no upstream changes, syncing peer units only')
 
         logger.info('deleting old pool packages')
-        reprepro.execute('deleteunreferenced')
+        with metrics.phase('deleteunreferenced'):
+            reprepro.execute('deleteunreferenced')
 
-        logger.info('deleting old pool packages on peer units')
-        remote_sync(paths['static'] / 'ubuntu', logger, delete=True)
+        if stage is not None:
+            stage = publish_generation(served, stage)
+            prune_generations(paths['snapshots'], {stage.name}, keep=1)
+            logger.info('published repository snapshot {}'.format(stage.name))
 
-        logger.info('rsyncing reprepro dir to peer units')
-        # Push only the reprepro db and lists, not the conf dir. Each
-        # unit should generate the conf dir themselves, so we don't push
-        # it, since it contains the private signing key, which is
-        # sensitive data.
-        remote_sync(paths['reprepro'] / 'db', logger, delete=True)
-        remote_sync(paths['reprepro'] / 'lists', logger, delete=True)
+        manifest = diff(pool_before, snapshot(pool))
+        logger.info('{} pool files added, {} removed'.format(
+            len(manifest.added), len(manifest.removed)))
+        metrics.set_pool_changes(len(manifest.added), len(manifest.removed))
 
-        logger.info('mirroring completed')
-    except subprocess.CalledProcessError:
+        # Peer units get dists generations, even if the repository was
+        # exported before they were used.
+        dists = served / 'dists'
+        if adopt_directory(dists, paths['dists-generations']):
+            logger.info('moved the dists directory to a generation')
+        if pull_mode:
+            generation = bump_generation(
+                paths['generation'], dists=get_published(dists))
+            logger.info('published generation {} for peer units'.format(
+                generation.number))
+        else:
+            _push(logger, paths, config, connections, metrics, health,
+                  manifest, synced_units, available_units)
+
+        if failed_suites:
+            logger.error('mirroring completed with errors')
+        else:
+            logger.info('mirroring completed')
+            success = True
+    except (subprocess.CalledProcessError, SigningError):
         logger.error('mirroring failed')
-        sys.exit(1)
     finally:
-        lockfile.release()
+        for unit in other_units:
+            status = health.status(unit)
+            if status is not None:
+                metrics.add_unhealthy_peer(unit, status)
+        metrics.finish(success)
+        _write_metrics(metrics, paths, logger)
+        _save_health(health, logger)
+    return CycleResult(changed=bool(changed), success=success)
+
+
+def _push(logger, paths, config, connections, metrics, health, manifest,
+          synced_units, units):
+    """Push the repository to peer units.
+
+    Units in sync after the last run only get the changes in the manifest.
+    """
+    logger.info('rsyncing repository to peer units')
+    with metrics.phase('sync'), tempfile.TemporaryDirectory() as workdir:
+        full_plan = get_sync_plan(paths)
+        delta_plan = get_delta_sync_plan(paths, manifest, Path(workdir))
+        results = run_plans(
+            {unit: delta_plan if unit in synced_units else full_plan
+             for unit in health.select(units)},
+            logger, rsh=connections.rsh,
+            max_workers=config.get('sync-concurrency', 1))
+    for unit, result in results.items():
+        metrics.add_peer(unit, result)
+        if result.success:
+            health.mark_healthy(unit)
+        else:
+            health.mark_failed(unit, _format_error(result.error))
+    _write_synced_units(
+        paths['synced-peers'],
+        [unit for unit, result in results.items() if result.success])
+
+
+def _add_dists_steps(plan, paths, dists):
+    """Add steps copying dists generations and publishing one of them.
+
+    If dists is None, the generation published locally is used.
+    """
+    link = paths['static'] / 'ubuntu' / 'dists'
+    if dists is None:
+        dists = get_published(link)
+    # Generations share files through hard links, so that files which are the
+    # same as in previous generations are not transferred again.
+    plan.add_step(paths['dists-generations'], hard_links=True)
+    if dists is not None:
+        # Peer units switch to the new generation at once, as done locally.
+        plan.add_command_step(switch_link_command(
+            link, paths['dists-generations'] / dists))
+
+
+def _get_reprepro_dirs(paths):
+    """Return the reprepro directories to push to peer units."""
+    # Push only the reprepro db and lists, not the conf dir. Each unit should
+    # generate the conf dir themselves, so we don't push it, since it
+    # contains the private signing key, which is sensitive data.
+    return paths['reprepro'] / 'db', paths['reprepro'] / 'lists'
+
+
+def _get_stage(logger, paths):
+    """Return the directory to stage repository changes in.
+
+    The stage is a copy of the served repository tree made of hard links, so
+    that no data is copied. A stage left over by a failed run is used again.
+    """
+    stage = get_incomplete(paths['snapshots'])
+    if stage is not None:
+        logger.info('resuming changes staged in {}'.format(stage))
+        return stage
+    served = paths['static'] / 'ubuntu'
+    if adopt_directory(served, paths['snapshots']):
+        logger.info('moved the repository to a snapshot')
+    logger.info('staging changes in a snapshot of the repository')
+    return create_generation(served, paths['snapshots'])
+
+
+def _get_signing_agent(logger, paths, config):
+    """Return a SigningAgent for signing Release files during export.
+
+    While the agent is running, the reprepro sign helper forwards requests to
+    it, so that the signing key is set up only once.
+    """
+    # GPG support is only imported when there's something to export.
+    from ..gpg import Signer
+    sign = partial(
+        sign_release, Signer(config['sign-key-id'], paths=paths),
+        packages_require_auth=config.get('packages-require-auth', False))
+    return SigningAgent(paths['sign-agent-socket'], sign, logger)
+
+
+def _get_config_digest(paths, config):
+    """Return a digest of the mirroring configuration.
+
+    The digest is included in upstream release fingerprints, so that all
+    suites are updated and exported again when the configuration changes.
+    """
+    digest = hashlib.sha256()
+    options = {
+        key: config.get(key)
+        for key in ('sign-key-id', 'packages-require-auth')}
+    digest.update(json.dumps(options, sort_keys=True).encode('utf8'))
+    for path in (
+            paths['reprepro-conf'] / 'distributions',
+            paths['reprepro-conf'] / 'updates'):
+        if path.exists():
+            digest.update(path.read_bytes())
+    return digest.digest()
+
+
+def export(logger, paths, config, reprepro, suites, outdir=None):
+    """Export the given suites, signing their Release files.
+
+    Suites are exported to a new generation of the dists directory, which is
+    published once complete. Old generations are then removed, keeping as
+    many as configured.
+
+    If outdir is specified, the generation is published in the dists link
+    there, instead of the served one.
+    """
+    served = paths['static'] / 'ubuntu' / 'dists'
+    dists = served if outdir is None else outdir / 'dists'
+    generation = create_generation(
+        dists, paths['dists-generations'], exclude=suites)
+    try:
+        _export_generation(logger, paths, config, reprepro, suites, generation)
+    except Exception:
+        shutil.rmtree(str(generation))
+        raise
+    generation = publish_generation(dists, generation)
+    logger.info('published dists generation {}'.format(generation.name))
+    # Generations still served are kept too.
+    prune_generations(
+        paths['dists-generations'],
+        {get_published(dists), get_published(served)},
+        keep=config.get('dists-generations', KEEP_GENERATIONS))
+
+
+def _export_generation(logger, paths, config, reprepro, suites, generation):
+    """Export the given suites to a dists generation directory.
+
+    Unless the sign concurrency is 1, signing is deferred until the export
+    completes, and Release files are then signed in parallel.
+    """
+    concurrency = config.get('sign-concurrency', 1)
+    if concurrency == 1:
+        with _get_signing_agent(logger, paths, config):
+            reprepro.execute('--distdir', str(generation), 'export', *suites)
+        return
+
+    with tempfile.TemporaryDirectory(
+            prefix='sign-spool-', dir=str(paths['base'])) as workdir:
+        spool = Path(workdir) / 'sign-spool'
+        env = dict(os.environ)
+        env[SPOOL_ENV] = str(spool)
+        reprepro.execute(
+            '--distdir', str(generation), 'export', *suites, env=env)
+
+        from ..gpg import sign_files
+        requests = read_spool(spool)
+        logger.info('signing {} release files'.format(len(requests)))
+        errors = sign_files(
+            config['sign-key-id'], requests, paths=paths,
+            max_workers=concurrency or None,
+            transform=partial(
+                patch_release,
+                packages_require_auth=config.get(
+                    'packages-require-auth', False)))
+        failed = [
+            (request[0], error) for request, error in zip(requests, errors)
+            if error]
+        for path, error in failed:
+            logger.error('signing {} failed: {}'.format(path, error))
+        if failed:
+            raise SigningError('cannot sign release files')
+
+
+def _run_daemon(logger, paths, connections):
+    """Run mirroring cycles until the process is terminated.
+
+    The parsed configuration and ssh master connections are kept between
+    cycles. SIGHUP triggers a new cycle immediately.
+    """
+    config = ConfigWatcher(paths['config'], get_config)
+    interval = AdaptiveInterval()
+
+    def cycle():
+        options = config.get()
+        interval.set_bounds(
+            options.get('daemon-min-interval', MIN_INTERVAL),
+            options.get('daemon-max-interval', MAX_INTERVAL))
+        try:
+            return run_cycle(logger, paths, options, connections)
+        except Exception:
+            # Keep the daemon running, the next cycle might succeed.
+            logger.exception('mirroring failed')
+            return CycleResult(changed=False, success=False)
+
+    daemon = Daemon(cycle, logger, interval=interval)
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: daemon.stop())
+    signal.signal(signal.SIGHUP, lambda signum, frame: daemon.wakeup())
+    daemon.run()
+
+
+def _write_metrics(metrics, paths, logger):
+    """Save metrics for the run, logging failures."""
+    try:
+        metrics.write(
+            json_path=paths['metrics'],
+            textfile_path=paths['metrics-textfile'])
+    except OSError as error:
+        logger.warning('cannot save metrics: {}'.format(error))
+
+
+def _save_health(health, logger):
+    """Save the peer health registry, logging failures."""
+    try:
+        health.save()
+    except OSError as error:
+        logger.warning('cannot save peer health: {}'.format(error))
+
+
+def _format_error(error):
+    """Return an error from a SyncResult as text."""
+    if isinstance(error, bytes):
+        error = error.decode('utf8', errors='replace')
+    return (error or '').strip()
+
+
+def _read_synced_units(path):
+    """Return the set of peer units which were in sync after the last run.
+
+    Units not in the set need a full sync, as changes from previous runs may
+    not have reached them.
+    """
+    if not path.exists():
+        return set()
+    return set(path.read_text().split())
+
+
+def _write_synced_units(path, units):
+    """Save the list of peer units in sync with the repository."""
+    path.write_text(''.join(unit + '\n' for unit in sorted(units)))
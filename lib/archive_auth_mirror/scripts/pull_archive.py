@@ -0,0 +1,143 @@
+"""Pull the repository from the leader or from another peer unit."""
+
+import subprocess
+import sys
+
+from ..lock import LockFile, AlreadyLocked
+from ..metrics import RunMetrics
+from ..replication import (
+    fetch_generation,
+    get_pull_sources,
+    invalidate_generation,
+    read_generation,
+    write_generation,
+)
+from ..script import setup_logger
+from ..ssh import ConnectionPool
+from ..utils import get_config, get_paths
+from .mirror_archive import get_sync_plan
+
+
+def main():
+    logger = setup_logger(echo=True)
+    paths = get_paths()
+    config = get_config()
+    if not config:
+        logger.error('no config file found')
+        sys.exit(1)
+    connections = ConnectionPool(paths['ssh-key'], paths['ssh-control'])
+    lockfile = LockFile(paths['lockfile'])
+
+    try:
+        lockfile.lock()
+    except AlreadyLocked:
+        logger.error('another process is already running, exiting')
+        sys.exit(1)
+
+    try:
+        sources = get_pull_sources(
+            config.get('leader-address'), config.get('ssh-peers', {}),
+            config.get('unit-address'), fanout=config.get('pull-fanout', 0))
+        if not sources:
+            logger.info('no units to pull from, nothing to do')
+            return
+        if not pull(logger, paths, sources, connections):
+            sys.exit(1)
+    finally:
+        connections.close()
+        lockfile.release()
+
+
+def pull(logger, paths, sources, connections):
+    """Pull the repository from the first available source unit.
+
+    The repository is only pulled if the generation published by the source
+    differs from the local one. Return whether the repository is up to date
+    with a source.
+    """
+    for source in sources:
+        connections.open([source], logger)
+        try:
+            remote = fetch_generation(
+                source, paths['generation'], connections.rsh)
+        except subprocess.CalledProcessError:
+            logger.warning('cannot reach {}'.format(source))
+            continue
+        if remote is None:
+            logger.info('no generation published by {} yet'.format(source))
+            continue
+        local = read_generation(paths['generation'])
+        if remote == local:
+            logger.info('repository at generation {}, nothing to do'.format(
+                local.number))
+            return True
+        if _pull_generation(logger, paths, source, remote, connections):
+            return True
+    logger.error('cannot pull from any of {}'.format(', '.join(sources)))
+    return False
+
+
+def _pull_generation(logger, paths, source, generation, connections):
+    """Pull a generation of the repository from the source unit.
+
+    The dists generation published by the source is published locally too.
+    The local generation is withdrawn while pulling, and published again only
+    once the whole generation has been pulled. Return whether the pull
+    succeeded.
+    """
+    logger.info('pulling generation {} from {}'.format(
+        generation.number, source))
+    metrics = RunMetrics()
+    success = False
+    changed = []
+
+    def check_generation(host):
+        # Old files are only deleted if the source didn't start changing the
+        # repository, as files of the generation being pulled might be gone.
+        if _fetch_current(paths, source, connections) != generation:
+            changed.append(host)
+            return 'generation changed during the pull'
+
+    try:
+        # Units pulling from this one must not take the repository for the
+        # previous generation while it changes.
+        invalidate_generation(paths['generation'])
+        with metrics.phase('sync'):
+            plan = get_sync_plan(
+                paths, dists=generation.dists, check=check_generation)
+            result = plan.sync(source, logger, rsh=connections.rsh, pull=True)
+        metrics.add_peer(source, result)
+        if changed:
+            # The local repository is still usable, but it's pulled again at
+            # the next run.
+            logger.info(
+                '{} changed during the pull, old files kept'.format(source))
+            success = True
+            return True
+        if not result.success:
+            return False
+        # If the source changed during the pull, the local copy might be a
+        # mix of generations, so it's pulled again at the next run.
+        if _fetch_current(paths, source, connections) == generation:
+            write_generation(paths['generation'], generation)
+            logger.info('pulled generation {}'.format(generation.number))
+        else:
+            logger.info('{} changed during the pull'.format(source))
+        success = True
+        return True
+    finally:
+        metrics.finish(success)
+        try:
+            metrics.write(
+                json_path=paths['metrics'],
+                textfile_path=paths['metrics-textfile'])
+        except OSError as error:
+            logger.warning('cannot save metrics: {}'.format(error))
+
+
+def _fetch_current(paths, source, connections):
+    """Return the Generation currently published by the source, or None."""
+    try:
+        return fetch_generation(source, paths['generation'], connections.rsh)
+    except subprocess.CalledProcessError:
+        return None
@@ -1,12 +1,20 @@
 """Helper for reprepro to sign archive lists."""
 
+import os
 import sys
 import argparse
+from functools import partial
 from pathlib import Path
 
-from ..utils import get_config
-from ..gpg import inline_sign, detach_sign
-from ..script import setup_logger
+from ..utils import get_config, get_paths
+from ..script import load_site, setup_logger
+from ..signing import (
+    SPOOL_ENV,
+    AgentUnavailable,
+    SigningError,
+    request_signature,
+    spool_request,
+)
 
 
 def parse_args(args=None):
@@ -21,33 +29,69 @@ def parse_args(args=None):
     return parser.parse_args(args=args)
 
 
-def patch_release_file(path, packages_require_auth):
-    """Insert some custom fields in the Release file."""
-    patch_path = path.with_suffix(".patched")
-    with path.open() as file:
-        with patch_path.open("x") as outfile:
-            for line in file:
-                if line.startswith('Codename:'):
-                    line = line.rstrip().split('-')[0] + '\n'
-                elif packages_require_auth and line.startswith("MD5Sum:"):
-                    outfile.write("Packages-Require-Authorization: yes\n")
-                outfile.write(line)
-    patch_path.rename(path)
+def patch_release(content, packages_require_auth):
+    """Return the Release file content with some custom fields inserted."""
+    lines = []
+    for line in content.splitlines(keepends=True):
+        if line.startswith('Codename:'):
+            line = line.rstrip().split('-')[0] + '\n'
+        elif packages_require_auth and line.startswith("MD5Sum:"):
+            lines.append("Packages-Require-Authorization: yes\n")
+        lines.append(line)
+    return ''.join(lines)
+
+
+def sign_release(signer, unsigned_file, inline_sign_file, detach_sign_file,
+                 packages_require_auth=False):
+    """Patch a Release file and sign it with the given Signer.
+
+    The file is read once, and patched in memory before signing.
+    """
+    signer.sign(
+        unsigned_file, inline_sign_file=inline_sign_file,
+        detach_sign_file=detach_sign_file,
+        transform=partial(
+            patch_release, packages_require_auth=packages_require_auth))
 
 
 def main():
     logger = setup_logger()
+    args = parse_args()
+    unsigned_file = Path(args.unsigned_file)
+    inline_sign_file = (
+        Path(args.inline_sign_file) if args.inline_sign_file else None)
+    detach_sign_file = (
+        Path(args.detach_sign_file) if args.detach_sign_file else None)
+
+    spool = os.environ.get(SPOOL_ENV)
+    if spool:
+        # Files are signed in batch once the export completes.
+        spool_request(
+            Path(spool), unsigned_file, inline_sign_file, detach_sign_file)
+        return
+
+    # Let the signing agent do the work if it's running, since it's already
+    # set up for signing.
+    try:
+        request_signature(
+            get_paths()['sign-agent-socket'], unsigned_file,
+            inline_sign_file, detach_sign_file)
+        return
+    except AgentUnavailable:
+        pass
+    except SigningError as error:
+        logger.error('signing failed: {}'.format(error))
+        sys.exit(1)
+
+    # Only load site packages when signing in this process. This must happen
+    # before reading the config, which might need the YAML parser.
+    load_site()
     config = get_config()
     if not config:
         logger.error('no config file found')
         sys.exit(1)
-    sign_key = config['sign-key-id']
-
-    args = parse_args()
-    unsigned_file = Path(args.unsigned_file)
-    patch_release_file(
-        unsigned_file, config.get('packages-require-auth', False))
-    if args.inline_sign_file:
-        inline_sign(sign_key, unsigned_file, Path(args.inline_sign_file))
-    if args.detach_sign_file:
-        detach_sign(sign_key, unsigned_file, Path(args.detach_sign_file))
+    from ..gpg import Signer
+    sign_release(
+        Signer(config['sign-key-id']), unsigned_file, inline_sign_file,
+        detach_sign_file,
+        packages_require_auth=config.get('packages-require-auth', False))
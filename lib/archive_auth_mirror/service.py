@@ -0,0 +1,54 @@
+"""Systemd service configuration for running the mirroring daemon."""
+
+import subprocess
+import textwrap
+
+from .utils import get_paths
+
+
+SERVICE_NAME = 'archive-auth-mirror'
+
+SERVICE_TEMPLATE = textwrap.dedent(
+    '''
+    [Unit]
+    Description=Mirror and sync the archive-auth-mirror repository
+    After=network-online.target
+
+    [Service]
+    ExecStart={paths[bin]}/mirror-archive --daemon
+    ExecReload=/bin/kill -HUP $MAINPID
+    Restart=on-failure
+    RestartSec=60
+
+    [Install]
+    WantedBy=multi-user.target
+    ''').lstrip()
+
+
+def install_service(paths=None):
+    """Install and start the systemd service running the mirroring daemon."""
+    if paths is None:
+        paths = get_paths()
+
+    with paths['service'].open('w') as fh:
+        fh.write(SERVICE_TEMPLATE.format(paths=paths))
+    _systemctl('daemon-reload')
+    _systemctl('enable', SERVICE_NAME)
+    _systemctl('restart', SERVICE_NAME)
+
+
+def remove_service(paths=None):
+    """Stop and remove the systemd service, if installed."""
+    if paths is None:
+        paths = get_paths()
+
+    service_file = paths['service']
+    if not service_file.exists():
+        return
+    _systemctl('disable', '--now', SERVICE_NAME)
+    service_file.unlink()
+    _systemctl('daemon-reload')
+
+
+def _systemctl(*args):
+    subprocess.check_call(('systemctl',) + args)
@@ -0,0 +1,179 @@
+"""Sign repository files through a long-running agent, or in batch.
+
+The agent listens on a Unix socket, and signs files on behalf of clients,
+keeping the signing key ready between requests. Requests and responses are
+JSON objects, sent as a single line.
+
+Alternatively, signing requests can be deferred to a spool file, so that
+they can be processed in batch once reprepro is done exporting.
+"""
+
+import json
+import os
+from pathlib import Path
+import socket
+import socketserver
+import threading
+
+# Maximum time, in seconds, clients wait for a signature.
+CLIENT_TIMEOUT = 120
+
+# Environment variable with the path of the spool file for deferred signing.
+SPOOL_ENV = 'ARCHIVE_AUTH_MIRROR_SIGN_SPOOL'
+
+
+class AgentUnavailable(Exception):
+    """The signing agent can't be reached."""
+
+
+class SigningError(Exception):
+    """The signing agent failed to sign a file."""
+
+
+class SigningAgent:
+    """Sign files requested by clients connecting to a Unix socket.
+
+    The sign callable is called with the unsigned, inline-signed and
+    detached signature file paths for each request. Requests are served one
+    at a time in a background thread while the agent is running.
+    """
+
+    def __init__(self, socket_path, sign, logger):
+        self.socket_path = socket_path
+        self._sign = sign
+        self._logger = logger
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """Start serving requests."""
+        if self.socket_path.exists():
+            # A stale socket from an agent which didn't exit cleanly.
+            self.socket_path.unlink()
+        # The socket must only be accessible by the user running the agent.
+        umask = os.umask(0o177)
+        try:
+            self._server = _Server(str(self.socket_path), _Handler)
+        finally:
+            os.umask(umask)
+        self._server.agent = self
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={'poll_interval': 0.1})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop serving requests and remove the socket."""
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = self._thread = None
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+
+    def handle(self, request):
+        """Handle a request, returning the response."""
+        try:
+            self._sign(*(
+                _to_path(request.get(key))
+                for key in ('unsigned', 'inline', 'detach')))
+        except Exception as error:
+            self._logger.error('signing {} failed: {}'.format(
+                request.get('unsigned'), error))
+            return {'success': False, 'error': str(error)}
+        return {'success': True}
+
+
+def request_signature(socket_path, unsigned_file, inline_sign_file,
+                      detach_sign_file, timeout=CLIENT_TIMEOUT):
+    """Ask the agent listening on socket_path to sign a file.
+
+    AgentUnavailable is raised if the agent isn't running. SigningError is
+    raised if signing fails.
+    """
+    request = {
+        'unsigned': str(unsigned_file),
+        'inline': str(inline_sign_file) if inline_sign_file else None,
+        'detach': str(detach_sign_file) if detach_sign_file else None}
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with sock:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(str(socket_path))
+        except OSError as error:
+            raise AgentUnavailable(str(error))
+        sock.sendall(json.dumps(request).encode('utf8') + b'\n')
+        with sock.makefile('rb') as fh:
+            line = fh.readline()
+    if not line:
+        raise SigningError('no response from the signing agent')
+    response = json.loads(line.decode('utf8'))
+    if not response['success']:
+        raise SigningError(response['error'])
+
+
+def spool_request(spool_path, unsigned_file, inline_sign_file,
+                  detach_sign_file):
+    """Save a signing request to the spool file, to process it later.
+
+    Empty signature files are created, as reprepro expects them to exist.
+    """
+    request = [
+        str(path) if path else None
+        for path in (unsigned_file, inline_sign_file, detach_sign_file)]
+    with spool_path.open('a') as fh:
+        fh.write(json.dumps(request) + '\n')
+    for path in (inline_sign_file, detach_sign_file):
+        if path:
+            path.touch()
+
+
+def read_spool(spool_path):
+    """Return signing requests from the spool file.
+
+    Requests are returned as (unsigned_file, inline_sign_file,
+    detach_sign_file) tuples. Since reprepro renames files with a ".new"
+    suffix when it completes an export, paths are updated accordingly.
+    """
+    if not spool_path.exists():
+        return []
+    with spool_path.open() as fh:
+        return [
+            tuple(_resolve_new(_to_path(value)) for value in json.loads(line))
+            for line in fh if line.strip()]
+
+
+class _Server(socketserver.UnixStreamServer):
+
+    agent = None
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        response = self.server.agent.handle(json.loads(line.decode('utf8')))
+        self.wfile.write(json.dumps(response).encode('utf8') + b'\n')
+
+
+def _resolve_new(path):
+    """Return the final name for a file with a ".new" suffix, if renamed."""
+    if path is None or path.suffix != '.new' or path.exists():
+        return path
+    return path.with_suffix('')
+
+
+def _to_path(value):
+    """Return a Path for the given string, or None."""
+    return Path(value) if value else None
@@ -0,0 +1,140 @@
+"""Sorted on-disk index of keys, for fast lookups in large files.
+
+The index holds keys sorted by their UTF-8 encoding, one per line, after a
+header line with the version stamp of the indexed file and the number of
+keys. Lookups use binary search on the memory-mapped index, and they fail
+if the stamp doesn't match the current version of the indexed file.
+"""
+
+from contextlib import contextmanager
+import mmap
+import os
+
+
+def get_stamp(path):
+    """Return the version stamp of a file, or None if it doesn't exist."""
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def write_index(index_path, keys, stamp, indexed_path=None):
+    """Write the sorted index for keys, atomically.
+
+    The index holds the same data as the indexed file, so it gets the same
+    ownership and permissions if indexed_path is passed. Otherwise, it's
+    only readable by the owner.
+    """
+    keys = sorted(set(key.encode('utf8') for key in keys))
+    header = '# {} {}\n'.format(' '.join(str(value) for value in stamp),
+                                len(keys))
+    tmp_path = index_path.with_name('.' + index_path.name + '.tmp')
+    fd = os.open(
+        str(tmp_path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, 'wb') as fh:
+        fh.write(header.encode('ascii'))
+        fh.writelines(key + b'\n' for key in keys)
+    if indexed_path is not None and indexed_path.exists():
+        stat = indexed_path.stat()
+        os.chown(str(tmp_path), stat.st_uid, stat.st_gid)
+        os.chmod(str(tmp_path), stat.st_mode & 0o7777)
+    os.replace(str(tmp_path), str(index_path))
+
+
+def index_count(index_path, stamp):
+    """Return the number of keys, or None if the index is not usable."""
+    with _open_index(index_path, stamp) as index:
+        if index is None:
+            return None
+        return index[2]
+
+
+def index_contains(index_path, key, stamp):
+    """Return whether key is in the index.
+
+    None is returned if the index is not usable.
+    """
+    with _open_index(index_path, stamp) as index:
+        if index is None:
+            return None
+        data, lo, _ = index
+        return _search(data, lo, key.encode('utf8'))
+
+
+def index_prefix(index_path, prefix, stamp):
+    """Return the sorted list of keys starting with prefix.
+
+    None is returned if the index is not usable.
+    """
+    with _open_index(index_path, stamp) as index:
+        if index is None:
+            return None
+        data, lo, _ = index
+        prefix = prefix.encode('utf8')
+        keys = []
+        start = _lower_bound(data, lo, prefix)
+        while start < len(data):
+            end = data.find(b'\n', start)
+            key = data[start:end]
+            if not key.startswith(prefix):
+                break
+            keys.append(key.decode('utf8'))
+            start = end + 1
+        return keys
+
+
+@contextmanager
+def _open_index(index_path, stamp):
+    """Yield (data, keys offset, keys count) for the index.
+
+    None is yielded if the index doesn't exist, or if it's for a different
+    version of the indexed file.
+    """
+    try:
+        fh = index_path.open('rb')
+    except FileNotFoundError:
+        yield None
+        return
+    with fh:
+        fields = fh.readline().split()
+        try:
+            index_stamp = tuple(int(value) for value in fields[1:-1])
+            count = int(fields[-1])
+        except (IndexError, ValueError):
+            index_stamp = None
+        if stamp is None or fields[:1] != [b'#'] or index_stamp != stamp:
+            yield None
+            return
+        data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield data, fh.tell(), count
+        finally:
+            data.close()
+
+
+def _search(data, lo, key):
+    """Binary search key among lines of data, starting at offset lo."""
+    start = _lower_bound(data, lo, key)
+    return start < len(data) and data[start:data.find(b'\n', start)] == key
+
+
+def _lower_bound(data, lo, key):
+    """Return the offset of the first line of data not lower than key.
+
+    Lines are searched starting at offset lo. The length of data is returned
+    if all lines are lower than key.
+    """
+    hi = len(data)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        # Look at the line containing mid. Both lo and hi are line starts.
+        newline = data.rfind(b'\n', lo, mid)
+        start = lo if newline < 0 else newline + 1
+        end = data.find(b'\n', start, hi)
+        if data[start:end] < key:
+            lo = end + 1
+        else:
+            hi = start
+    return lo
@@ -1,7 +1,19 @@
 """Helper functions to deal with ssh."""
 
+from collections import OrderedDict
 import subprocess
 
+from .utils import write_atomic
+
+# Markers for the block of keys managed by the charm in authorized_keys.
+AUTHORIZED_KEYS_BEGIN = '# BEGIN archive-auth-mirror peers'
+AUTHORIZED_KEYS_END = '# END archive-auth-mirror peers'
+
+# How long idle master connections are kept. Masters which are not closed,
+# because the process which opened them was killed or the peer unit went
+# away, exit after this time.
+CONTROL_PERSIST = '10m'
+
 
 def create_key(path):
     """Use ssh-keygen to create a new ssh key."""
@@ -11,15 +23,138 @@ def create_key(path):
 
 def add_authorized_key(public_key, authorized_keys_path):
     """Add the public key to the specified authorized_keys file."""
+    update_authorized_keys(authorized_keys_path, add=[public_key])
+
+
+def update_authorized_keys(authorized_keys_path, add=(), remove=()):
+    """Add and remove public keys in the authorized_keys file.
+
+    Keys are kept in a block delimited by marker comments, and the rest of
+    the file is left untouched, except that removed keys are dropped also
+    from outside the block. Added keys found outside the block are moved
+    into it. The file is rewritten atomically, only if it changes.
+
+    Return whether the file changed.
+    """
     ssh_dir = authorized_keys_path.parent
     if not ssh_dir.exists():
         ssh_dir.mkdir(0o700)
     if authorized_keys_path.exists():
-        authorized_keys = authorized_keys_path.read_text().splitlines()
+        content = authorized_keys_path.read_text()
     else:
-        authorized_keys = []
-    public_key = public_key.strip()
-    if public_key in authorized_keys:
-        return
-    with authorized_keys_path.open('a') as authorized_keys_file:
-        authorized_keys_file.write(public_key + '\n')
+        content = ''
+    before, managed, after = _split_authorized_keys(content.splitlines())
+    add = [key.strip() for key in add]
+    remove = set(key.strip() for key in remove)
+    # Use an OrderedDict as an ordered set of keys.
+    keys = OrderedDict.fromkeys(managed)
+    keys.update(OrderedDict.fromkeys(add))
+    for key in remove:
+        keys.pop(key, None)
+    outside = remove.union(keys)
+    before = [line for line in before if line.strip() not in outside]
+    after = [line for line in after if line.strip() not in outside]
+    lines = before
+    if keys:
+        lines += [AUTHORIZED_KEYS_BEGIN] + list(keys) + [AUTHORIZED_KEYS_END]
+    lines += after
+    new_content = ''.join(line + '\n' for line in lines)
+    if new_content == content:
+        return False
+    write_atomic(authorized_keys_path, new_content, mode=0o600)
+    return True
+
+
+def _split_authorized_keys(lines):
+    """Split authorized_keys lines in before, managed and after the block."""
+    try:
+        begin = lines.index(AUTHORIZED_KEYS_BEGIN)
+        end = lines.index(AUTHORIZED_KEYS_END, begin)
+    except ValueError:
+        return lines, [], []
+    return lines[:begin], lines[begin + 1:end], lines[end + 1:]
+
+
+class ConnectionPool:
+    """Persistent multiplexed ssh connections to a set of hosts.
+
+    A master connection is opened to each host, and the ssh command returned
+    by rsh reuses it through its control socket. If a master connection isn't
+    available for a host, ssh falls back to connecting directly.
+    """
+
+    def __init__(self, key_path, control_dir, binary='/usr/bin/ssh'):
+        self._key_path = key_path
+        self._control_dir = control_dir
+        self._binary = binary
+        self._hosts = []
+
+    @property
+    def rsh(self):
+        """The ssh command to use as rsync remote shell."""
+        return ' '.join(self._get_command())
+
+    def open(self, hosts, logger):
+        """Open a master connection to each of the given hosts.
+
+        Hosts with a live master connection are skipped, so that connections
+        can be kept across runs, or shared with other processes. Failures are
+        logged via the provided logger, and the next host is attempted.
+
+        Return a list of hosts which couldn't be connected.
+        """
+        failed = []
+        if not self._control_dir.exists():
+            self._control_dir.mkdir(0o700)
+        for host in hosts:
+            if self._check(host):
+                continue
+            if host in self._hosts:
+                self._hosts.remove(host)
+            # With ControlMaster=auto, ssh removes a stale control socket
+            # left by a dead master before listening on it. With "yes" it
+            # would run in background without a control socket instead.
+            command = self._get_command(
+                '-o', 'ControlMaster=auto',
+                '-o', 'ControlPersist={}'.format(CONTROL_PERSIST),
+                '-o', 'ConnectTimeout=10', '-f', '-N', host)
+            # The master connection runs in background once established, so
+            # its output must not be captured, or the call would not return.
+            return_code = subprocess.call(
+                command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+            if return_code:
+                logger.warning(
+                    'cannot open ssh master connection to {}'.format(host))
+                failed.append(host)
+                continue
+            self._hosts.append(host)
+        return failed
+
+    def close(self):
+        """Close all master connections."""
+        for host in self._hosts:
+            subprocess.call(
+                self._get_command('-O', 'exit', host),
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+        self._hosts = []
+
+    def _check(self, host):
+        """Return whether the master connection to host is alive."""
+        return_code = subprocess.call(
+            self._get_command('-O', 'check', host),
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        return return_code == 0
+
+    def _get_command(self, *args):
+        # Using StrictHostKeyChecking=no isn't ideal, but we don't yet
+        # popolate known_hosts with the right keys. But we trust the
+        # network, and we don't push any sensitive data.
+        command = [
+            self._binary, '-o', 'StrictHostKeyChecking=no',
+            '-i', str(self._key_path),
+            '-o', 'ControlPath={}/%C'.format(self._control_dir)]
+        command.extend(args)
+        return command
@@ -1,8 +1,13 @@
 """Miscellaneous helper functions."""
 
+from contextlib import contextmanager
+import copy
+import json
+import os
 from pathlib import Path
 
-import yaml
+# Format of the config snapshot. Snapshots in a different format are ignored.
+SNAPSHOT_FORMAT = 1
 
 
 def get_paths(root_dir=None):
@@ -12,16 +17,29 @@ def get_paths(root_dir=None):
 
     /srv/archive-auth-mirror
     ├── basic-auth -- the file containing BasicAuth username/passwords
+    ├── basic-auth.index -- sorted index of users, for large basic-auth files
     ├── bin
     │   └── mirror-archive  -- the mirroring script
+    ├── config.json  -- snapshot of config.yaml, for fast loading
     ├── config.yaml  -- the script configuration file
+    ├── dists-generations  -- generations of the dists directory, the one
+    │                         published is linked from static/ubuntu/dists
+    ├── generation.json  -- repository generation, for units in pull mode
+    ├── metrics.json  -- metrics for the last mirroring run
+    ├── metrics.prom  -- the same metrics, in Prometheus textfile format
     ├── mirror-archive.lock  -- lockfile for the mirror-archive script
+    ├── peer-health.json  -- peer units which failed to sync, and when to retry
+    ├── release-fingerprints.json  -- upstream releases as of the last run
     ├── reprepro
     │   └── conf  -- reprepro configuration files
     │       └── .gnupg  -- GPG config for reprepro
+    ├── sign-agent.sock  -- socket for the signing agent, while mirroring
     ├── sign-passphrase  -- contains the passphrase for the GPG sign key
+    ├── snapshots  -- snapshots of the repository, when changes are staged
+    ├── ssh-control  -- control sockets for ssh master connections
     ├── ssh-key  -- the ssh key used by rsync
-    └── static  -- the root of the virtualhost, contains the repository
+    ├── static  -- the root of the virtualhost, contains the repository
+    └── synced-peers  -- peer units in sync after the last mirroring run
     """
     if root_dir is None:
         root_dir = Path('/')
@@ -30,14 +48,26 @@ def get_paths(root_dir=None):
     return {
         'base': base_dir,
         'cron': root_dir / 'etc/cron.d/archive-auth-mirror',
+        'service': (
+            root_dir / 'etc/systemd/system/archive-auth-mirror.service'),
         'bin': base_dir / 'bin',
         'config': base_dir / 'config.yaml',
         'static': base_dir / 'static',
+        'dists-generations': base_dir / 'dists-generations',
+        'snapshots': base_dir / 'snapshots',
         'basic-auth': base_dir / 'basic-auth',
         'sign-passphrase': base_dir / 'sign-passphrase',
+        'sign-agent-socket': base_dir / 'sign-agent.sock',
         'ssh-key': base_dir / 'ssh-key',
+        'ssh-control': base_dir / 'ssh-control',
+        'synced-peers': base_dir / 'synced-peers',
+        'generation': base_dir / 'generation.json',
+        'peer-health': base_dir / 'peer-health.json',
         'authorized-keys': root_dir / 'root' / '.ssh' / 'authorized_keys',
         'lockfile': base_dir / 'mirror-archive.lock',
+        'metrics': base_dir / 'metrics.json',
+        'metrics-textfile': base_dir / 'metrics.prom',
+        'release-fingerprints': base_dir / 'release-fingerprints.json',
         'reprepro': reprepro_dir,
         'reprepro-conf': reprepro_dir / 'conf',
         'gnupghome': reprepro_dir / '.gnupg'}
@@ -45,28 +75,191 @@ def get_paths(root_dir=None):
 
 def get_config(config_path=None):
     """Return a dict with the service configuration."""
-    if config_path is None:
-        config_path = get_paths()['config']
-    if not config_path.exists():
-        return {}
-    with config_path.open() as fh:
-        return yaml.load(fh)
+    return ConfigStore(path=config_path).load()
 
 
 def update_config(
-        config_path=None, suites=(), sign_key_id=None, new_ssh_peers=None,
-        packages_require_auth=None):
-    """Update the config with the given parameters."""
-    config = get_config(config_path=config_path)
-    if suites:
-        config['suites'] = suites
-    if sign_key_id is not None:
-        config['sign-key-id'] = sign_key_id
-    if new_ssh_peers is not None:
-        ssh_peers = config.get('ssh-peers', {})
-        ssh_peers.update(new_ssh_peers)
-        config['ssh-peers'] = ssh_peers
-    if packages_require_auth is not None:
-        config['packages-require-auth'] = packages_require_auth
-    with config_path.open('w') as config_file:
-        yaml.dump(config, config_file)
+        config_path=None, suites=(), upstreams=None, sign_key_id=None,
+        new_ssh_peers=None, removed_ssh_peers=None,
+        packages_require_auth=None, sync_concurrency=None,
+        daemon_min_interval=None, daemon_max_interval=None,
+        sign_concurrency=None, replication_mode=None, pull_fanout=None,
+        leader_address=None, unit_address=None, dists_generations=None,
+        snapshot_staging=None):
+    """Update the config with the given parameters.
+
+    The file is only written if the config changes. If a transaction is in
+    progress for the config file, changes are written when it completes.
+    Return whether the config changed.
+    """
+    with ConfigStore(path=config_path).transaction() as config:
+        original = copy.deepcopy(config)
+        if suites:
+            config['suites'] = suites
+        if upstreams is not None:
+            config['upstreams'] = upstreams
+        if sign_key_id is not None:
+            config['sign-key-id'] = sign_key_id
+        if new_ssh_peers is not None:
+            ssh_peers = config.get('ssh-peers', {})
+            ssh_peers.update(new_ssh_peers)
+            config['ssh-peers'] = ssh_peers
+        if removed_ssh_peers:
+            ssh_peers = config.get('ssh-peers', {})
+            for peer in removed_ssh_peers:
+                ssh_peers.pop(peer, None)
+            config['ssh-peers'] = ssh_peers
+        if packages_require_auth is not None:
+            config['packages-require-auth'] = packages_require_auth
+        if sync_concurrency is not None:
+            config['sync-concurrency'] = sync_concurrency
+        if sign_concurrency is not None:
+            config['sign-concurrency'] = sign_concurrency
+        if daemon_min_interval is not None:
+            config['daemon-min-interval'] = daemon_min_interval
+        if daemon_max_interval is not None:
+            config['daemon-max-interval'] = daemon_max_interval
+        if replication_mode is not None:
+            config['replication-mode'] = replication_mode
+        if pull_fanout is not None:
+            config['pull-fanout'] = pull_fanout
+        if leader_address is not None:
+            config['leader-address'] = leader_address
+        if unit_address is not None:
+            config['unit-address'] = unit_address
+        if dists_generations is not None:
+            config['dists-generations'] = dists_generations
+        if snapshot_staging is not None:
+            config['snapshot-staging'] = snapshot_staging
+        return config != original
+
+
+class ConfigStore:
+    """Read and update the service configuration file.
+
+    Reads are cached for the process until the file changes on disk. Updates
+    are made in transactions, each resulting in a single atomic write.
+
+    Along with the YAML file, a JSON snapshot of the config is written, so
+    that scripts can load it without importing and running the YAML parser.
+    The snapshot is stamped with the version of the YAML file it was
+    generated from, and it's ignored if the YAML file is modified otherwise.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = get_paths()['config']
+        self.path = path
+        self.snapshot_path = path.with_suffix('.json')
+
+    def load(self):
+        """Return a dict with the configuration.
+
+        If a transaction is in progress, its pending changes are included.
+        """
+        key = str(self.path)
+        pending = _transactions.get(key)
+        if pending is not None:
+            return copy.deepcopy(pending)
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            _configs.pop(key, None)
+            return {}
+        version = _get_version(stat)
+        cached = _configs.get(key)
+        if cached is None or cached[0] != version:
+            config = self._load_snapshot(version)
+            if config is None:
+                config = self._load_yaml()
+            cached = _configs[key] = (version, config)
+        return copy.deepcopy(cached[1])
+
+    @contextmanager
+    def transaction(self):
+        """Return a context manager yielding the config to be modified.
+
+        Changes are written when the outermost transaction for the file
+        completes without errors, and only if the config changed.
+        Transactions can be nested.
+        """
+        key = str(self.path)
+        pending = _transactions.get(key)
+        if pending is not None:
+            yield pending
+            return
+        original = self.load()
+        config = _transactions[key] = copy.deepcopy(original)
+        try:
+            yield config
+        finally:
+            del _transactions[key]
+        if (config != original or not self.path.exists() or
+                self._load_snapshot(_get_version(self.path.stat())) is None):
+            self._write(config)
+
+    def _load_yaml(self):
+        """Parse the YAML config file."""
+        import yaml
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+        with self.path.open() as fh:
+            return yaml.load(fh, Loader=loader) or {}
+
+    def _load_snapshot(self, version):
+        """Return the config from the snapshot.
+
+        None is returned if the snapshot doesn't exist, or if it wasn't
+        generated from the given version of the YAML file.
+        """
+        try:
+            with self.snapshot_path.open() as fh:
+                snapshot = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        if (not isinstance(snapshot, dict) or
+                snapshot.get('format') != SNAPSHOT_FORMAT or
+                snapshot.get('version') != list(version)):
+            return None
+        return snapshot.get('config')
+
+    def _write(self, config):
+        """Write the YAML config file and its snapshot."""
+        import yaml
+        dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+        write_atomic(
+            self.path,
+            yaml.dump(config, Dumper=dumper, default_flow_style=False))
+        version = _get_version(self.path.stat())
+        write_atomic(self.snapshot_path, json.dumps({
+            'format': SNAPSHOT_FORMAT, 'version': list(version),
+            'config': config}))
+        _configs[str(self.path)] = (version, copy.deepcopy(config))
+
+
+def write_atomic(path, content, mode=None):
+    """Write text content to path, replacing it atomically.
+
+    Readers see either the previous content or the new one, never a partially
+    written file. If mode is specified, it's set as the file permissions.
+    """
+    tmp_path = path.with_name('.' + path.name + '.tmp')
+    if mode is None:
+        tmp_path.write_text(content)
+    else:
+        fd = os.open(
+            str(tmp_path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        with open(fd, 'w') as fh:
+            os.fchmod(fh.fileno(), mode)
+            fh.write(content)
+    os.replace(str(tmp_path), str(path))
+
+
+def _get_version(stat):
+    """Return a tuple identifying a version of a file, from its stat."""
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+# Cached configs as (file version, config) tuples, keyed by path.
+_configs = {}
+# Configs modified by transactions in progress, keyed by path.
+_transactions = {}
@@ -1,7 +1,10 @@
 """Repository configuration functions."""
 
 import getpass
+import hashlib
+from pathlib import Path
 
+from charmhelpers.core import hookenv
 from charmhelpers.core.templating import render
 
 from archive_auth_mirror.utils import (
@@ -13,30 +16,64 @@ from archive_auth_mirror.utils import (
 def configure_reprepro(mirrors, sign_key_fingerprint, sign_key_passphrase):
     """Create reprepro configuration files.
 
-    The provided mirrors is a sequence of mirror.Mirror named tuples.
+    The provided mirrors is a sequence of mirror.Mirror named tuples. Files
+    are only written if their content changes, so that reprepro doesn't see
+    its configuration as modified. Return whether any file was written.
     """
     paths = get_paths()
     # Explicitly pass owner and group for tests, otherwise root would be used.
     owner = group = getpass.getuser()
     # Render distributions file.
-    target = str(paths['reprepro-conf'] / 'distributions')
+    target = paths['reprepro-conf'] / 'distributions'
     context = {
         'mirrors': mirrors,
         'sign_script': paths['bin'] / 'reprepro-sign-helper',
     }
-    render(_DISTRIBUTIONS, target, context, owner=owner, group=group)
+    changed = _render(_DISTRIBUTIONS, target, context, owner, group)
     # Render updates file.
-    target = str(paths['reprepro-conf'] / 'updates')
+    target = paths['reprepro-conf'] / 'updates'
     context = {'mirrors': mirrors}
-    render(_UPDATES, target, context, owner=owner, group=group)
+    changed = _render(_UPDATES, target, context, owner, group) or changed
     # Update configuration.
-    update_config(
+    changed = update_config(
         config_path=paths['config'],
         suites=[mirror.local_suite for mirror in mirrors],
-        sign_key_id=sign_key_fingerprint)
+        upstreams={
+            mirror.local_suite: {
+                'url': mirror.url, 'suite': mirror.remote_suite}
+            for mirror in mirrors},
+        sign_key_id=sign_key_fingerprint) or changed
     # Save the sign passphrase for the signing helper script.
-    with paths['sign-passphrase'].open('w') as fh:
-        fh.write(sign_key_passphrase)
+    passphrase_path = paths['sign-passphrase']
+    if (not passphrase_path.exists() or
+            passphrase_path.read_text() != sign_key_passphrase):
+        with passphrase_path.open('w') as fh:
+            fh.write(sign_key_passphrase)
+        changed = True
+    return changed
+
+
+def get_render_inputs(templates_dir=None):
+    """Return what reprepro files depend on, besides the charm options.
+
+    This includes digests of the templates and the paths rendered in files,
+    so that files are generated again when a charm upgrade changes them.
+    """
+    if templates_dir is None:
+        templates_dir = Path(hookenv.charm_dir()) / 'templates'
+    paths = get_paths()
+    templates = {}
+    for name in (_DISTRIBUTIONS, _UPDATES):
+        path = templates_dir / name
+        templates[name] = (
+            hashlib.sha256(path.read_bytes()).hexdigest()
+            if path.exists() else None)
+    return {
+        'templates': templates,
+        'paths': {
+            name: str(paths[name])
+            for name in ('bin', 'config', 'reprepro-conf', 'sign-passphrase')},
+    }
 
 
 def disable_mirroring(get_paths=get_paths):
@@ -46,5 +83,17 @@ def disable_mirroring(get_paths=get_paths):
         config.replace(config.with_suffix('.disabled'))
 
 
+def _render(source, target, context, owner, group):
+    """Render a template to target, only if its content changes.
+
+    Return whether the file was written.
+    """
+    content = render(source, None, context)
+    if target.exists() and target.read_text() == content:
+        return False
+    render(source, str(target), context, owner=owner, group=group)
+    return True
+
+
 _DISTRIBUTIONS = 'reprepro-distributions.j2'
 _UPDATES = 'reprepro-updates.j2'
@@ -1,5 +1,6 @@
 """Service installation and configuration functions."""
 
+import compileall
 from pathlib import Path
 
 from charmhelpers.core import hookenv, host
@@ -9,7 +10,12 @@ from archive_auth_mirror.utils import get_paths
 
 
 REQUIRED_OPTIONS = frozenset(['mirrors', 'repository-origin', 'sign-gpg-key'])
-SCRIPTS = ('mirror-archive', 'manage-user', 'reprepro-sign-helper')
+SCRIPTS = (
+    'mirror-archive', 'manage-user', 'reprepro-sign-helper', 'pull-archive')
+# Scripts started often enough for startup time to matter. They're run
+# without the site module, which they load only if they need packages from
+# the virtualenv.
+NO_SITE_SCRIPTS = frozenset(['reprepro-sign-helper'])
 
 
 def get_virtualhost_name(hookenv=hookenv):
@@ -55,14 +61,18 @@ def install_resources(root_dir=None):
     for script in SCRIPTS:
         create_script_file(script, paths['bin'])
     # symlink the lib libary to make it available to scripts too
-    (paths['bin'] / 'lib').symlink_to(Path.cwd() / 'lib')
+    lib_dir = Path.cwd() / 'lib'
+    (paths['bin'] / 'lib').symlink_to(lib_dir)
+    # precompile modules, so that scripts don't do it on their first run
+    compileall.compile_dir(str(lib_dir), quiet=1)
 
 
 def create_script_file(name, bindir):
     """Write a python script file from the template."""
     context = {
         'interpreter': Path.cwd().parent / '.venv/bin/python3',
-        'script_module': name.replace('-', '_')}
+        'script_module': name.replace('-', '_'),
+        'no_site': name in NO_SITE_SCRIPTS}
     render('script.j2', str(bindir / name), context, perms=0o755)
 
 
@@ -2,13 +2,16 @@
 
 from charmhelpers.core import hookenv
 from charms.layer.nginx import configure_site
+from charms.leadership import leader_get, leader_set
 from charms.reactive import (
     clear_flag,
     only_once,
     set_flag,
     when,
+    when_any,
     when_not,
 )
+from charms.reactive.helpers import data_changed
 
 from charms.archive_auth_mirror import (
     repository,
@@ -18,6 +21,8 @@ from archive_auth_mirror import (
     cron,
     gpg,
     mirror,
+    replication,
+    service,
     ssh,
     utils,
 )
@@ -31,6 +36,14 @@ NGINX_OPTIONS = (
     'resource-name',
 )
 
+# Define options requiring a reprepro reconfiguration.
+REPREPRO_OPTIONS = (
+    'mirrors',
+    'repository-origin',
+    'sign-gpg-key',
+    'sign-gpg-passphrase',
+)
+
 
 def charm_flag(flag):
     """Return a reactive flag name for this charm."""
@@ -90,15 +103,39 @@ def set_ssh_key(ssh_keys):
 @when('ssh-peers.new-remote-public-key')
 def add_authorized_key(ssh_keys):
     remote_public_key = ssh_keys.get_remote('public-ssh-key')
+    address = ssh_keys.get_remote('private-address')
+    paths = utils.get_paths()
     hookenv.log("Adding key: " + remote_public_key)
-    ssh.add_authorized_key(
-        remote_public_key, utils.get_paths()['authorized-keys'])
-    ssh_peer = {ssh_keys.get_remote('private-address'): remote_public_key}
+    # Drop the previous key for the peer, if it changed.
+    previous_key = utils.get_config(
+        config_path=paths['config']).get('ssh-peers', {}).get(address)
+    remove = []
+    if previous_key and previous_key.strip() != remote_public_key.strip():
+        remove.append(previous_key)
+    ssh.update_authorized_keys(
+        paths['authorized-keys'], add=[remote_public_key], remove=remove)
     utils.update_config(
-        config_path=utils.get_paths()['config'], new_ssh_peers=ssh_peer)
+        config_path=paths['config'],
+        new_ssh_peers={address: remote_public_key})
     ssh_keys.remove_state(ssh_keys.states.new_remote_public_key)
 
 
+@when('ssh-peers.departed')
+def remove_authorized_key(ssh_keys):
+    address, public_key = ssh_keys.get_departed_peer()
+    paths = utils.get_paths()
+    config_path = paths['config']
+    if not public_key:
+        public_key = utils.get_config(
+            config_path=config_path).get('ssh-peers', {}).get(address)
+    if public_key:
+        hookenv.log("Removing key for departed peer " + address)
+        ssh.update_authorized_keys(
+            paths['authorized-keys'], remove=[public_key])
+    utils.update_config(config_path=config_path, removed_ssh_peers=[address])
+    ssh_keys.remove_state(ssh_keys.states.departed)
+
+
 @when(charm_flag('static-serve.configured'), 'config.changed')
 @when('basic-auth-check.available')
 def config_changed_basic_auth(basic_auth_check):
@@ -137,21 +174,40 @@ def config_set():
             '{}'.format(', '.join(missing_options)))
         return
 
-    # Configure mirroring.
-    keyring = gpg.KeyRing()
-    mirrors = mirror.from_config(
-        keyring, config['mirrors'], config['repository-origin'].strip())
-    sign_key_fingerprint = keyring.import_key(config['sign-gpg-key'])
-    sign_key_passphrase = config.get('sign-gpg-passphrase', '').strip()
-    repository.configure_reprepro(
-        mirrors, sign_key_fingerprint, sign_key_passphrase)
-    # Export the public key used to sign the repository.
-    _export_sign_key(sign_key_fingerprint)
+    config_path = utils.get_paths()['config']
+    # Batch all changes to the scripts config in a single write.
+    with utils.ConfigStore(path=config_path).transaction():
+        # Configure mirroring, only if related options, templates or paths
+        # changed since the last time, or generated files are missing.
+        reprepro_config = {
+            option: config.get(option) for option in REPREPRO_OPTIONS}
+        reprepro_config.update(repository.get_render_inputs())
+        if (data_changed(charm_flag('reprepro-config'), reprepro_config) or
+                not _reprepro_configured()):
+            keyring = gpg.KeyRing()
+            mirrors = mirror.from_config(
+                keyring, config['mirrors'],
+                config['repository-origin'].strip())
+            sign_key = keyring.import_key_fingerprint(config['sign-gpg-key'])
+            sign_key_passphrase = config.get(
+                'sign-gpg-passphrase', '').strip()
+            repository.configure_reprepro(
+                mirrors, sign_key.short, sign_key_passphrase)
+            # Export the public key used to sign the repository.
+            _export_sign_key(sign_key.full)
+        # Update scripts config.
+        utils.update_config(
+            config_path=config_path,
+            packages_require_auth=config['packages-require-auth'],
+            sync_concurrency=config['sync-concurrency'],
+            sign_concurrency=config['sign-concurrency'],
+            daemon_min_interval=config['daemon-min-interval'],
+            daemon_max_interval=config['daemon-max-interval'],
+            replication_mode=config['replication-mode'],
+            pull_fanout=config['pull-fanout'],
+            dists_generations=config['dists-generations'],
+            snapshot_staging=config['snapshot-staging'])
     hookenv.status_set('active', 'Mirroring configured')
-    # Update scripts config.
-    utils.update_config(
-        config_path=utils.get_paths()['config'],
-        packages_require_auth=config['packages-require-auth'])
 
 
 @when_not('config.set.mirrors', 'config.set.sign-gpg-key')
@@ -163,16 +219,75 @@ def config_not_set():
 
 @when_not(charm_flag('job.enabled'))
 @when('leadership.is_leader')
-def install_cron():
-    cron.install_crontab()
+def install_job():
+    _install_job()
     set_flag(charm_flag('job.enabled'))
 
 
+@when(charm_flag('job.enabled'), 'config.changed.daemon-mode')
+@when('leadership.is_leader')
+def switch_job():
+    _install_job()
+
+
 @when_not('leadership.is_leader')
 @when(charm_flag('job.enabled'))
-def remove_cron():
+def remove_job():
     cron.remove_crontab()
+    service.remove_service()
+    # The new leader tracks which peers are in sync on its own. Forget about
+    # them, so that a full sync is performed if this unit is elected again.
+    synced_peers = utils.get_paths()['synced-peers']
+    if synced_peers.exists():
+        synced_peers.unlink()
     clear_flag(charm_flag('job.enabled'))
+    clear_flag(charm_flag('pull-job.configured'))
+
+
+@when('leadership.is_leader')
+def publish_leader_address():
+    address = hookenv.unit_private_ip()
+    if leader_get('leader-address') != address:
+        leader_set({'leader-address': address})
+
+
+@when(charm_flag('installed'), 'leadership.set.leader-address')
+def update_leader_address():
+    utils.update_config(
+        config_path=utils.get_paths()['config'],
+        leader_address=leader_get('leader-address'),
+        unit_address=hookenv.unit_private_ip())
+
+
+@when(charm_flag('installed'))
+@when_not('leadership.is_leader', charm_flag('job.enabled'),
+          charm_flag('pull-job.configured'))
+def configure_pull_job():
+    """On peer units, pull the repository periodically in pull mode."""
+    if hookenv.config()['replication-mode'] == replication.PULL:
+        # The script is only installed along with the others on new units,
+        # so make sure it's there on units installed before pull mode.
+        setup.create_script_file('pull-archive', utils.get_paths()['bin'])
+        cron.install_pull_crontab()
+    else:
+        cron.remove_crontab()
+    set_flag(charm_flag('pull-job.configured'))
+
+
+@when(charm_flag('pull-job.configured'))
+@when_any('leadership.is_leader', 'config.changed.replication-mode')
+def reset_pull_job():
+    clear_flag(charm_flag('pull-job.configured'))
+
+
+def _install_job():
+    """Run mirroring either as a daemon or through cron, based on config."""
+    if hookenv.config()['daemon-mode']:
+        cron.remove_crontab()
+        service.install_service()
+    else:
+        service.remove_service()
+        cron.install_crontab()
 
 
 def _configure_static_serve(auth_backends=None):
@@ -184,6 +299,16 @@ def _configure_static_serve(auth_backends=None):
     configure_site('archive-auth-mirror', 'nginx-static.j2', **vhost_config)
 
 
+def _reprepro_configured():
+    """Return whether files generated from reprepro options are present."""
+    paths = utils.get_paths()
+    return all(path.exists() for path in (
+        paths['config'],
+        paths['reprepro-conf'] / 'distributions',
+        paths['reprepro-conf'] / 'updates',
+        paths['static'] / 'key.asc'))
+
+
 def _export_sign_key(key_id):
     """Export the public key for the repo under the static serve."""
     filename = utils.get_paths()['static'] / 'key.asc'
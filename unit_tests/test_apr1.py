@@ -0,0 +1,33 @@
+from unittest import TestCase
+
+from archive_auth_mirror.apr1 import check_password, hash_password
+
+
+class HashPasswordTest(TestCase):
+
+    def test_hash(self):
+        """Passwords are hashed in the apr1 format."""
+        self.assertEqual(
+            '$apr1$abcdefgh$CqJPN4ZXn9D0KdSZVMZhu0',
+            hash_password('pässword1', salt='abcdefgh'))
+        self.assertEqual(
+            '$apr1$xy$rBA8z2HJwabth.S1mWkS3.',
+            hash_password(
+                'a-very-long-password-longer-than-16-chars', salt='xy'))
+
+    def test_random_salt(self):
+        """A random salt is used if not specified."""
+        self.assertNotEqual(hash_password('pass'), hash_password('pass'))
+
+
+class CheckPasswordTest(TestCase):
+
+    def test_match(self):
+        """check_password returns whether the password matches."""
+        hashed = hash_password('pass')
+        self.assertTrue(check_password('pass', hashed))
+        self.assertFalse(check_password('other', hashed))
+
+    def test_other_format(self):
+        """Hashes in other formats never match."""
+        self.assertFalse(check_password('pass', '{SHA}abcdef'))
@@ -3,7 +3,11 @@ from pathlib import Path
 from charmtest import CharmTest
 
 from archive_auth_mirror.utils import get_paths
-from archive_auth_mirror.cron import install_crontab, remove_crontab
+from archive_auth_mirror.cron import (
+    install_crontab,
+    install_pull_crontab,
+    remove_crontab,
+)
 
 
 class InstallCrontabTest(CharmTest):
@@ -22,6 +26,22 @@ class InstallCrontabTest(CharmTest):
         self.assertIn(str(script), content)
 
 
+class InstallPullCrontabTest(CharmTest):
+
+    def test_install_pull_crontab(self):
+        """install_pull_crontab creates a crontab file for pulling."""
+        root_dir = Path(self.fakes.fs.root.path)
+        (root_dir / 'etc/cron.d').mkdir(parents=True)
+        paths = get_paths(root_dir=root_dir)
+        install_pull_crontab(paths=paths)
+
+        with paths['cron'].open() as fh:
+            content = fh.read()
+
+        script = paths['bin'] / 'pull-archive'
+        self.assertIn(str(script), content)
+
+
 class RemoveCrontabTest(CharmTest):
 
     def setUp(self):
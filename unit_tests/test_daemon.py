@@ -0,0 +1,136 @@
+import logging
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import unittest
+
+from fixtures import LoggerFixture, TestWithFixtures
+
+from archive_auth_mirror.daemon import (
+    AdaptiveInterval,
+    ConfigWatcher,
+    CycleResult,
+    Daemon,
+)
+
+
+CHANGED = CycleResult(changed=True, success=True)
+IDLE = CycleResult(changed=False, success=True)
+FAILED = CycleResult(changed=True, success=False)
+
+
+class AdaptiveIntervalTest(unittest.TestCase):
+
+    def test_backoff(self):
+        """The delay doubles while no changes are found, up to the max."""
+        interval = AdaptiveInterval(min_interval=10, max_interval=50)
+        self.assertEqual(
+            [10, 20, 40, 50, 50],
+            [interval.next(IDLE) for _ in range(5)])
+
+    def test_reset_on_changes(self):
+        """When changes are found, the delay goes back to the minimum."""
+        interval = AdaptiveInterval(min_interval=10, max_interval=50)
+        interval.next(IDLE)
+        interval.next(IDLE)
+        self.assertEqual(10, interval.next(CHANGED))
+        self.assertEqual(10, interval.next(IDLE))
+        self.assertEqual(20, interval.next(IDLE))
+
+    def test_backoff_on_failure(self):
+        """Failed cycles back off, even if changes were found."""
+        interval = AdaptiveInterval(min_interval=10, max_interval=50)
+        self.assertEqual([10, 20], [interval.next(FAILED) for _ in range(2)])
+
+    def test_set_bounds(self):
+        """Changing bounds clamps the current delay."""
+        interval = AdaptiveInterval(min_interval=10, max_interval=100)
+        for _ in range(4):
+            interval.next(IDLE)
+        interval.set_bounds(5, 30)
+        self.assertEqual(30, interval.next(IDLE))
+
+
+class DaemonTest(TestWithFixtures):
+
+    def setUp(self):
+        super().setUp()
+        self.logger = self.useFixture(LoggerFixture())
+
+    def test_run(self):
+        """Cycles run until the daemon is stopped."""
+        results = []
+
+        def run_cycle():
+            results.append(None)
+            if len(results) == 3:
+                daemon.stop()
+            return IDLE
+
+        daemon = Daemon(
+            run_cycle, logging.getLogger(),
+            interval=AdaptiveInterval(min_interval=0, max_interval=0))
+        daemon.run()
+        self.assertEqual(3, len(results))
+        self.assertIn('mirroring daemon stopped', self.logger.output)
+
+    def test_wakeup(self):
+        """wakeup makes the next cycle start without waiting."""
+        results = []
+
+        def run_cycle():
+            results.append(None)
+            if len(results) == 2:
+                daemon.stop()
+            else:
+                daemon.wakeup()
+            return IDLE
+
+        daemon = Daemon(
+            run_cycle, logging.getLogger(),
+            interval=AdaptiveInterval(min_interval=3600, max_interval=3600))
+        daemon.run()
+        self.assertEqual(2, len(results))
+        self.assertIn('next mirroring run in 3600 seconds', self.logger.output)
+
+
+class ConfigWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+        self.config_path = self.tempdir / 'config.yaml'
+        self.loads = []
+
+        def loader(config_path=None):
+            self.loads.append(config_path)
+            if not config_path.exists():
+                return {}
+            return {'suites': config_path.read_text().split()}
+
+        self.watcher = ConfigWatcher(self.config_path, loader)
+
+    def test_cached(self):
+        """The config is parsed only once if the file doesn't change."""
+        self.config_path.write_text('xenial\n')
+        self.assertEqual({'suites': ['xenial']}, self.watcher.get())
+        self.assertEqual({'suites': ['xenial']}, self.watcher.get())
+        self.assertEqual(1, len(self.loads))
+
+    def test_modified(self):
+        """The config is parsed again when the file changes."""
+        self.config_path.write_text('xenial\n')
+        self.watcher.get()
+        self.config_path.write_text('bionic\n')
+        # Make sure the modification time changes.
+        stat = self.config_path.stat()
+        os.utime(
+            str(self.config_path),
+            ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertEqual({'suites': ['bionic']}, self.watcher.get())
+        self.assertEqual(2, len(self.loads))
+
+    def test_not_existent(self):
+        """If the file doesn't exist, the config is empty."""
+        self.assertEqual({}, self.watcher.get())
@@ -0,0 +1,232 @@
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import tempfile
+from unittest import mock, TestCase
+
+from archive_auth_mirror.dists import (
+    adopt_directory,
+    create_generation,
+    get_incomplete,
+    get_published,
+    prune_generations,
+    publish_generation,
+    switch_link,
+    switch_link_command,
+)
+
+
+class DistsTestCase(TestCase):
+
+    def setUp(self):
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+        self.link = self.tempdir / 'static' / 'dists'
+        self.generations = self.tempdir / 'generations'
+
+    def make_generation(self, name, *suites):
+        """Create a complete generation with the given suites."""
+        path = self.generations / name
+        path.mkdir(parents=True)
+        for suite in suites:
+            (path / suite).mkdir()
+            (path / suite / 'Release').write_text(suite)
+        return path
+
+
+class CreateGenerationTest(DistsTestCase):
+
+    def test_create(self):
+        """Generations are created in the generations directory."""
+        path = create_generation(
+            self.link, self.generations, now=lambda: 1.5e9)
+        self.assertEqual(self.generations / '.new-1500000000000', path)
+        self.assertEqual([], os.listdir(str(path)))
+        # The generation is not published yet.
+        self.assertIsNone(get_published(self.link))
+
+    def test_create_newer(self):
+        """New generations are always newer than existing ones."""
+        self.make_generation('1500000000000')
+        path = create_generation(
+            self.link, self.generations, now=lambda: 1.4e9)
+        self.assertEqual('.new-1500000000001', path.name)
+
+    def test_create_links(self):
+        """Files of suites not excluded are hard-linked."""
+        current = self.make_generation('1234', 'xenial', 'bionic')
+        switch_link(self.link, current)
+        path = create_generation(
+            self.link, self.generations, exclude=['xenial'])
+        self.assertEqual(['bionic'], os.listdir(str(path)))
+        self.assertEqual(
+            (current / 'bionic' / 'Release').stat().st_ino,
+            (path / 'bionic' / 'Release').stat().st_ino)
+
+    def test_create_symlinks(self):
+        """Symlinks are copied as they are."""
+        (self.link / 'pool').mkdir(parents=True)
+        (self.link / 'dists').symlink_to('/generations/1234')
+        path = create_generation(self.link, self.generations)
+        self.assertEqual(
+            '/generations/1234', os.readlink(str(path / 'dists')))
+
+    def test_create_failure(self):
+        """A partial copy is removed, and never taken as a generation."""
+        current = self.make_generation('1234', 'bionic', 'xenial')
+        switch_link(self.link, current)
+        copytree = shutil.copytree
+
+        def fail_copytree(source, *args, **kwargs):
+            if source.endswith('xenial'):
+                raise OSError('Too many links')
+            return copytree(source, *args, **kwargs)
+
+        with mock.patch('shutil.copytree', side_effect=fail_copytree):
+            with self.assertRaises(OSError):
+                create_generation(self.link, self.generations)
+        self.assertEqual(['1234'], os.listdir(str(self.generations)))
+        self.assertIsNone(get_incomplete(self.generations))
+
+    def test_create_interrupted(self):
+        """Copies left over by an interrupted process are not used."""
+        (self.generations / '.copy-5').mkdir(parents=True)
+        self.assertIsNone(get_incomplete(self.generations))
+        path = create_generation(
+            self.link, self.generations, now=lambda: 0)
+        self.assertEqual('.new-1', path.name)
+        self.assertEqual(path, get_incomplete(self.generations))
+
+
+class GetIncompleteTest(DistsTestCase):
+
+    def test_incomplete(self):
+        """The latest incomplete generation is returned."""
+        for name in ('.new-9', '.new-10', '11'):
+            self.make_generation(name)
+        self.assertEqual(
+            self.generations / '.new-10', get_incomplete(self.generations))
+
+    def test_no_incomplete(self):
+        """If all generations are complete, None is returned."""
+        self.make_generation('1')
+        self.assertIsNone(get_incomplete(self.generations))
+
+    def test_missing(self):
+        """If there are no generations, None is returned."""
+        self.assertIsNone(get_incomplete(self.generations))
+
+
+class PublishGenerationTest(DistsTestCase):
+
+    def test_publish(self):
+        """Published generations are renamed and linked."""
+        path = create_generation(
+            self.link, self.generations, now=lambda: 1.5e9)
+        published = publish_generation(self.link, path)
+        self.assertEqual(self.generations / '1500000000000', published)
+        self.assertEqual('1500000000000', get_published(self.link))
+        self.assertEqual(published, Path(os.readlink(str(self.link))))
+
+    def test_publish_replace_dir(self):
+        """A plain dists directory is replaced."""
+        (self.link / 'xenial').mkdir(parents=True)
+        path = create_generation(self.link, self.generations)
+        published = publish_generation(self.link, path)
+        self.assertEqual(published.name, get_published(self.link))
+        self.assertEqual(['xenial'], os.listdir(str(self.link)))
+        self.assertEqual(['dists'], os.listdir(str(self.link.parent)))
+
+
+class AdoptDirectoryTest(DistsTestCase):
+
+    def test_adopt(self):
+        """A plain dists directory becomes a generation."""
+        (self.link / 'xenial').mkdir(parents=True)
+        self.assertTrue(
+            adopt_directory(self.link, self.generations, now=lambda: 1.5e9))
+        self.assertEqual('1500000000000', get_published(self.link))
+        self.assertEqual(['xenial'], os.listdir(str(self.link)))
+
+    def test_adopt_published(self):
+        """Nothing is done if a generation is already published."""
+        switch_link(self.link, self.make_generation('1234'))
+        self.assertFalse(adopt_directory(self.link, self.generations))
+        self.assertEqual('1234', get_published(self.link))
+
+    def test_adopt_missing(self):
+        """Nothing is done if there is no dists directory."""
+        self.assertFalse(adopt_directory(self.link, self.generations))
+        self.assertFalse(self.generations.exists())
+
+
+class PruneGenerationsTest(DistsTestCase):
+
+    def test_prune(self):
+        """Only the latest generations are kept."""
+        for name in ('1', '2', '3', '10'):
+            self.make_generation(name)
+        self.assertEqual(
+            ['1', '2'], prune_generations(self.generations, {'10'}, 2))
+        self.assertEqual(
+            ['10', '3'], sorted(os.listdir(str(self.generations))))
+
+    def test_prune_published(self):
+        """Published generations are never removed."""
+        for name in ('1', '2', '3'):
+            self.make_generation(name)
+        self.assertEqual(
+            [], prune_generations(self.generations, {'1', '2'}, 1))
+        self.assertEqual(
+            ['1', '2', '3'], sorted(os.listdir(str(self.generations))))
+
+    def test_prune_incomplete(self):
+        """Incomplete generations are removed."""
+        self.make_generation('1')
+        self.make_generation('.new-2')
+        self.assertEqual(
+            ['.new-2'], prune_generations(self.generations, set(), 3))
+        self.assertEqual(['1'], os.listdir(str(self.generations)))
+
+    def test_prune_partial(self):
+        """Partially created generations are removed."""
+        self.make_generation('1')
+        self.make_generation('.copy-2')
+        self.assertEqual(
+            ['.copy-2'], prune_generations(self.generations, set(), 3))
+        self.assertEqual(['1'], os.listdir(str(self.generations)))
+
+    def test_prune_missing(self):
+        """Nothing is done if there are no generations."""
+        self.assertEqual([], prune_generations(self.generations, set()))
+
+
+class SwitchLinkCommandTest(DistsTestCase):
+
+    def run_command(self, target):
+        subprocess.check_call(
+            ['/bin/sh', '-c', switch_link_command(self.link, target)])
+
+    def test_switch(self):
+        """The command points the link to the target."""
+        self.link.parent.mkdir()
+        switch_link(self.link, self.make_generation('1'))
+        self.run_command(self.make_generation('2', 'xenial'))
+        self.assertEqual('2', get_published(self.link))
+        self.assertEqual(['xenial'], os.listdir(str(self.link)))
+
+    def test_switch_replace_dir(self):
+        """A plain dists directory is replaced."""
+        (self.link / 'xenial').mkdir(parents=True)
+        self.run_command(self.make_generation('1', 'bionic'))
+        self.assertEqual('1', get_published(self.link))
+        self.assertEqual(['dists'], os.listdir(str(self.link.parent)))
+
+    def test_switch_missing_target(self):
+        """The command fails if the target doesn't exist."""
+        self.link.parent.mkdir()
+        switch_link(self.link, self.make_generation('1'))
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.run_command(self.generations / '2')
+        self.assertEqual('1', get_published(self.link))
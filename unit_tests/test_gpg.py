@@ -1,14 +1,21 @@
 from pathlib import Path
+import shutil
+import tempfile
+import unittest
 from unittest import mock
 
 from charmtest import CharmTest
 
 from archive_auth_mirror.utils import get_paths
 from archive_auth_mirror.gpg import (
-    detach_sign,
     export_public_key,
+    Fingerprint,
+    get_gpg,
     KeyRing,
-    inline_sign,
+    list_keys,
+    read_passphrase,
+    sign_files,
+    Signer,
 )
 
 
@@ -144,7 +151,7 @@ class ExportPublicKeyTest(CharmTest):
 class InlineSignTest(CharmTest):
 
     def test_inline_sign(self):
-        """inline_sign creates an inline signature for a file."""
+        """Signer can only create an inline signature for a file."""
         paths = get_paths(root_dir=Path(self.fakes.fs.root.path))
         paths['gnupghome'].mkdir(parents=True)
         paths['sign-passphrase'].write_text('')
@@ -155,7 +162,8 @@ class InlineSignTest(CharmTest):
         unsigned_file.write_text('some text to sign')
         inline_sign_file = Path(self.fakes.fs.root.join('signed'))
 
-        inline_sign(fingerprint, unsigned_file, inline_sign_file, paths=paths)
+        Signer(fingerprint, paths=paths).sign(
+            unsigned_file, inline_sign_file=inline_sign_file)
 
         signed_content = inline_sign_file.read_text()
         self.assertIn('some text to sign', signed_content)
@@ -165,7 +173,7 @@ class InlineSignTest(CharmTest):
 class DetachSignTest(CharmTest):
 
     def test_detach_sign(self):
-        """detach_sign creates a detached signature for a file."""
+        """Signer can only create a detached signature for a file."""
         paths = get_paths(root_dir=Path(self.fakes.fs.root.path))
         paths['gnupghome'].mkdir(parents=True)
         paths['sign-passphrase'].write_text('')
@@ -176,8 +184,241 @@ class DetachSignTest(CharmTest):
         unsigned_file.write_text('some text to sign')
         detach_sign_file = Path(self.fakes.fs.root.join('signature'))
 
-        detach_sign(fingerprint, unsigned_file, detach_sign_file, paths=paths)
+        Signer(fingerprint, paths=paths).sign(
+            unsigned_file, detach_sign_file=detach_sign_file)
 
         signature = detach_sign_file.read_text()
         self.assertTrue(signature.startswith('-----BEGIN PGP SIGNATURE-----'))
         self.assertTrue(signature.endswith('-----END PGP SIGNATURE-----\n'))
+
+
+class SignerTest(CharmTest):
+
+    def test_sign(self):
+        """Signer creates both an inline and a detached signature."""
+        paths = get_paths(root_dir=Path(self.fakes.fs.root.path))
+        paths['gnupghome'].mkdir(parents=True)
+        paths['sign-passphrase'].write_text('')
+        keyring = make_keyring(paths['gnupghome'])
+        fingerprint = keyring.import_key(SECRET_KEY_MATERIAL)
+        unsigned_file = Path(self.fakes.fs.root.join('unsigned'))
+        unsigned_file.write_text('some text to sign')
+        inline_sign_file = Path(self.fakes.fs.root.join('signed'))
+        detach_sign_file = Path(self.fakes.fs.root.join('signature'))
+        signer = Signer(fingerprint, paths=paths)
+        signer.sign(
+            unsigned_file, inline_sign_file=inline_sign_file,
+            detach_sign_file=detach_sign_file)
+        signed_content = inline_sign_file.read_text()
+        self.assertIn('some text to sign', signed_content)
+        self.assertIn('-----BEGIN PGP SIGNATURE-----', signed_content)
+        signature = detach_sign_file.read_text()
+        self.assertTrue(signature.startswith('-----BEGIN PGP SIGNATURE-----'))
+
+
+class SignerTransformTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+        self.paths = get_paths(root_dir=self.tempdir)
+        self.paths['sign-passphrase'].parent.mkdir(parents=True)
+        self.paths['sign-passphrase'].write_text('secret\n')
+
+    @mock.patch('gnupg.GPG')
+    def test_sign_transform(self, mock_gpg):
+        """The transformed content is signed and written back."""
+        mock_gpg.return_value.sign.side_effect = (
+            lambda content, clearsign, detach, **kwargs: (
+                'detached' if detach else 'inline:' + content))
+        unsigned_file = self.tempdir / 'Release'
+        unsigned_file.write_text('Codename: xenial\n')
+        inline_sign_file = self.tempdir / 'InRelease'
+        detach_sign_file = self.tempdir / 'Release.gpg'
+        signer = Signer('AABBCC', paths=self.paths)
+        signer.sign(
+            unsigned_file, inline_sign_file=inline_sign_file,
+            detach_sign_file=detach_sign_file, transform=str.upper)
+        self.assertEqual('CODENAME: XENIAL\n', unsigned_file.read_text())
+        self.assertEqual(
+            'inline:CODENAME: XENIAL\n', inline_sign_file.read_text())
+        self.assertEqual('detached', detach_sign_file.read_text())
+        mock_gpg.return_value.sign.assert_called_with(
+            'CODENAME: XENIAL\n', default_key='AABBCC', passphrase='secret',
+            clearsign=False, detach=True)
+        self.assertEqual(
+            ['InRelease', 'Release', 'Release.gpg'],
+            sorted(path.name for path in self.tempdir.iterdir()
+                   if path.is_file()))
+
+    @mock.patch('gnupg.GPG')
+    def test_sign_failure(self, mock_gpg):
+        """If signing fails, the unsigned file is not modified."""
+        mock_gpg.return_value.sign.side_effect = OSError('boom')
+        unsigned_file = self.tempdir / 'Release'
+        unsigned_file.write_text('Codename: xenial\n')
+        signer = Signer('AABBCC', paths=self.paths)
+        with self.assertRaises(OSError):
+            signer.sign(
+                unsigned_file, inline_sign_file=self.tempdir / 'InRelease',
+                transform=str.upper)
+        self.assertEqual('Codename: xenial\n', unsigned_file.read_text())
+
+
+class KeyRingIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.homedir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.homedir))
+        patcher = mock.patch('gnupg.GPG')
+        self.mock_gpg = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.fingerprints = []
+        self.mock_gpg.import_keys.side_effect = self.import_keys
+        self.mock_gpg.list_keys.side_effect = (
+            lambda secret: mock.Mock(fingerprints=list(self.fingerprints)))
+
+    def import_keys(self, key):
+        self.fingerprints.append(PUBLIC_KEY_FINGERPRINT)
+        # Simulate a change in the keyring.
+        (self.homedir / 'pubring.kbx').write_text(str(len(self.fingerprints)))
+        return mock.Mock(results=[{'fingerprint': PUBLIC_KEY_FINGERPRINT}])
+
+    def test_import_key_fingerprint(self):
+        """Both the full and the short fingerprint are returned."""
+        keyring = make_keyring(self.homedir)
+        self.assertEqual(
+            Fingerprint(
+                full=PUBLIC_KEY_FINGERPRINT,
+                short=PUBLIC_KEY_FINGERPRINT[-8:]),
+            keyring.import_key_fingerprint(PUBLIC_KEY_MATERIAL))
+
+    def test_import_key_once(self):
+        """Keys already in the keyring are not imported again."""
+        make_keyring(self.homedir).import_key(PUBLIC_KEY_MATERIAL)
+        fingerprint = make_keyring(self.homedir).import_key(
+            PUBLIC_KEY_MATERIAL + '\n')
+        self.assertEqual(PUBLIC_KEY_FINGERPRINT[-8:], fingerprint)
+        self.assertEqual(1, self.mock_gpg.import_keys.call_count)
+
+    def test_import_key_removed(self):
+        """Keys are imported again if removed from the keyring."""
+        make_keyring(self.homedir).import_key(PUBLIC_KEY_MATERIAL)
+        self.fingerprints.clear()
+        (self.homedir / 'pubring.kbx').write_text('removed')
+        make_keyring(self.homedir).import_key(PUBLIC_KEY_MATERIAL)
+        self.assertEqual(2, self.mock_gpg.import_keys.call_count)
+
+
+class GetGPGTest(unittest.TestCase):
+
+    def setUp(self):
+        self.homedir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.homedir))
+
+    @mock.patch('gnupg.GPG')
+    def test_cached(self, mock_gpg):
+        """The same handle is returned for the same homedir."""
+        mock_gpg.side_effect = lambda homedir: mock.Mock()
+        gpg = get_gpg(self.homedir)
+        self.assertIs(gpg, get_gpg(str(self.homedir)))
+        mock_gpg.assert_called_once_with(homedir=str(self.homedir))
+
+    @mock.patch('gnupg.GPG')
+    def test_keyring_changed(self, mock_gpg):
+        """The handle is kept when keyring files change."""
+        mock_gpg.side_effect = lambda homedir: mock.Mock()
+        gpg = get_gpg(self.homedir)
+        (self.homedir / 'pubring.kbx').write_text('keys')
+        self.assertIs(gpg, get_gpg(self.homedir))
+        mock_gpg.assert_called_once_with(homedir=str(self.homedir))
+
+    @mock.patch('gnupg.GPG')
+    def test_list_keys(self, mock_gpg):
+        """Key metadata is cached until keyring files change."""
+        mock_gpg.return_value.list_keys.side_effect = (
+            lambda secret: [object()])
+        keys = list_keys(self.homedir)
+        self.assertIs(keys, list_keys(self.homedir))
+        self.assertIsNot(keys, list_keys(self.homedir, secret=True))
+        (self.homedir / 'pubring.kbx').write_text('keys')
+        self.assertIsNot(keys, list_keys(self.homedir))
+        # Only key metadata is refreshed.
+        mock_gpg.assert_called_once_with(homedir=str(self.homedir))
+
+
+class ReadPassphraseTest(unittest.TestCase):
+
+    def setUp(self):
+        tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(tempdir))
+        self.path = tempdir / 'sign-passphrase'
+
+    def test_read_passphrase(self):
+        """The passphrase is read from the file, and stripped."""
+        self.path.write_text('secret\n')
+        self.assertEqual('secret', read_passphrase(self.path))
+
+    def test_file_changed(self):
+        """The passphrase is read again when the file changes."""
+        self.path.write_text('secret')
+        read_passphrase(self.path)
+        self.path.write_text('new secret')
+        self.assertEqual('new secret', read_passphrase(self.path))
+
+
+class FakeSigner:
+    """A fake Signer writing the key ID to signature files."""
+
+    def __init__(self, key_id, paths=None):
+        self.key_id = key_id
+
+    def sign(self, unsigned_file, inline_sign_file=None,
+             detach_sign_file=None, transform=None):
+        content = unsigned_file.read_text()
+        if transform is not None:
+            unsigned_file.write_text(transform(content))
+        for path in (inline_sign_file, detach_sign_file):
+            if path:
+                path.write_text(self.key_id)
+
+
+def transform(content):
+    """Mark the content as transformed."""
+    return content + 'transformed'
+
+
+class SignFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+        self.paths = get_paths(root_dir=self.tempdir)
+
+    @mock.patch('archive_auth_mirror.gpg.Signer', FakeSigner)
+    def test_sign_files(self):
+        """sign_files signs all files, transforming them first."""
+        requests = []
+        for name in ('xenial', 'bionic'):
+            unsigned_file = self.tempdir / name
+            unsigned_file.write_text('')
+            requests.append(
+                (unsigned_file, self.tempdir / (name + '.inline'),
+                 self.tempdir / (name + '.detach')))
+        errors = sign_files(
+            'AABBCC', requests, paths=self.paths, max_workers=2,
+            transform=transform)
+        self.assertEqual([None, None], errors)
+        for unsigned_file, inline_sign_file, detach_sign_file in requests:
+            self.assertEqual('transformed', unsigned_file.read_text())
+            self.assertEqual('AABBCC', inline_sign_file.read_text())
+            self.assertEqual('AABBCC', detach_sign_file.read_text())
+
+    @mock.patch('archive_auth_mirror.gpg.Signer', FakeSigner)
+    def test_sign_files_error(self):
+        """Errors are returned for files which can't be signed."""
+        errors = sign_files(
+            'AABBCC', [(self.tempdir / 'missing', None, None)],
+            paths=self.paths, max_workers=1)
+        self.assertEqual(1, len(errors))
+        self.assertIn('missing', errors[0])
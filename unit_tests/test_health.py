@@ -0,0 +1,80 @@
+from pathlib import Path
+import shutil
+import tempfile
+import unittest
+
+from archive_auth_mirror.health import PeerHealth
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.time = 1000.0
+
+    def __call__(self):
+        return self.time
+
+
+class PeerHealthTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+        self.path = self.tempdir / 'peer-health.json'
+        self.clock = FakeClock()
+
+    def make_health(self):
+        return PeerHealth(
+            self.path, now=self.clock, min_delay=10, max_delay=35)
+
+    def test_healthy(self):
+        """Peers are available unless marked as failed."""
+        health = self.make_health()
+        self.assertEqual(['1.2.3.4'], health.select(['1.2.3.4']))
+        self.assertIsNone(health.status('1.2.3.4'))
+
+    def test_failed_skipped_for_run(self):
+        """A failed peer is skipped for the rest of the run."""
+        health = self.make_health()
+        health.mark_failed('1.2.3.4', 'boom')
+        self.clock.time += 100
+        self.assertEqual(
+            ['5.6.7.8'], health.select(['1.2.3.4', '5.6.7.8']))
+        status = health.status('1.2.3.4')
+        self.assertEqual(1, status.failures)
+        self.assertEqual('boom', status.error)
+
+    def test_backoff(self):
+        """Failed peers are probed again after exponential delays."""
+        for failures, delay in ((1, 10), (2, 20), (3, 35), (4, 35)):
+            health = self.make_health()
+            health.mark_failed('1.2.3.4', 'boom')
+            health.save()
+            health = self.make_health()
+            self.assertEqual(failures, health.status('1.2.3.4').failures)
+            self.clock.time += delay - 1
+            self.assertFalse(health.available('1.2.3.4'))
+            self.clock.time += 1
+            self.assertTrue(health.available('1.2.3.4'))
+
+    def test_healthy_again(self):
+        """A successful sync resets the peer status."""
+        health = self.make_health()
+        health.mark_failed('1.2.3.4', 'boom')
+        health.mark_healthy('1.2.3.4')
+        health.save()
+        self.assertTrue(self.make_health().available('1.2.3.4'))
+
+    def test_prune(self):
+        """Peers which are gone are forgotten."""
+        health = self.make_health()
+        health.mark_failed('1.2.3.4', 'boom')
+        health.mark_failed('5.6.7.8', 'boom')
+        health.prune(['5.6.7.8'])
+        self.assertIsNone(health.status('1.2.3.4'))
+        self.assertIsNotNone(health.status('5.6.7.8'))
+
+    def test_invalid_file(self):
+        """If the saved registry is invalid, it's ignored."""
+        self.path.write_text('[1, 2]')
+        self.assertTrue(self.make_health().available('1.2.3.4'))
@@ -1,11 +1,27 @@
+from collections import OrderedDict
+import io
+import os
 from pathlib import Path
+import shutil
+import tempfile
+from unittest import TestCase, mock
 
 from charmtest import CharmTest
 
+from archive_auth_mirror.apr1 import check_password
 from archive_auth_mirror.scripts.manage_user import (
     add_user,
+    count_users,
+    get_index_path,
+    get_verified_path,
+    import_users,
+    iter_users,
+    read_credentials,
+    read_users,
     remove_user,
     list_users,
+    user_exists,
+    write_users,
 )
 
 
@@ -41,3 +57,199 @@ class ManageUserTest(CharmTest):
         remove_user(self.auth_file, 'user1')
         self.assertNotIn('user1', self.auth_file.read_text())
         self.assertIn('user2', self.auth_file.read_text())
+
+
+class ImportUsersTest(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+        self.auth_file = self.tempdir / 'auth-file'
+
+    def test_import(self):
+        """import_users adds users with apr1-hashed passwords."""
+        result = import_users(
+            self.auth_file, [('user1', 'pass1'), ('user2', 'pass2')])
+        self.assertEqual((2, 0, 0), result)
+        users = read_users(self.auth_file)
+        self.assertEqual(['user1', 'user2'], list(users))
+        self.assertTrue(check_password('pass1', users['user1']))
+        self.assertTrue(check_password('pass2', users['user2']))
+
+    def test_import_update(self):
+        """Passwords are updated only for users whose password changed."""
+        import_users(self.auth_file, [('user1', 'pass1'), ('user2', 'pass2')])
+        hashed = read_users(self.auth_file)['user1']
+        result = import_users(
+            self.auth_file, [('user1', 'pass1'), ('user2', 'new')])
+        self.assertEqual((0, 1, 0), result)
+        users = read_users(self.auth_file)
+        self.assertEqual(hashed, users['user1'])
+        self.assertTrue(check_password('new', users['user2']))
+
+    def test_import_unchanged(self):
+        """If nothing changes, the file is not written."""
+        import_users(self.auth_file, [('user1', 'pass1')])
+        mtime = self.auth_file.stat().st_mtime_ns
+        self.assertEqual(
+            (0, 0, 0), import_users(self.auth_file, [('user1', 'pass1')]))
+        self.assertEqual(mtime, self.auth_file.stat().st_mtime_ns)
+
+    def test_import_keeps_others(self):
+        """Users not included are kept, unless remove_others is True."""
+        import_users(self.auth_file, [('user1', 'pass1'), ('user2', 'pass2')])
+        import_users(self.auth_file, [('user3', 'pass3')])
+        self.assertEqual(
+            ['user1', 'user2', 'user3'], list(read_users(self.auth_file)))
+        result = import_users(
+            self.auth_file, [('user2', 'pass2')], remove_others=True)
+        self.assertEqual((0, 0, 2), result)
+        self.assertEqual(['user2'], list(read_users(self.auth_file)))
+
+    def test_import_preserves_mode(self):
+        """The permissions of the existing file are preserved."""
+        self.auth_file.touch()
+        self.auth_file.chmod(0o640)
+        import_users(self.auth_file, [('user1', 'pass1')])
+        self.assertEqual(0o640, self.auth_file.stat().st_mode & 0o777)
+        self.assertEqual(
+            ['auth-file', 'auth-file.verified'],
+            sorted(os.listdir(str(self.tempdir))))
+
+    def test_import_verified_cached(self):
+        """Passwords found unchanged are not checked again."""
+        credentials = [('user1', 'pass1'), ('user2', 'pass2')]
+        import_users(self.auth_file, credentials)
+        self.assertEqual(
+            0o600, get_verified_path(self.auth_file).stat().st_mode & 0o777)
+        with mock.patch(
+                'archive_auth_mirror.scripts.manage_user.check_password',
+                return_value=False) as mock_check_password:
+            self.assertEqual(
+                (0, 1, 0),
+                import_users(
+                    self.auth_file, [('user1', 'pass1'), ('user2', 'new')]))
+        # Only the changed password is checked.
+        mock_check_password.assert_called_once_with('new', mock.ANY)
+
+    def test_import_verified_hash_changed(self):
+        """Passwords are checked if the hash changed since the last import."""
+        import_users(self.auth_file, [('user1', 'pass1')])
+        users = read_users(self.auth_file)
+        users['user1'] = '$apr1$other$hash'
+        write_users(self.auth_file, users)
+        self.assertEqual(
+            (0, 1, 0), import_users(self.auth_file, [('user1', 'pass1')]))
+        self.assertTrue(
+            check_password('pass1', read_users(self.auth_file)['user1']))
+
+    def test_import_verified_invalid(self):
+        """An invalid cache of verified passwords is ignored."""
+        import_users(self.auth_file, [('user1', 'pass1')])
+        get_verified_path(self.auth_file).write_text('garbage')
+        self.assertEqual(
+            (0, 0, 0), import_users(self.auth_file, [('user1', 'pass1')]))
+
+
+class LookupUsersTest(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+        self.auth_file = self.tempdir / 'auth-file'
+        self.index_path = get_index_path(self.auth_file)
+        patcher = mock.patch(
+            'archive_auth_mirror.scripts.manage_user.INDEX_MIN_USERS', 3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_users(self, *users):
+        write_users(
+            self.auth_file,
+            OrderedDict((user, 'hash-' + user) for user in users))
+
+    def test_iter_users_prefix(self):
+        """iter_users yields users with the given prefix."""
+        self.write_users('foo1', 'bar', 'foo2')
+        self.assertEqual(['foo1', 'foo2'], list(iter_users(
+            self.auth_file, prefix='foo')))
+        self.assertEqual(['foo1', 'bar', 'foo2'], list_users(self.auth_file))
+
+    def test_list_prefix_not_indexed(self):
+        """Without index, users with a prefix are sorted and unique."""
+        self.auth_file.write_text('foo2:hash\nfoo1:hash\nbar:hash\nfoo2:x\n')
+        self.assertEqual(
+            ['foo1', 'foo2'], list_users(self.auth_file, prefix='foo'))
+
+    def test_count_duplicates_not_indexed(self):
+        """Without index, duplicated users are counted once."""
+        self.auth_file.write_text('user1:hash\nuser2:hash\nuser1:other\n')
+        self.assertEqual(2, count_users(self.auth_file))
+
+    def test_small_file_not_indexed(self):
+        """Files with fewer users than the threshold are not indexed."""
+        self.write_users('user1', 'user2')
+        self.assertFalse(self.index_path.exists())
+        self.assertTrue(user_exists(self.auth_file, 'user1'))
+        self.assertFalse(user_exists(self.auth_file, 'user3'))
+        self.assertEqual(2, count_users(self.auth_file))
+
+    def test_indexed(self):
+        """Large files are indexed, and lookups use the index."""
+        self.write_users('user1', 'user2', 'user3')
+        self.assertTrue(self.index_path.exists())
+        with mock.patch(
+                'archive_auth_mirror.scripts.manage_user.iter_users') as iter:
+            self.assertTrue(user_exists(self.auth_file, 'user2'))
+            self.assertFalse(user_exists(self.auth_file, 'user4'))
+            self.assertEqual(3, count_users(self.auth_file))
+            self.assertEqual(
+                ['user2'], list_users(self.auth_file, prefix='user2'))
+            self.assertEqual(
+                [], list_users(self.auth_file, prefix='user4'))
+            iter.assert_not_called()
+
+    def test_index_mode(self):
+        """The index has the same permissions as the file."""
+        self.auth_file.touch()
+        self.auth_file.chmod(0o640)
+        self.write_users('user1', 'user2', 'user3')
+        self.assertEqual(0o640, self.index_path.stat().st_mode & 0o777)
+
+    def test_index_removed(self):
+        """The index is removed when the file shrinks below the threshold."""
+        self.write_users('user1', 'user2', 'user3')
+        self.write_users('user1')
+        self.assertFalse(self.index_path.exists())
+
+    def test_stale_index(self):
+        """If the file is modified otherwise, the index is ignored."""
+        self.write_users('user1', 'user2', 'user3')
+        with self.auth_file.open('a') as fh:
+            fh.write('user4:hash\n')
+        self.assertTrue(user_exists(self.auth_file, 'user4'))
+        self.assertEqual(4, count_users(self.auth_file))
+
+
+class ReadCredentialsTest(TestCase):
+
+    def test_read(self):
+        """Credentials are read from CSV lines."""
+        content = 'user1,pass1\n\n"user2","pa,ss2"\n'
+        self.assertEqual(
+            [('user1', 'pass1'), ('user2', 'pa,ss2')],
+            read_credentials(io.StringIO(content)))
+
+    def test_invalid_row(self):
+        """Rows must contain the user and the password."""
+        with self.assertRaises(ValueError) as context:
+            read_credentials(io.StringIO('user1,pass1\nuser2\n'))
+        self.assertEqual(
+            'line 2: expected user and password', str(context.exception))
+
+    def test_invalid_user(self):
+        """User names can't contain colons."""
+        with self.assertRaises(ValueError):
+            read_credentials(io.StringIO('us:er,pass1\n'))
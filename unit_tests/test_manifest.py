@@ -0,0 +1,63 @@
+from pathlib import Path
+import shutil
+import tempfile
+import unittest
+
+from archive_auth_mirror.manifest import (
+    diff,
+    Manifest,
+    snapshot,
+    write_file_list,
+)
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+
+    def test_snapshot(self):
+        """snapshot returns paths of files in the tree, relative to it."""
+        (self.tempdir / 'main/f/foo').mkdir(parents=True)
+        (self.tempdir / 'main/f/foo/foo_1.0.deb').touch()
+        (self.tempdir / 'main/f/foo/foo_1.1.deb').touch()
+        (self.tempdir / 'top').touch()
+        (self.tempdir / 'empty').mkdir()
+        self.assertEqual(
+            frozenset(
+                ['main/f/foo/foo_1.0.deb', 'main/f/foo/foo_1.1.deb', 'top']),
+            snapshot(self.tempdir))
+
+    def test_snapshot_not_existent(self):
+        """If the tree doesn't exist, the snapshot is empty."""
+        self.assertEqual(frozenset(), snapshot(self.tempdir / 'not-here'))
+
+
+class DiffTest(unittest.TestCase):
+
+    def test_diff(self):
+        """diff returns sorted added and removed files."""
+        before = frozenset(['a', 'b', 'd'])
+        after = frozenset(['a', 'e', 'c'])
+        self.assertEqual(
+            Manifest(added=['c', 'e'], removed=['b', 'd']),
+            diff(before, after))
+
+    def test_diff_no_changes(self):
+        """If the snapshots are the same, the manifest is empty."""
+        files = frozenset(['a', 'b'])
+        self.assertEqual(Manifest(added=[], removed=[]), diff(files, files))
+
+
+class WriteFileListTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+
+    def test_write_file_list(self):
+        """write_file_list writes a file per line."""
+        path = self.tempdir / 'files'
+        write_file_list(['a/b', 'c'], path)
+        self.assertEqual('a/b\nc\n', path.read_text())
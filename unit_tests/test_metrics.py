@@ -0,0 +1,139 @@
+import json
+from pathlib import Path
+import shutil
+import tempfile
+import unittest
+
+from archive_auth_mirror.health import PeerStatus
+from archive_auth_mirror.metrics import RunMetrics
+from archive_auth_mirror.rsync import SyncResult, TransferStats
+from archive_auth_mirror.scheduler import SuiteStatus
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.time = 100.0
+
+    def __call__(self):
+        return self.time
+
+
+class RunMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.metrics = RunMetrics(clock=self.clock, now=lambda: 1500000000.0)
+
+    def test_phase(self):
+        """Phases record the time spent in them."""
+        with self.metrics.phase('update'):
+            self.clock.time += 3
+        with self.metrics.phase('export') as phase:
+            self.clock.time += 2
+            phase.files = 10
+        phases = self.metrics.as_dict()['phases']
+        self.assertEqual(['update', 'export'], list(phases))
+        self.assertEqual(
+            {'seconds': 3.0, 'files': None, 'bytes': None}, phases['update'])
+        self.assertEqual(
+            {'seconds': 2.0, 'files': 10, 'bytes': None}, phases['export'])
+
+    def test_phase_error(self):
+        """Time is recorded also when the phase fails."""
+        with self.assertRaises(ValueError):
+            with self.metrics.phase('update'):
+                self.clock.time += 3
+                raise ValueError()
+        self.assertEqual(3.0, self.metrics.phases['update'].seconds)
+
+    def test_finish(self):
+        """finish records the total run time and the outcome."""
+        self.clock.time += 10
+        self.metrics.finish(True)
+        metrics = self.metrics.as_dict()
+        self.assertEqual(10.0, metrics['seconds'])
+        self.assertIs(True, metrics['success'])
+        self.assertEqual(1500000000.0, metrics['timestamp'])
+
+    def test_add_peer(self):
+        """Peer results are recorded and added up in the sync phase."""
+        self.metrics.add_peer('1.2.3.4', SyncResult(
+            host='1.2.3.4', success=True, error=None, seconds=4.0,
+            stats=TransferStats(files=3, bytes=100)))
+        self.metrics.add_peer('5.6.7.8', SyncResult(
+            host='5.6.7.8', success=True, error=None, seconds=5.0,
+            stats=TransferStats(files=2, bytes=50)))
+        self.metrics.add_peer('9.9.9.9', SyncResult(
+            host='9.9.9.9', success=False, error='boom', seconds=1.0,
+            stats=None))
+        metrics = self.metrics.as_dict()
+        self.assertEqual(
+            {'seconds': 4.0, 'success': True, 'files': 3, 'bytes': 100},
+            metrics['peers']['1.2.3.4'])
+        self.assertEqual(
+            {'seconds': 1.0, 'success': False, 'files': None, 'bytes': None},
+            metrics['peers']['9.9.9.9'])
+        self.assertEqual(5, metrics['phases']['sync']['files'])
+        self.assertEqual(150, metrics['phases']['sync']['bytes'])
+
+    def test_add_suite(self):
+        """Suite update results are recorded."""
+        self.metrics.add_suite(SuiteStatus(
+            suite='xenial', success=False, error='boom', seconds=2.5))
+        self.assertEqual(
+            {'xenial': {'seconds': 2.5, 'success': False}},
+            self.metrics.as_dict()['suites'])
+
+    def test_add_unhealthy_peer(self):
+        """The status of unhealthy peers is recorded."""
+        self.metrics.add_unhealthy_peer('1.2.3.4', PeerStatus(
+            failures=2, next_probe=1500000120.0, error='boom', skip=True))
+        self.assertEqual(
+            {'1.2.3.4': {'failures': 2, 'next-probe': 1500000120.0}},
+            self.metrics.as_dict()['unhealthy-peers'])
+        self.assertIn(
+            'archive_auth_mirror_peer_consecutive_failures{peer="1.2.3.4"} 2',
+            self.metrics.as_prometheus().splitlines())
+
+    def test_as_prometheus(self):
+        """Metrics can be exported in the Prometheus text format."""
+        with self.metrics.phase('update'):
+            self.clock.time += 3
+        self.metrics.set_pool_changes(4, 1)
+        self.metrics.add_peer('1.2.3.4', SyncResult(
+            host='1.2.3.4', success=True, error=None, seconds=4.0,
+            stats=TransferStats(files=3, bytes=100)))
+        self.metrics.finish(False)
+        lines = self.metrics.as_prometheus().splitlines()
+        self.assertIn(
+            '# TYPE archive_auth_mirror_phase_seconds gauge', lines)
+        self.assertIn(
+            'archive_auth_mirror_phase_seconds{phase="update"} 3.0', lines)
+        self.assertIn(
+            'archive_auth_mirror_phase_bytes{phase="sync"} 100', lines)
+        self.assertIn('archive_auth_mirror_pool_files_added 4', lines)
+        self.assertIn('archive_auth_mirror_last_run_success 0', lines)
+        self.assertIn(
+            'archive_auth_mirror_peer_sync_bytes{peer="1.2.3.4"} 100', lines)
+        self.assertIn(
+            'archive_auth_mirror_peer_sync_success{peer="1.2.3.4"} 1', lines)
+        # Unset values are not exported.
+        self.assertNotIn(
+            'archive_auth_mirror_phase_files{phase="update"} None', lines)
+
+    def test_write(self):
+        """Metrics are saved as JSON and as a Prometheus textfile."""
+        tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(tempdir))
+        json_path = tempdir / 'metrics.json'
+        textfile_path = tempdir / 'metrics.prom'
+        self.metrics.finish(True)
+        self.metrics.write(json_path=json_path, textfile_path=textfile_path)
+        self.assertEqual(
+            self.metrics.as_dict(), json.loads(json_path.read_text()))
+        self.assertEqual(
+            self.metrics.as_prometheus(), textfile_path.read_text())
+        self.assertEqual(
+            ['metrics.json', 'metrics.prom'],
+            sorted(path.name for path in tempdir.iterdir()))
@@ -0,0 +1,652 @@
+import logging
+import os
+from pathlib import Path
+import shutil
+from subprocess import CalledProcessError
+import tempfile
+import unittest
+from unittest import mock
+
+from fixtures import LoggerFixture, TestWithFixtures
+
+from archive_auth_mirror.dists import (
+    create_generation,
+    get_published,
+    switch_link_command,
+)
+from archive_auth_mirror.health import PeerHealth
+from archive_auth_mirror.lock import AlreadyLocked
+from archive_auth_mirror.manifest import Manifest
+from archive_auth_mirror.preflight import load_fingerprints, save_fingerprints
+from archive_auth_mirror.replication import (
+    Generation,
+    read_generation,
+    write_generation,
+)
+from archive_auth_mirror.rsync import SyncResult, SyncStep
+from archive_auth_mirror.scripts.mirror_archive import (
+    _get_stage,
+    export,
+    get_delta_sync_plan,
+    get_sync_plan,
+    main,
+    run_cycle,
+)
+from archive_auth_mirror.signing import (
+    SPOOL_ENV,
+    SigningError,
+    spool_request,
+)
+from archive_auth_mirror.utils import get_paths
+
+
+class GetSyncPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+        self.paths = get_paths(root_dir=self.tempdir)
+        self.pool = self.paths['static'] / 'ubuntu' / 'pool'
+        self.dists = self.paths['static'] / 'ubuntu' / 'dists'
+        self.generations = self.paths['dists-generations']
+
+    def test_plan(self):
+        """The pool is pushed before dists, and deletions happen last."""
+        (self.generations / '1234').mkdir(parents=True)
+        self.dists.parent.mkdir(parents=True)
+        self.dists.symlink_to(self.generations / '1234')
+        plan = get_sync_plan(self.paths)
+        self.assertEqual(
+            [SyncStep(
+                paths=(self.pool,), delete=False, files_from=None,
+                hard_links=False, command=None, check=None),
+             SyncStep(
+                 paths=(self.generations,), delete=False, files_from=None,
+                 hard_links=True, command=None, check=None),
+             SyncStep(
+                 paths=(), delete=False, files_from=None, hard_links=False,
+                 command=switch_link_command(
+                     self.dists, self.generations / '1234'), check=None),
+             SyncStep(
+                 paths=(self.pool, self.generations,
+                        self.paths['reprepro'] / 'db',
+                        self.paths['reprepro'] / 'lists'),
+                 delete=True, files_from=None, hard_links=True,
+                 command=None, check=None)],
+            plan.steps)
+
+    def test_plan_dists(self):
+        """The dists generation to publish can be specified."""
+        plan = get_sync_plan(self.paths, dists='5678')
+        self.assertEqual(
+            switch_link_command(self.dists, self.generations / '5678'),
+            plan.steps[2].command)
+
+    def test_plan_check(self):
+        """The check is run before old files are deleted."""
+        check = mock.Mock()
+        plan = get_sync_plan(self.paths, check=check)
+        self.assertIs(check, plan.steps[-2].check)
+        self.assertTrue(plan.steps[-1].delete)
+
+    def test_plan_not_published(self):
+        """If no dists generation is published, there's nothing to switch."""
+        plan = get_sync_plan(self.paths)
+        self.assertEqual(
+            [None, None, None], [step.command for step in plan.steps])
+
+
+class GetDeltaSyncPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+        self.paths = get_paths(root_dir=self.tempdir)
+        self.pool = self.paths['static'] / 'ubuntu' / 'pool'
+        self.dists = self.paths['static'] / 'ubuntu' / 'dists'
+        self.generations = self.paths['dists-generations']
+        (self.generations / '1234').mkdir(parents=True)
+        self.dists.parent.mkdir(parents=True)
+        self.dists.symlink_to(self.generations / '1234')
+
+    def test_plan(self):
+        """Only changed pool files are pushed."""
+        manifest = Manifest(added=['a.deb', 'b.deb'], removed=['c.deb'])
+        plan = get_delta_sync_plan(self.paths, manifest, self.tempdir)
+        self.assertEqual(
+            [SyncStep(
+                paths=(self.pool,), delete=False,
+                files_from=self.tempdir / 'added', hard_links=False,
+                command=None, check=None),
+             SyncStep(
+                 paths=(self.generations,), delete=False, files_from=None,
+                 hard_links=True, command=None, check=None),
+             SyncStep(
+                 paths=(), delete=False, files_from=None, hard_links=False,
+                 command=switch_link_command(
+                     self.dists, self.generations / '1234'), check=None),
+             SyncStep(
+                 paths=(self.generations,
+                        self.paths['reprepro'] / 'db',
+                        self.paths['reprepro'] / 'lists'),
+                 delete=True, files_from=None, hard_links=True,
+                 command=None, check=None),
+             SyncStep(
+                 paths=(self.pool,), delete=True,
+                 files_from=self.tempdir / 'removed', hard_links=False,
+                 command=None, check=None)],
+            plan.steps)
+        self.assertEqual(
+            'a.deb\nb.deb\n', (self.tempdir / 'added').read_text())
+        self.assertEqual('c.deb\n', (self.tempdir / 'removed').read_text())
+
+    def test_plan_no_changes(self):
+        """If the pool didn't change, only indexes are pushed."""
+        manifest = Manifest(added=[], removed=[])
+        plan = get_delta_sync_plan(self.paths, manifest, self.tempdir)
+        self.assertEqual(3, len(plan.steps))
+        self.assertEqual((self.generations,), plan.steps[0].paths)
+
+
+class FakeReprepro:
+    """A fake Reprepro exporting a Release file for each suite."""
+
+    def __init__(self):
+        self.calls = []
+
+    def execute(self, *args, env=None):
+        self.calls.append(args)
+        distdir = Path(args[1])
+        for suite in args[3:]:
+            suite_dir = distdir / suite
+            suite_dir.mkdir(parents=True)
+            (suite_dir / 'Release').write_text('Codename: ' + suite + '\n')
+            if env is not None:
+                spool_request(
+                    Path(env[SPOOL_ENV]), suite_dir / 'Release',
+                    suite_dir / 'InRelease', suite_dir / 'Release.gpg')
+
+
+class ExportTest(TestWithFixtures):
+
+    def setUp(self):
+        super().setUp()
+        self.logger = self.useFixture(LoggerFixture())
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+        self.paths = get_paths(root_dir=self.tempdir)
+        self.paths['base'].mkdir(parents=True)
+        self.dists = self.paths['static'] / 'ubuntu' / 'dists'
+        self.config = {'sign-key-id': 'AABBCC', 'sign-concurrency': 2}
+        self.reprepro = FakeReprepro()
+
+    @mock.patch('archive_auth_mirror.gpg.sign_files')
+    def test_export_batch(self, mock_sign_files):
+        """Suites are exported to a new generation and signed in batch."""
+        mock_sign_files.return_value = [None, None]
+        (self.dists / 'xenial').mkdir(parents=True)
+        (self.dists / 'xenial' / 'old').touch()
+        (self.dists / 'bionic').mkdir()
+        (self.dists / 'bionic' / 'Release').touch()
+        inode = (self.dists / 'bionic' / 'Release').stat().st_ino
+        export(
+            logging.getLogger(), self.paths, self.config, self.reprepro,
+            ['xenial', 'trusty'])
+        [(key_id, requests), kwargs] = mock_sign_files.call_args
+        self.assertEqual('AABBCC', key_id)
+        self.assertEqual(2, kwargs['max_workers'])
+        self.assertTrue(self.dists.is_symlink())
+        self.assertEqual(
+            ['InRelease', 'Release', 'Release.gpg'],
+            sorted(os.listdir(str(self.dists / 'xenial'))))
+        self.assertEqual(
+            ['InRelease', 'Release', 'Release.gpg'],
+            sorted(os.listdir(str(self.dists / 'trusty'))))
+        # Other suites are linked from the previous dists directory.
+        self.assertEqual(
+            inode, (self.dists / 'bionic' / 'Release').stat().st_ino)
+        # The spool directory is removed.
+        self.assertEqual(
+            ['dists-generations', 'static'],
+            sorted(os.listdir(str(self.paths['base']))))
+
+    @mock.patch('archive_auth_mirror.gpg.sign_files')
+    def test_export_batch_error(self, mock_sign_files):
+        """If signing fails, the new generation is not published."""
+        mock_sign_files.return_value = ['boom']
+        (self.dists / 'xenial').mkdir(parents=True)
+        with self.assertRaises(SigningError):
+            export(
+                logging.getLogger(), self.paths, self.config, self.reprepro,
+                ['xenial'])
+        self.assertFalse(self.dists.is_symlink())
+        self.assertEqual([], os.listdir(str(self.dists / 'xenial')))
+        self.assertEqual(
+            [], os.listdir(str(self.paths['dists-generations'])))
+        self.assertIn('boom', self.logger.output)
+
+    @mock.patch('archive_auth_mirror.scripts.mirror_archive.'
+                '_get_signing_agent')
+    def test_export_agent(self, mock_get_signing_agent):
+        """With a sign concurrency of 1, suites are signed while exported."""
+        self.config['sign-concurrency'] = 1
+        export(
+            logging.getLogger(), self.paths, self.config, self.reprepro,
+            ['xenial'])
+        mock_get_signing_agent.return_value.__enter__.assert_called_once_with()
+        [(_, distdir, _, _)] = self.reprepro.calls
+        # The generation is renamed when published.
+        self.assertEqual(
+            Path(distdir), self.paths['dists-generations'] /
+            ('.new-' + get_published(self.dists)))
+        self.assertEqual(
+            ['Release'], os.listdir(str(self.dists / 'xenial')))
+
+    @mock.patch('archive_auth_mirror.gpg.sign_files')
+    def test_export_prune(self, mock_sign_files):
+        """Only the configured number of generations is kept."""
+        mock_sign_files.return_value = [None]
+        self.config['dists-generations'] = 2
+        for _ in range(3):
+            export(
+                logging.getLogger(), self.paths, self.config, self.reprepro,
+                ['xenial'])
+        generations = sorted(
+            os.listdir(str(self.paths['dists-generations'])), key=int)
+        self.assertEqual(2, len(generations))
+        self.assertEqual(generations[-1], get_published(self.dists))
+
+    @mock.patch('archive_auth_mirror.gpg.sign_files')
+    def test_export_outdir(self, mock_sign_files):
+        """Suites can be exported to a staged repository tree."""
+        mock_sign_files.return_value = [None]
+        self.config['dists-generations'] = 1
+        export(
+            logging.getLogger(), self.paths, self.config, self.reprepro,
+            ['xenial'])
+        served = get_published(self.dists)
+        stage = self.tempdir / 'stage'
+        stage.mkdir()
+        (stage / 'dists').symlink_to(os.readlink(str(self.dists)))
+        export(
+            logging.getLogger(), self.paths, self.config, self.reprepro,
+            ['xenial'], outdir=stage)
+        # The served generation is kept, even if older than the staged one.
+        self.assertEqual(served, get_published(self.dists))
+        self.assertNotEqual(served, get_published(stage / 'dists'))
+        self.assertEqual(
+            sorted([served, get_published(stage / 'dists')]),
+            sorted(os.listdir(str(self.paths['dists-generations']))))
+
+
+class GetStageTest(TestWithFixtures):
+
+    def setUp(self):
+        super().setUp()
+        self.logger = self.useFixture(LoggerFixture())
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+        self.paths = get_paths(root_dir=self.tempdir)
+        self.served = self.paths['static'] / 'ubuntu'
+        (self.served / 'pool' / 'main').mkdir(parents=True)
+        (self.served / 'pool' / 'main' / 'a.deb').touch()
+
+    def test_stage(self):
+        """The stage is a hard-linked copy of the served repository."""
+        stage = _get_stage(logging.getLogger(), self.paths)
+        self.assertEqual(self.paths['snapshots'], stage.parent)
+        self.assertEqual(
+            (self.served / 'pool' / 'main' / 'a.deb').stat().st_ino,
+            (stage / 'pool' / 'main' / 'a.deb').stat().st_ino)
+        # The served repository was moved to a snapshot.
+        self.assertTrue(self.served.is_symlink())
+        self.assertIn('moved the repository to a snapshot', self.logger.output)
+
+    def test_stage_resume(self):
+        """A stage left over by a failed run is used again."""
+        stage = _get_stage(logging.getLogger(), self.paths)
+        self.assertEqual(stage, _get_stage(logging.getLogger(), self.paths))
+        self.assertIn('resuming changes staged in', self.logger.output)
+
+
+class RecordingReprepro:
+    """A fake Reprepro factory recording commands and output directories."""
+
+    def __init__(self, fail_suites=(), on_execute=None):
+        self.fail_suites = fail_suites
+        self.on_execute = on_execute
+        self.calls = []
+        self.outdirs = []
+
+    def __call__(self, logger, progress=None, outdir=None):
+        self.outdirs.append(outdir)
+        return _RecordingRepreproRun(self)
+
+
+class _RecordingRepreproRun:
+
+    def __init__(self, factory):
+        self._factory = factory
+
+    def execute(self, *args, env=None):
+        self._factory.calls.append(args)
+        if self._factory.on_execute is not None:
+            self._factory.on_execute(args)
+        if 'update' in args and args[-1] in self._factory.fail_suites:
+            raise CalledProcessError(1, ['reprepro'])
+
+
+class FakeConnections:
+
+    rsh = 'ssh'
+
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.opened = []
+
+    def open(self, hosts, logger):
+        self.opened.extend(hosts)
+        return [host for host in hosts if host in self.failing]
+
+
+class RunCycleTest(TestWithFixtures):
+
+    def setUp(self):
+        super().setUp()
+        self.logger = self.useFixture(LoggerFixture())
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+        self.paths = get_paths(root_dir=self.tempdir)
+        self.paths['base'].mkdir(parents=True)
+        (self.paths['static'] / 'ubuntu' / 'pool').mkdir(parents=True)
+        self.config = {
+            'suites': ['xenial', 'bionic'],
+            'upstreams': {
+                'xenial': {'url': 'http://example.com', 'suite': 'xenial'},
+                'bionic': {'url': 'http://example.com', 'suite': 'bionic'}},
+            'ssh-peers': {'1.1.1.1': 'key1', '2.2.2.2': 'key2'},
+        }
+        self.fingerprints = {'xenial': 'x1', 'bionic': 'b1'}
+        self.connections = FakeConnections()
+        self.reprepro = RecordingReprepro()
+        self.sync_results = {}
+        module = 'archive_auth_mirror.scripts.mirror_archive.'
+        self.patch(
+            module + 'get_release_fingerprints',
+            side_effect=lambda *args, **kwargs: dict(self.fingerprints))
+        self.patch(module + 'Reprepro', new=self.reprepro)
+        self.mock_export = self.patch(module + 'export')
+        self.patch(module + 'get_sync_plan', return_value='full')
+        self.patch(module + 'get_delta_sync_plan', return_value='delta')
+        self.mock_run_plans = self.patch(
+            module + 'run_plans', side_effect=self.run_plans)
+
+    def patch(self, target, **kwargs):
+        patcher = mock.patch(target, **kwargs)
+        mocked = patcher.start()
+        self.addCleanup(patcher.stop)
+        return mocked
+
+    def run_plans(self, plans, logger, rsh=None, max_workers=1):
+        return {
+            unit: SyncResult(
+                host=unit, success=self.sync_results.get(unit, True),
+                error=None if self.sync_results.get(unit, True) else b'boom',
+                seconds=1.0, stats=None)
+            for unit in plans}
+
+    def run_cycle(self):
+        return run_cycle(
+            logging.getLogger(), self.paths, self.config, self.connections)
+
+    def set_up_to_date(self, synced=('1.1.1.1', '2.2.2.2')):
+        """Record the current fingerprints and peer units as synced."""
+        save_fingerprints(
+            self.paths['release-fingerprints'], self.fingerprints)
+        self.paths['synced-peers'].write_text(
+            ''.join(unit + '\n' for unit in synced))
+
+    def get_plans(self):
+        """Return the plans passed to run_plans."""
+        self.mock_run_plans.assert_called_once_with(
+            mock.ANY, mock.ANY, rsh='ssh', max_workers=1)
+        return self.mock_run_plans.call_args[0][0]
+
+    def test_nothing_to_do(self):
+        """If nothing changed and peers are in sync, nothing is done."""
+        self.set_up_to_date()
+        result = self.run_cycle()
+        self.assertEqual((False, True), tuple(result))
+        self.assertEqual([], self.reprepro.calls)
+        self.assertEqual([], self.connections.opened)
+        self.mock_run_plans.assert_not_called()
+        self.assertIn('no upstream changes, nothing to do', self.logger.output)
+
+    def test_changed_suites(self):
+        """Only changed suites are updated and exported."""
+        self.set_up_to_date()
+        self.fingerprints['xenial'] = 'x2'
+        result = self.run_cycle()
+        self.assertEqual((True, True), tuple(result))
+        self.assertEqual(
+            [('--show-percent', '--export=never', '--keepunreferencedfiles',
+              'update', 'xenial'),
+             ('deleteunreferenced',)],
+            self.reprepro.calls)
+        self.mock_export.assert_called_once_with(
+            mock.ANY, self.paths, self.config, mock.ANY, ['xenial'],
+            outdir=None)
+        self.assertEqual(
+            {'xenial': 'x2', 'bionic': 'b1'},
+            load_fingerprints(self.paths['release-fingerprints']))
+        # Peer units in sync after the last run only get the changes.
+        self.assertEqual(
+            {'1.1.1.1': 'delta', '2.2.2.2': 'delta'}, self.get_plans())
+        self.assertEqual(['1.1.1.1', '2.2.2.2'], self.connections.opened)
+        self.assertEqual(
+            '1.1.1.1\n2.2.2.2\n', self.paths['synced-peers'].read_text())
+
+    def test_failed_suite(self):
+        """Failed suites are attempted again at the next run."""
+        self.reprepro.fail_suites = ['bionic']
+        result = self.run_cycle()
+        self.assertEqual((True, False), tuple(result))
+        self.assertEqual(
+            {'xenial': 'x1'},
+            load_fingerprints(self.paths['release-fingerprints']))
+        self.mock_export.assert_called_once_with(
+            mock.ANY, self.paths, self.config, mock.ANY,
+            ['xenial', 'bionic'], outdir=None)
+        # Peer units get the suites which were updated.
+        self.assertEqual(
+            {'1.1.1.1': 'full', '2.2.2.2': 'full'}, self.get_plans())
+        self.assertIn('failed to update suites: bionic', self.logger.output)
+        self.assertIn('mirroring completed with errors', self.logger.output)
+
+    def test_peers_not_synced(self):
+        """Peer units not in sync are synced even without changes."""
+        self.set_up_to_date(synced=['1.1.1.1'])
+        result = self.run_cycle()
+        self.assertEqual((False, True), tuple(result))
+        self.assertEqual([('deleteunreferenced',)], self.reprepro.calls)
+        self.mock_export.assert_not_called()
+        # Only units which were not in sync get the whole repository.
+        self.assertEqual(
+            {'1.1.1.1': 'delta', '2.2.2.2': 'full'}, self.get_plans())
+        self.assertIn(
+            'no upstream changes, syncing peer units only', self.logger.output)
+
+    def test_sync_failure(self):
+        """Units failing to sync are marked unhealthy and not in sync."""
+        self.sync_results['2.2.2.2'] = False
+        result = self.run_cycle()
+        self.assertTrue(result.success)
+        self.assertEqual('1.1.1.1\n', self.paths['synced-peers'].read_text())
+        health = PeerHealth(self.paths['peer-health'])
+        self.assertIsNone(health.status('1.1.1.1'))
+        self.assertEqual('boom', health.status('2.2.2.2').error)
+
+    def test_unhealthy_peer_skipped(self):
+        """Unhealthy peer units are skipped until their probe delay is over."""
+        health = PeerHealth(self.paths['peer-health'])
+        health.mark_failed('2.2.2.2', 'unreachable')
+        health.save()
+        self.set_up_to_date(synced=['1.1.1.1'])
+        result = self.run_cycle()
+        # The skipped unit doesn't force a run.
+        self.assertEqual((False, True), tuple(result))
+        self.mock_run_plans.assert_not_called()
+        self.assertIn(
+            'skipping unhealthy peer units: 2.2.2.2', self.logger.output)
+
+    def test_connection_failure(self):
+        """Units which can't be connected are not synced."""
+        self.connections.failing = ['2.2.2.2']
+        self.run_cycle()
+        self.assertEqual({'1.1.1.1': 'full'}, self.get_plans())
+        health = PeerHealth(self.paths['peer-health'])
+        self.assertEqual(
+            'cannot open ssh connection', health.status('2.2.2.2').error)
+        self.assertEqual('1.1.1.1\n', self.paths['synced-peers'].read_text())
+
+    def test_reprepro_failure(self):
+        """If reprepro fails, the run fails."""
+
+        def on_execute(args):
+            if args == ('deleteunreferenced',):
+                raise CalledProcessError(1, ['reprepro'])
+
+        self.reprepro.on_execute = on_execute
+        result = self.run_cycle()
+        self.assertEqual((True, False), tuple(result))
+        self.mock_run_plans.assert_not_called()
+        self.assertIn('mirroring failed', self.logger.output)
+        # No unit is in sync with the changed repository.
+        self.assertEqual('', self.paths['synced-peers'].read_text())
+
+    def test_push_mode_withdraws_generation(self):
+        """In push mode, a generation left by pull mode is removed."""
+        write_generation(
+            self.paths['generation'], Generation(number=1, dists=None))
+        self.set_up_to_date()
+        self.run_cycle()
+        self.assertIsNone(read_generation(self.paths['generation']))
+
+    def test_pull_mode(self):
+        """In pull mode, a new generation is published for peer units."""
+        self.config['replication-mode'] = 'pull'
+        generations = []
+        self.reprepro.on_execute = lambda args: generations.append(
+            read_generation(self.paths['generation']))
+        write_generation(
+            self.paths['generation'], Generation(number=1, dists=None))
+        save_fingerprints(
+            self.paths['release-fingerprints'], {'xenial': 'x1'})
+        result = self.run_cycle()
+        self.assertEqual((True, True), tuple(result))
+        # The generation is withdrawn while the repository changes.
+        self.assertEqual([None, None], generations)
+        self.assertGreater(read_generation(self.paths['generation']).number, 1)
+        self.assertEqual([], self.connections.opened)
+        self.mock_run_plans.assert_not_called()
+
+    def test_pull_mode_up_to_date(self):
+        """In pull mode, peer units in sync are not tracked."""
+        self.config['replication-mode'] = 'pull'
+        self.set_up_to_date(synced=[])
+        write_generation(
+            self.paths['generation'], Generation(number=1, dists=None))
+        result = self.run_cycle()
+        self.assertEqual((False, True), tuple(result))
+        self.assertEqual([], self.reprepro.calls)
+        self.assertEqual(
+            Generation(number=1, dists=None),
+            read_generation(self.paths['generation']))
+
+    def test_pull_mode_no_generation(self):
+        """In pull mode, a generation is published if there's none."""
+        self.config['replication-mode'] = 'pull'
+        self.set_up_to_date()
+        result = self.run_cycle()
+        self.assertEqual((False, True), tuple(result))
+        self.assertIsNotNone(read_generation(self.paths['generation']))
+
+    def test_snapshot_staging(self):
+        """With snapshot staging, changes are published at once."""
+        self.config['snapshot-staging'] = True
+        result = self.run_cycle()
+        self.assertTrue(result.success)
+        served = self.paths['static'] / 'ubuntu'
+        self.assertTrue(served.is_symlink())
+        stage = self.paths['snapshots'] / get_published(served)
+        self.assertEqual({stage.with_name('.new-' + stage.name)},
+                         set(self.reprepro.outdirs))
+        self.mock_export.assert_called_once_with(
+            mock.ANY, self.paths, self.config, mock.ANY,
+            ['xenial', 'bionic'], outdir=stage.with_name('.new-' + stage.name))
+
+    def test_stage_resumed(self):
+        """Changes staged by a failed run are published, even if unchanged."""
+        self.set_up_to_date()
+        served = self.paths['static'] / 'ubuntu'
+        stage = create_generation(served, self.paths['snapshots'])
+        result = self.run_cycle()
+        self.assertEqual((False, True), tuple(result))
+        self.assertEqual([stage], self.reprepro.outdirs)
+        self.assertEqual([('deleteunreferenced',)], self.reprepro.calls)
+        self.assertEqual(stage.name[len('.new-'):], get_published(served))
+        self.assertIn('resuming changes staged in', self.logger.output)
+
+
+class MainTest(TestWithFixtures):
+
+    def setUp(self):
+        super().setUp()
+        self.logger = self.useFixture(LoggerFixture())
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+        module = 'archive_auth_mirror.scripts.mirror_archive.'
+        patches = {
+            'get_paths': get_paths(root_dir=self.tempdir),
+            'get_config': {'suites': []},
+            'setup_logger': logging.getLogger(),
+        }
+        for name, value in patches.items():
+            self.patch(module + name, return_value=value)
+        self.connections = self.patch(module + 'ConnectionPool').return_value
+        self.lockfile = self.patch(module + 'LockFile').return_value
+        self.mock_run_cycle = self.patch(module + 'run_cycle')
+        self.patch('sys.argv', new=['mirror-archive'])
+
+    def patch(self, target, **kwargs):
+        patcher = mock.patch(target, **kwargs)
+        mocked = patcher.start()
+        self.addCleanup(patcher.stop)
+        return mocked
+
+    def test_main(self):
+        """A single cycle is run, and resources are released."""
+        self.mock_run_cycle.return_value.success = True
+        main()
+        self.mock_run_cycle.assert_called_once_with(
+            mock.ANY, mock.ANY, {'suites': []}, self.connections)
+        self.connections.close.assert_called_once_with()
+        self.lockfile.release.assert_called_once_with()
+
+    def test_main_failure(self):
+        """If the cycle fails, the process exits with an error."""
+        self.mock_run_cycle.return_value.success = False
+        with self.assertRaises(SystemExit) as context:
+            main()
+        self.assertEqual(1, context.exception.code)
+        self.connections.close.assert_called_once_with()
+        self.lockfile.release.assert_called_once_with()
+
+    def test_main_locked(self):
+        """If another process is running, nothing is done."""
+        self.lockfile.lock.side_effect = AlreadyLocked()
+        with self.assertRaises(SystemExit) as context:
+            main()
+        self.assertEqual(1, context.exception.code)
+        self.mock_run_cycle.assert_not_called()
+        self.assertIn('another process is already running', self.logger.output)
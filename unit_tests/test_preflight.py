@@ -0,0 +1,176 @@
+import base64
+import hashlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import logging
+from pathlib import Path
+import shutil
+import tempfile
+import threading
+import unittest
+from urllib.error import HTTPError
+
+from fixtures import TestWithFixtures, LoggerFixture
+
+from archive_auth_mirror.preflight import (
+    changed_suites,
+    fetch_release,
+    get_release_fingerprints,
+    load_fingerprints,
+    save_fingerprints,
+)
+
+
+class FakeArchive:
+    """A local HTTP server serving fixture archive files."""
+
+    def __init__(self, files, credentials=None):
+        self.files = files
+        self.credentials = credentials
+        archive = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if archive.credentials is not None:
+                    expected = 'Basic ' + base64.b64encode(
+                        archive.credentials.encode('utf8')).decode('ascii')
+                    if self.headers.get('Authorization') != expected:
+                        self.send_error(401)
+                        return
+                content = archive.files.get(self.path)
+                if content is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+
+    def url(self, credentials=''):
+        if credentials:
+            credentials += '@'
+        return 'http://{}127.0.0.1:{}/ubuntu'.format(
+            credentials, self.server.server_port)
+
+    def start(self):
+        thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={'poll_interval': 0.01})
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ArchiveTestMixin:
+
+    def make_archive(self, files, credentials=None):
+        archive = FakeArchive(files, credentials=credentials)
+        archive.start()
+        self.addCleanup(archive.stop)
+        return archive
+
+
+class FetchReleaseTest(ArchiveTestMixin, unittest.TestCase):
+
+    def test_inrelease(self):
+        """The InRelease file is returned if available."""
+        archive = self.make_archive({
+            '/ubuntu/dists/xenial/InRelease': b'inrelease',
+            '/ubuntu/dists/xenial/Release': b'release'})
+        self.assertEqual(b'inrelease', fetch_release(archive.url(), 'xenial'))
+
+    def test_release(self):
+        """If there's no InRelease file, the Release file is returned."""
+        archive = self.make_archive({
+            '/ubuntu/dists/xenial/Release': b'release'})
+        self.assertEqual(b'release', fetch_release(archive.url(), 'xenial'))
+
+    def test_not_found(self):
+        """If no release file is found, an error is raised."""
+        archive = self.make_archive({})
+        with self.assertRaises(HTTPError) as context_manager:
+            fetch_release(archive.url(), 'xenial')
+        self.assertEqual(404, context_manager.exception.code)
+
+    def test_credentials(self):
+        """Credentials in the URL are used for basic authentication."""
+        archive = self.make_archive(
+            {'/ubuntu/dists/xenial/InRelease': b'inrelease'},
+            credentials='user:p@ss')
+        self.assertEqual(
+            b'inrelease',
+            fetch_release(archive.url(credentials='user:p%40ss'), 'xenial'))
+
+
+class GetReleaseFingerprintsTest(ArchiveTestMixin, TestWithFixtures):
+
+    def setUp(self):
+        super().setUp()
+        self.logger = self.useFixture(LoggerFixture())
+
+    def test_fingerprints(self):
+        """Fingerprints of upstream releases are returned by suite."""
+        archive = self.make_archive({
+            '/ubuntu/dists/xenial/InRelease': b'xenial',
+            '/ubuntu/dists/bionic/InRelease': b'bionic'})
+        upstreams = {
+            'xenial-updates': {'url': archive.url(), 'suite': 'xenial'},
+            'bionic': {'url': archive.url(), 'suite': 'bionic'}}
+        fingerprints = get_release_fingerprints(
+            upstreams, logging.getLogger(), salt=b'salt')
+        self.assertEqual(
+            {'xenial-updates': hashlib.sha256(b'saltxenial').hexdigest(),
+             'bionic': hashlib.sha256(b'saltbionic').hexdigest()},
+            fingerprints)
+
+    def test_fetch_error(self):
+        """If the release can't be fetched, the fingerprint is None."""
+        archive = self.make_archive({})
+        upstreams = {'xenial': {'url': archive.url(), 'suite': 'xenial'}}
+        fingerprints = get_release_fingerprints(
+            upstreams, logging.getLogger())
+        self.assertEqual({'xenial': None}, fingerprints)
+        self.assertIn(
+            'cannot fetch upstream release for xenial: ', self.logger.output)
+
+
+class ChangedSuitesTest(unittest.TestCase):
+
+    def test_changed_suites(self):
+        """Suites with new, changed or unknown fingerprints are returned."""
+        suites = ['xenial', 'bionic', 'focal', 'jammy']
+        fingerprints = {'xenial': 'aaa', 'bionic': 'bbb', 'focal': None}
+        previous = {'xenial': 'aaa', 'bionic': 'ccc', 'focal': 'ddd'}
+        self.assertEqual(
+            ['bionic', 'focal', 'jammy'],
+            changed_suites(suites, fingerprints, previous))
+
+    def test_no_changes(self):
+        """If no fingerprint changed, no suite is returned."""
+        fingerprints = {'xenial': 'aaa'}
+        self.assertEqual(
+            [], changed_suites(['xenial'], fingerprints, fingerprints))
+
+
+class FingerprintsFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+
+    def test_load_not_existent(self):
+        """If the file doesn't exist, no fingerprints are returned."""
+        self.assertEqual({}, load_fingerprints(self.tempdir / 'not-here'))
+
+    def test_save_and_load(self):
+        """Saved fingerprints can be loaded back."""
+        path = self.tempdir / 'fingerprints.json'
+        save_fingerprints(path, {'xenial': 'aaa'})
+        self.assertEqual({'xenial': 'aaa'}, load_fingerprints(path))
@@ -0,0 +1,215 @@
+import logging
+from pathlib import Path
+import shutil
+import tempfile
+from unittest import mock
+
+from fixtures import LoggerFixture, TestWithFixtures
+
+from archive_auth_mirror.replication import (
+    Generation,
+    read_generation,
+    write_generation,
+)
+from archive_auth_mirror.rsync import SyncResult, TransferStats
+from archive_auth_mirror.scripts.pull_archive import pull
+from archive_auth_mirror.utils import get_paths
+
+
+class FakeConnections:
+
+    rsh = 'ssh'
+
+    def __init__(self):
+        self.opened = []
+
+    def open(self, hosts, logger):
+        self.opened.extend(hosts)
+        return []
+
+
+class PullTest(TestWithFixtures):
+
+    def setUp(self):
+        super().setUp()
+        self.logger = self.useFixture(LoggerFixture())
+        tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(tempdir))
+        self.paths = get_paths(root_dir=tempdir)
+        self.paths['base'].mkdir(parents=True)
+        self.connections = FakeConnections()
+        self.remote_generations = {}
+        patcher = mock.patch(
+            'archive_auth_mirror.scripts.pull_archive.fetch_generation',
+            side_effect=self.fetch_generation)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sync_patcher = mock.patch(
+            'archive_auth_mirror.rsync.SyncPlan.sync')
+        self.mock_sync = self.sync_patcher.start()
+        self.addCleanup(mock.patch.stopall)
+        self.mock_sync.side_effect = lambda host, logger, rsh, pull: (
+            SyncResult(host=host, success=host != 'dead', error=None,
+                       seconds=1.0, stats=None))
+
+    def fetch_generation(self, host, path, rsh):
+        return self.remote_generations.get(host)
+
+    def test_up_to_date(self):
+        """If the generation didn't change, nothing is pulled."""
+        write_generation(
+            self.paths['generation'], Generation(number=42, dists='1234'))
+        self.remote_generations['leader'] = Generation(
+            number=42, dists='1234')
+        self.assertTrue(
+            pull(logging.getLogger(), self.paths, ['leader'],
+                 self.connections))
+        self.mock_sync.assert_not_called()
+
+    def test_pull(self):
+        """A new generation is pulled and recorded."""
+        self.remote_generations['leader'] = Generation(
+            number=43, dists='1234')
+        self.assertTrue(
+            pull(logging.getLogger(), self.paths, ['leader'],
+                 self.connections))
+        self.mock_sync.assert_called_once_with(
+            'leader', mock.ANY, rsh='ssh', pull=True)
+        self.assertEqual(
+            Generation(number=43, dists='1234'),
+            read_generation(self.paths['generation']))
+        self.assertTrue(self.paths['metrics'].exists())
+
+    @mock.patch('archive_auth_mirror.scripts.pull_archive.get_sync_plan')
+    def test_pull_dists(self, mock_get_sync_plan):
+        """The dists generation published by the source is pulled."""
+        mock_get_sync_plan.return_value.sync.return_value = SyncResult(
+            host='leader', success=True, error=None, seconds=1.0, stats=None)
+        self.remote_generations['leader'] = Generation(
+            number=43, dists='1234')
+        pull(logging.getLogger(), self.paths, ['leader'], self.connections)
+        mock_get_sync_plan.assert_called_once_with(
+            self.paths, dists='1234', check=mock.ANY)
+
+    def test_fallback(self):
+        """If pulling from a source fails, the next one is used."""
+        generation = Generation(number=43, dists='1234')
+        self.remote_generations.update(
+            {'dead': generation, 'leader': generation})
+        self.assertTrue(
+            pull(logging.getLogger(), self.paths, ['dead', 'leader'],
+                 self.connections))
+        self.assertEqual(['dead', 'leader'], self.connections.opened)
+        self.assertEqual(
+            generation, read_generation(self.paths['generation']))
+
+    def test_no_generation(self):
+        """Sources which haven't published a generation are skipped."""
+        self.assertFalse(
+            pull(logging.getLogger(), self.paths, ['leader'],
+                 self.connections))
+        self.assertIn('no generation published by leader', self.logger.output)
+        self.mock_sync.assert_not_called()
+
+    def test_changed_during_pull(self):
+        """If the source changes during the pull, it's not recorded."""
+        self.remote_generations['leader'] = Generation(
+            number=43, dists='1234')
+
+        def sync(host, logger, rsh, pull):
+            self.remote_generations['leader'] = Generation(
+                number=44, dists='5678')
+            return SyncResult(
+                host=host, success=True, error=None, seconds=1.0, stats=None)
+
+        self.mock_sync.side_effect = sync
+        self.assertTrue(
+            pull(logging.getLogger(), self.paths, ['leader'],
+                 self.connections))
+        self.assertIsNone(read_generation(self.paths['generation']))
+
+    @mock.patch('archive_auth_mirror.rsync.run_command')
+    @mock.patch('archive_auth_mirror.rsync.rsync_trees')
+    def test_leader_run_during_pull(self, mock_rsync_trees, mock_run_command):
+        """Old files are not deleted if the leader runs during the pull."""
+        # Plans are run for real, only rsync and commands are mocked.
+        self.sync_patcher.stop()
+        self.remote_generations['leader'] = Generation(
+            number=43, dists='1234')
+
+        def rsync_trees(*args, **kwargs):
+            # The leader withdraws its generation before changing anything.
+            self.remote_generations['leader'] = None
+            return TransferStats(files=0, bytes=0)
+
+        mock_rsync_trees.side_effect = rsync_trees
+        self.assertTrue(
+            pull(logging.getLogger(), self.paths, ['leader'],
+                 self.connections))
+        self.assertNotIn(
+            True, [call[1].get('delete') for call in
+                   mock_rsync_trees.call_args_list])
+        self.assertIsNone(read_generation(self.paths['generation']))
+        self.assertIn(
+            'leader changed during the pull, old files kept',
+            self.logger.output)
+
+    def test_pull_withdraws_generation(self):
+        """The local generation is withdrawn until the pull completes."""
+        write_generation(
+            self.paths['generation'], Generation(number=42, dists='1234'))
+        self.remote_generations['leader'] = Generation(
+            number=43, dists='5678')
+        during_sync = []
+
+        def sync(host, logger, rsh, pull):
+            during_sync.append(read_generation(self.paths['generation']))
+            return SyncResult(
+                host=host, success=False, error='failed', seconds=1.0,
+                stats=None)
+
+        self.mock_sync.side_effect = sync
+        self.assertFalse(
+            pull(logging.getLogger(), self.paths, ['leader'],
+                 self.connections))
+        self.assertEqual([None], during_sync)
+        # After a failure, the repository is pulled again at the next run.
+        self.assertIsNone(read_generation(self.paths['generation']))
+
+    def test_child_pull_during_parent_pull(self):
+        """A unit doesn't pull from a parent unit which is pulling."""
+        self.remote_generations['leader'] = Generation(
+            number=43, dists='5678')
+        write_generation(
+            self.paths['generation'], Generation(number=42, dists='1234'))
+        child_paths = get_paths(root_dir=self.paths['base'] / 'child')
+        child_paths['base'].mkdir(parents=True)
+        write_generation(
+            child_paths['generation'], Generation(number=41, dists='1111'))
+        child_results = []
+
+        def sync(host, logger, **kwargs):
+            if host == 'leader':
+                # The child unit runs while this unit pulls from the leader.
+                self.remote_generations['parent'] = read_generation(
+                    self.paths['generation'])
+                child_results.append(
+                    pull(logger, child_paths, ['parent'], self.connections))
+            return SyncResult(
+                host=host, success=True, error=None, seconds=1.0, stats=None)
+
+        self.mock_sync.side_effect = sync
+        self.assertTrue(
+            pull(logging.getLogger(), self.paths, ['leader'],
+                 self.connections))
+        # The child found no generation to pull from its parent, and left
+        # its own repository untouched.
+        self.assertEqual([False], child_results)
+        self.assertEqual(1, self.mock_sync.call_count)
+        self.assertEqual(
+            Generation(number=41, dists='1111'),
+            read_generation(child_paths['generation']))
+        self.assertIn('no generation published by parent', self.logger.output)
+        self.assertEqual(
+            Generation(number=43, dists='5678'),
+            read_generation(self.paths['generation']))
@@ -0,0 +1,145 @@
+from pathlib import Path
+import shutil
+import subprocess
+import tempfile
+from unittest import mock, TestCase
+
+from archive_auth_mirror.replication import (
+    Generation,
+    bump_generation,
+    fetch_generation,
+    get_pull_sources,
+    invalidate_generation,
+    read_generation,
+    write_generation,
+)
+
+
+class GenerationTest(TestCase):
+
+    def setUp(self):
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+        self.path = self.tempdir / 'generation.json'
+
+    def test_read_not_existent(self):
+        """If the marker file doesn't exist, there's no generation."""
+        self.assertIsNone(read_generation(self.path))
+
+    def test_read_invalid(self):
+        """Invalid marker files are ignored."""
+        self.path.write_text('garbage')
+        self.assertIsNone(read_generation(self.path))
+
+    def test_write(self):
+        """The generation is written to the marker file."""
+        write_generation(self.path, Generation(number=42, dists='1234'))
+        self.assertEqual(
+            Generation(number=42, dists='1234'), read_generation(self.path))
+
+    def test_read_without_dists(self):
+        """Markers may not have a dists generation."""
+        self.path.write_text('{"generation": 42}')
+        self.assertEqual(
+            Generation(number=42, dists=None), read_generation(self.path))
+
+    def test_bump(self):
+        """Generations are based on the current time."""
+        self.assertEqual(
+            Generation(number=1500000000000, dists='1234'),
+            bump_generation(self.path, dists='1234', now=lambda: 1.5e9))
+        self.assertEqual(
+            Generation(number=1500000000000, dists='1234'),
+            read_generation(self.path))
+
+    def test_bump_increasing(self):
+        """Generations always increase."""
+        write_generation(
+            self.path, Generation(number=1500000000000, dists=None))
+        self.assertEqual(
+            Generation(number=1500000000001, dists=None),
+            bump_generation(self.path, now=lambda: 1.4e9))
+
+    def test_invalidate(self):
+        """Invalidated generations are not published anymore."""
+        write_generation(self.path, Generation(number=42, dists=None))
+        invalidate_generation(self.path)
+        self.assertIsNone(read_generation(self.path))
+        # Nothing fails if there's no generation.
+        invalidate_generation(self.path)
+
+
+class FetchGenerationTest(TestCase):
+
+    @mock.patch('subprocess.check_output')
+    def test_fetch(self, mock_check_output):
+        """The generation published by a remote host is returned."""
+        mock_check_output.return_value = (
+            b'{"generation": 42, "dists": "1234"}\n')
+        self.assertEqual(
+            Generation(number=42, dists='1234'),
+            fetch_generation(
+                '1.2.3.4', Path('/srv/generation.json'), 'ssh -i key'))
+        mock_check_output.assert_called_once_with(
+            ['ssh', '-i', 'key', '1.2.3.4',
+             'cat /srv/generation.json 2>/dev/null || true'],
+            stdin=subprocess.DEVNULL)
+
+    @mock.patch('subprocess.check_output')
+    def test_fetch_not_published(self, mock_check_output):
+        """If the remote host has no generation, None is returned."""
+        mock_check_output.return_value = b''
+        self.assertIsNone(fetch_generation(
+            '1.2.3.4', Path('/srv/generation.json'), 'ssh'))
+
+
+class GetPullSourcesTest(TestCase):
+
+    units = ['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4', '10.0.0.5']
+
+    def test_leader(self):
+        """The leader doesn't pull from anyone."""
+        self.assertEqual(
+            [], get_pull_sources('10.0.0.1', self.units, '10.0.0.1'))
+
+    def test_no_leader(self):
+        """Without a leader, there's nothing to pull from."""
+        self.assertEqual([], get_pull_sources(None, self.units, '10.0.0.2'))
+
+    def test_no_fanout(self):
+        """Without a fanout, all units pull from the leader."""
+        for unit in self.units[1:]:
+            self.assertEqual(
+                ['10.0.0.1'], get_pull_sources('10.0.0.1', self.units, unit))
+
+    def test_chain(self):
+        """With a fanout of 1, units pull from the previous one."""
+        sources = [
+            get_pull_sources('10.0.0.1', self.units, unit, fanout=1)
+            for unit in self.units[1:]]
+        self.assertEqual(
+            [['10.0.0.1'],
+             ['10.0.0.2', '10.0.0.1'],
+             ['10.0.0.3', '10.0.0.1'],
+             ['10.0.0.4', '10.0.0.1']],
+            sources)
+
+    def test_tree(self):
+        """Units form a tree, with the leader as fallback source."""
+        sources = [
+            get_pull_sources('10.0.0.1', self.units, unit, fanout=2)
+            for unit in self.units[1:]]
+        self.assertEqual(
+            [['10.0.0.1'],
+             ['10.0.0.1'],
+             ['10.0.0.2', '10.0.0.1'],
+             ['10.0.0.2', '10.0.0.1']],
+            sources)
+
+    def test_unit_not_in_units(self):
+        """The unit itself doesn't need to be in the list of units."""
+        self.assertEqual(
+            ['10.0.0.4', '10.0.0.1'],
+            get_pull_sources(
+                '10.0.0.1', ['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4'],
+                '10.0.0.5', fanout=1))
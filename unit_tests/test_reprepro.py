@@ -7,7 +7,7 @@ from subprocess import CalledProcessError
 
 from fixtures import TestWithFixtures, LoggerFixture
 
-from archive_auth_mirror.reprepro import Reprepro
+from archive_auth_mirror.reprepro import ProgressEvent, Reprepro
 
 
 class RepreproTest(TestWithFixtures):
@@ -16,6 +16,16 @@ class RepreproTest(TestWithFixtures):
         super().setUp()
         self.logger = self.useFixture(LoggerFixture(level=logging.DEBUG))
 
+    def make_binary(self, content):
+        """Create an executable script with the given content."""
+        fd, name = tempfile.mkstemp()
+        os.close(fd)
+        binary = Path(name)
+        self.addCleanup(binary.unlink)
+        binary.write_text(textwrap.dedent(content))
+        binary.chmod(0o700)
+        return binary
+
     def test_execute(self):
         """The execute function calls reprepro with the specified args."""
         reprepro = Reprepro(logging.getLogger(''), binary='/bin/echo')
@@ -34,6 +44,23 @@ class RepreproTest(TestWithFixtures):
             'export ubuntu\n',
             self.logger.output)
 
+    def test_execute_outdir(self):
+        """Files can be written to a different output directory."""
+        reprepro = Reprepro(
+            logging.getLogger(''), binary='/bin/echo', outdir=Path('/stage'))
+        reprepro.execute('export', 'ubuntu')
+        self.assertIn(' --outdir /stage ', self.logger.output)
+
+    def test_execute_env(self):
+        """The command environment can be specified."""
+        binary = self.make_binary("""\
+            #!/bin/sh
+            echo "value: $TEST_VAR"
+            """)
+        reprepro = Reprepro(logging.getLogger(''), binary=str(binary))
+        reprepro.execute('export', env={'TEST_VAR': 'foo'})
+        self.assertIn(' value: foo\n', self.logger.output)
+
     def test_execute_fail(self):
         """If the command fails, an exception is raised."""
         reprepro = Reprepro(logging.getLogger(''), binary='/bin/false')
@@ -50,19 +77,56 @@ class RepreproTest(TestWithFixtures):
 
     def test_execute_log_error(self):
         """If the command fails, stderr is logged."""
-        fd, name = tempfile.mkstemp()
-        os.close(fd)
-        binary = Path(name)
-        self.addCleanup(binary.unlink)
-        binary.write_text(
-            textwrap.dedent(
-                '''#!/bin/sh
-                echo fail >&2
-                exit 1
-                '''))
-        binary.chmod(0o700)
+        binary = self.make_binary(
+            '''#!/bin/sh
+            echo fail >&2
+            exit 1
+            ''')
 
         reprepro = Reprepro(logging.getLogger(''), binary=str(binary))
         with self.assertRaises(CalledProcessError):
             reprepro.execute('export', 'ubuntu')
         self.assertIn('fail\n', self.logger.output)
+
+    def test_execute_stream_output(self):
+        """Both stdout and stderr are logged as they are written."""
+        binary = self.make_binary(
+            '''#!/bin/sh
+            echo out1
+            echo err1 >&2
+            echo out2
+            ''')
+        reprepro = Reprepro(logging.getLogger(''), binary=str(binary))
+        reprepro.execute('export')
+        lines = self.logger.output.splitlines()[1:]
+        self.assertEqual([' err1', ' out1', ' out2'], sorted(lines))
+
+    def test_execute_large_stderr(self):
+        """Large output on stderr doesn't block the process."""
+        binary = self.make_binary(
+            '''#!/bin/sh
+            seq 1 20000 >&2
+            echo done
+            ''')
+        reprepro = Reprepro(logging.getLogger(''), binary=str(binary))
+        reprepro.execute('export')
+        self.assertIn(' 20000\n', self.logger.output)
+        self.assertIn(' done\n', self.logger.output)
+
+    def test_execute_progress(self):
+        """Percentages in the output are reported as progress events."""
+        binary = self.make_binary(
+            '''#!/bin/sh
+            printf 'Getting packages  10%%\\r Getting packages  55%%\\r'
+            echo 'Getting packages 100%'
+            echo 'no progress here'
+            ''')
+        events = []
+        reprepro = Reprepro(
+            logging.getLogger(''), binary=str(binary), progress=events.append)
+        reprepro.execute('update')
+        self.assertEqual(
+            [ProgressEvent(percent=10, message='Getting packages  10%'),
+             ProgressEvent(percent=55, message='Getting packages  55%'),
+             ProgressEvent(percent=100, message='Getting packages 100%')],
+            events)
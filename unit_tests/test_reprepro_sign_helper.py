@@ -0,0 +1,57 @@
+from pathlib import Path
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+from unittest import TestCase
+
+import archive_auth_mirror
+
+LIB_DIR = str(Path(archive_auth_mirror.__file__).parent.parent)
+
+# Run the helper without site packages, like the installed script does.
+HELPER_SCRIPT = textwrap.dedent('''\
+    import sys
+    import types
+    sys.path.insert(0, {lib_dir!r})
+    from pathlib import Path
+    from unittest import mock
+    from archive_auth_mirror import utils
+    from archive_auth_mirror.scripts import reprepro_sign_helper as helper
+
+    paths = utils.get_paths(root_dir=Path({root_dir!r}))
+    # GPG support is not under test.
+    gpg = types.ModuleType('archive_auth_mirror.gpg')
+    gpg.Signer = mock.Mock()
+    sys.modules['archive_auth_mirror.gpg'] = gpg
+    argv = ['reprepro-sign-helper', 'Release', 'InRelease', 'Release.gpg']
+    with mock.patch.object(utils, 'get_paths', return_value=paths), \\
+            mock.patch.object(helper, 'get_paths', return_value=paths), \\
+            mock.patch.object(helper, 'setup_logger'), \\
+            mock.patch.object(helper, 'sign_release') as sign_release, \\
+            mock.patch.object(sys, 'argv', argv):
+        helper.main()
+    gpg.Signer.assert_called_once_with('AABBCC')
+    print(sign_release.call_args[1]['packages_require_auth'])
+    ''')
+
+
+class MainTest(TestCase):
+
+    def setUp(self):
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+        self.base_dir = self.tempdir / 'srv' / 'archive-auth-mirror'
+        self.base_dir.mkdir(parents=True)
+
+    def test_main_yaml_config(self):
+        """Without a config snapshot, the YAML config is loaded."""
+        (self.base_dir / 'config.yaml').write_text(
+            'sign-key-id: AABBCC\npackages-require-auth: true\n')
+        script = HELPER_SCRIPT.format(
+            lib_dir=LIB_DIR, root_dir=str(self.tempdir))
+        output = subprocess.check_output(
+            [sys.executable, '-S', '-c', script], stderr=subprocess.STDOUT)
+        self.assertEqual(b'True\n', output)
+        self.assertFalse((self.base_dir / 'config.json').exists())
@@ -1,79 +1,278 @@
 from pathlib import Path
 import logging
+import shutil
+import subprocess
+import tempfile
 from subprocess import CalledProcessError
 from unittest import TestCase, mock
 
 from fixtures import TestWithFixtures, LoggerFixture
 
-from archive_auth_mirror.rsync import rsync, rsync_multi
+from archive_auth_mirror.rsync import (
+    rsync_files,
+    rsync_trees,
+    run_plans,
+    SyncPlan,
+    TransferStats,
+)
 
 
-class RsyncTest(TestCase):
+class RsyncTreesTest(TestCase):
 
-    @mock.patch('subprocess.check_output')
-    def test_rsync(self, mock_check_output):
-        """The rsync copies a filesytem tree using rsync."""
-        rsync('1.2.3.4', Path('/foo/bar'))
-        mock_check_output.assert_called_with(
-            ['/usr/bin/rsync', '-a', '/foo/bar/', '1.2.3.4:/foo/bar/'])
+    @mock.patch('subprocess.check_output', return_value=b'')
+    def test_rsync_trees(self, mock_check_output):
+        """rsync_trees copies multiple trees in a single rsync run."""
+        rsync_trees('1.2.3.4', [Path('/foo/bar'), Path('/baz')])
+        mock_check_output.assert_called_once_with(
+            ['/usr/bin/rsync', '-a', '--relative', '--stats', '/foo/bar/',
+             '/baz/', '1.2.3.4:/'])
 
-    @mock.patch('subprocess.check_output')
-    def test_rsync_delete(self, mock_check_output):
-        """If the delete flag is True, the --delete option is passed."""
-        rsync('1.2.3.4', Path('/foo/bar'), delete=True)
-        mock_check_output.assert_called_with(
-            ['/usr/bin/rsync', '-a', '--delete', '/foo/bar/',
-             '1.2.3.4:/foo/bar/'])
+    @mock.patch('subprocess.check_output', return_value=b'')
+    def test_rsync_trees_delete(self, mock_check_output):
+        """If the delete flag is True, files are deleted after transfer."""
+        rsync_trees(
+            '1.2.3.4', [Path('/foo/bar')], rsh='ssh -i my-identity',
+            delete=True)
+        mock_check_output.assert_called_once_with(
+            ['/usr/bin/rsync', '-a', '--relative', '--stats', '--rsh',
+             'ssh -i my-identity', '--delete-after', '/foo/bar/',
+             '1.2.3.4:/'])
+
+    @mock.patch('subprocess.check_output', return_value=b'')
+    def test_rsync_trees_pull(self, mock_check_output):
+        """If the pull flag is True, trees are copied from the host."""
+        rsync_trees('1.2.3.4', [Path('/foo/bar'), Path('/baz')], pull=True)
+        mock_check_output.assert_called_once_with(
+            ['/usr/bin/rsync', '-a', '--relative', '--stats',
+             '1.2.3.4:/foo/bar/', ':/baz/', '/'])
+
+    @mock.patch('subprocess.check_output', return_value=b'')
+    def test_rsync_trees_hard_links(self, mock_check_output):
+        """Hard links can be preserved."""
+        rsync_trees('1.2.3.4', [Path('/foo/bar')], hard_links=True)
+        mock_check_output.assert_called_once_with(
+            ['/usr/bin/rsync', '-a', '--relative', '--stats', '--hard-links',
+             '/foo/bar/', '1.2.3.4:/'])
 
     @mock.patch('subprocess.check_output')
-    def test_rsync_rsh(self, mock_check_output):
-        """If the rsh flag is not None, the --rsh option is passed."""
-        rsync('1.2.3.4', Path('/foo/bar'), rsh='ssh -i my-identity')
-        mock_check_output.assert_called_with(
-            ['/usr/bin/rsync', '-a', '--rsh', 'ssh -i my-identity',
+    def test_rsync_trees_stats(self, mock_check_output):
+        """rsync_trees returns transfer statistics."""
+        mock_check_output.return_value = (
+            b'Number of files: 1,234 (reg: 1,000, dir: 234)\n'
+            b'Number of regular files transferred: 1,002\n'
+            b'Total file size: 9,999,999 bytes\n'
+            b'Total transferred file size: 1,234,567 bytes\n')
+        stats = rsync_trees('1.2.3.4', [Path('/foo/bar')])
+        self.assertEqual(TransferStats(files=1002, bytes=1234567), stats)
+
+
+class RsyncFilesTest(TestCase):
+
+    @mock.patch('subprocess.check_output', return_value=b'')
+    def test_rsync_files(self, mock_check_output):
+        """rsync_files copies only the listed files."""
+        rsync_files('1.2.3.4', Path('/foo/bar'), Path('/files'))
+        mock_check_output.assert_called_once_with(
+            ['/usr/bin/rsync', '-a', '--stats', '--files-from', '/files',
+             '/foo/bar/', '1.2.3.4:/foo/bar/'])
+
+    @mock.patch('subprocess.check_output', return_value=b'')
+    def test_rsync_files_delete(self, mock_check_output):
+        """If the delete flag is True, missing files are deleted."""
+        rsync_files(
+            '1.2.3.4', Path('/foo/bar'), Path('/files'),
+            rsh='ssh -i my-identity', delete=True)
+        mock_check_output.assert_called_once_with(
+            ['/usr/bin/rsync', '-a', '--stats', '--files-from', '/files',
+             '--rsh', 'ssh -i my-identity', '--delete-missing-args',
              '/foo/bar/', '1.2.3.4:/foo/bar/'])
 
 
-class RsyncMultiTest(TestWithFixtures):
+class SyncPlanTest(TestWithFixtures):
 
     def setUp(self):
         super().setUp()
         self.logger = self.useFixture(LoggerFixture())
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+        for name in ('pool', 'dists', 'db'):
+            (self.tempdir / name).mkdir()
 
-    @mock.patch('subprocess.check_output')
-    def test_each_host(self, mock_check_output):
-        """The rsync call is performed for each host."""
-        rsync_multi(
-            ['1.2.3.4', '5.6.7.8'], Path('/foo/bar'), logging.getLogger())
-        mock_check_output.assert_has_calls(
-            [mock.call(
-                ['/usr/bin/rsync', '-a', '/foo/bar/', '1.2.3.4:/foo/bar/']),
-             mock.call(
-                 ['/usr/bin/rsync', '-a', '/foo/bar/', '5.6.7.8:/foo/bar/'])])
+    def make_plan(self):
+        plan = SyncPlan()
+        plan.add_step(self.tempdir / 'pool')
+        plan.add_step(
+            self.tempdir / 'dists', self.tempdir / 'db', delete=True)
+        return plan
+
+    @mock.patch('subprocess.check_output', return_value=b'')
+    def test_steps_in_order(self, mock_check_output):
+        """Steps are run in order for each host."""
+        self.make_plan().run(['1.2.3.4', '5.6.7.8'], logging.getLogger())
+        tempdir = str(self.tempdir)
+        mock_check_output.assert_has_calls([
+            mock.call(
+                ['/usr/bin/rsync', '-a', '--relative', '--stats',
+                 tempdir + '/pool/', '1.2.3.4:/']),
+            mock.call(
+                ['/usr/bin/rsync', '-a', '--relative', '--stats',
+                 '--delete-after', tempdir + '/dists/', tempdir + '/db/',
+                 '1.2.3.4:/']),
+            mock.call(
+                ['/usr/bin/rsync', '-a', '--relative', '--stats',
+                 tempdir + '/pool/', '5.6.7.8:/']),
+            mock.call(
+                ['/usr/bin/rsync', '-a', '--relative', '--stats',
+                 '--delete-after', tempdir + '/dists/', tempdir + '/db/',
+                 '5.6.7.8:/'])])
 
     @mock.patch('subprocess.check_output')
-    def test_log_failures(self, mock_check_output):
-        """If copy to a host fails, it's logged."""
+    def test_failure_skips_host(self, mock_check_output):
+        """If a step fails for a host, later steps are skipped for it."""
 
         def check_output(cmd):
-            if cmd[-1].startswith('1.2.3.4:'):
+            if cmd[-1] == '1.2.3.4:/':
                 raise CalledProcessError(1, cmd, output='something failed')
+            return b''
 
         mock_check_output.side_effect = check_output
-        rsync_multi(
-            ['1.2.3.4', '5.6.7.8'], Path('/foo/bar'), logging.getLogger())
+        results = self.make_plan().run(
+            ['1.2.3.4', '5.6.7.8'], logging.getLogger())
+        self.assertEqual(
+            {'1.2.3.4': ('1.2.3.4', False, 'something failed'),
+             '5.6.7.8': ('5.6.7.8', True, None)},
+            {host: result[:3] for host, result in results.items()})
         self.assertIn(
             'rsync to 1.2.3.4 failed: something failed\n', self.logger.output)
-        # rsync to the second host is exectuted too
+        # only the first step is attempted for the failing host
+        self.assertEqual(3, mock_check_output.call_count)
+
+    @mock.patch('subprocess.check_output', return_value=b'')
+    def test_missing_paths(self, mock_check_output):
+        """Paths that don't exist are skipped."""
+        (self.tempdir / 'pool').rmdir()
+        self.make_plan().run(['1.2.3.4'], logging.getLogger())
+        tempdir = str(self.tempdir)
+        mock_check_output.assert_called_once_with(
+            ['/usr/bin/rsync', '-a', '--relative', '--stats', '--delete-after',
+             tempdir + '/dists/', tempdir + '/db/', '1.2.3.4:/'])
+
+    @mock.patch('subprocess.check_output', return_value=b'')
+    def test_files_step(self, mock_check_output):
+        """Files steps sync only the listed files."""
+        plan = SyncPlan()
+        plan.add_files_step(
+            self.tempdir / 'pool', self.tempdir / 'removed', delete=True)
+        plan.run(['1.2.3.4'], logging.getLogger())
+        tempdir = str(self.tempdir)
+        mock_check_output.assert_called_once_with(
+            ['/usr/bin/rsync', '-a', '--stats', '--files-from',
+             tempdir + '/removed', '--delete-missing-args', tempdir + '/pool/',
+             '1.2.3.4:{}/pool/'.format(tempdir)])
+
+    @mock.patch('subprocess.check_output', return_value=b'')
+    def test_run_plans(self, mock_check_output):
+        """run_plans runs a different plan for each host."""
+        pool_plan = SyncPlan()
+        pool_plan.add_step(self.tempdir / 'pool')
+        dists_plan = SyncPlan()
+        dists_plan.add_step(self.tempdir / 'dists')
+        results = run_plans(
+            {'1.2.3.4': pool_plan, '5.6.7.8': dists_plan},
+            logging.getLogger(), max_workers=2)
+        tempdir = str(self.tempdir)
+        self.assertEqual(2, mock_check_output.call_count)
+        mock_check_output.assert_any_call(
+            ['/usr/bin/rsync', '-a', '--relative', '--stats',
+             tempdir + '/pool/', '1.2.3.4:/'])
         mock_check_output.assert_any_call(
-            ['/usr/bin/rsync', '-a', '/foo/bar/', '5.6.7.8:/foo/bar/'])
+            ['/usr/bin/rsync', '-a', '--relative', '--stats',
+             tempdir + '/dists/', '5.6.7.8:/'])
+        self.assertEqual({'1.2.3.4', '5.6.7.8'}, set(results))
+
+    @mock.patch('subprocess.check_output', return_value=b'')
+    def test_run_plans_concurrent(self, mock_check_output):
+        """Hosts can be synced concurrently."""
+        hosts = ['1.2.3.4', '5.6.7.8', '9.10.11.12']
+        plan = self.make_plan()
+        results = run_plans(
+            {host: plan for host in hosts}, logging.getLogger(),
+            max_workers=3)
+        self.assertEqual(6, mock_check_output.call_count)
+        self.assertEqual(set(hosts), set(results))
+        self.assertTrue(all(result.success for result in results.values()))
 
     @mock.patch('subprocess.check_output')
-    def test_rsh(self, mock_check_output):
-        """The rsh flag is passed through."""
-        rsync_multi(
-            ['1.2.3.4'], Path('/foo/bar'), logging.getLogger(),
-            rsh='ssh -i my-identity')
-        mock_check_output.assert_called_with(
-            ['/usr/bin/rsync', '-a', '--rsh', 'ssh -i my-identity',
-             '/foo/bar/', '1.2.3.4:/foo/bar/'])
+    def test_stats(self, mock_check_output):
+        """Transfer statistics for all steps are summed up."""
+        mock_check_output.return_value = (
+            b'Number of regular files transferred: 2\n'
+            b'Total transferred file size: 100 bytes\n')
+        results = self.make_plan().run(['1.2.3.4'], logging.getLogger())
+        result = results['1.2.3.4']
+        self.assertEqual(TransferStats(files=4, bytes=200), result.stats)
+        self.assertGreaterEqual(result.seconds, 0)
+
+    @mock.patch('subprocess.check_output', return_value=b'')
+    def test_command_step(self, mock_check_output):
+        """Command steps run a command on the host, after previous steps."""
+        plan = SyncPlan()
+        plan.add_step(self.tempdir / 'dists')
+        plan.add_command_step('touch /done')
+        plan.run(['1.2.3.4'], logging.getLogger(), rsh='ssh -i key')
+        self.assertEqual(
+            mock.call(
+                ['ssh', '-i', 'key', '1.2.3.4', 'touch /done'],
+                stdin=subprocess.DEVNULL, stderr=subprocess.STDOUT),
+            mock_check_output.mock_calls[-1])
+
+    @mock.patch('subprocess.check_output', return_value=b'')
+    def test_command_step_pull(self, mock_check_output):
+        """When pulling, commands are run locally."""
+        plan = SyncPlan()
+        plan.add_command_step('touch /done')
+        plan.sync('1.2.3.4', logging.getLogger(), rsh='ssh', pull=True)
+        mock_check_output.assert_called_once_with(
+            ['/bin/sh', '-c', 'touch /done'],
+            stdin=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+
+    @mock.patch('subprocess.check_output')
+    def test_command_step_failure(self, mock_check_output):
+        """If a command fails, later steps are skipped."""
+        mock_check_output.side_effect = CalledProcessError(
+            1, 'cmd', output=b'no such file')
+        plan = SyncPlan()
+        plan.add_command_step('touch /done')
+        plan.add_step(self.tempdir / 'dists')
+        result = plan.sync('1.2.3.4', logging.getLogger())
+        self.assertFalse(result.success)
+        self.assertEqual(b'no such file', result.error)
+        self.assertEqual(1, mock_check_output.call_count)
+        self.assertIn('command on 1.2.3.4 failed', self.logger.output)
+
+    @mock.patch('subprocess.check_output', return_value=b'')
+    def test_check_step(self, mock_check_output):
+        """Check steps are called with the host, between other steps."""
+        check = mock.Mock(return_value=None)
+        plan = SyncPlan()
+        plan.add_step(self.tempdir / 'pool')
+        plan.add_check_step(check)
+        plan.add_step(self.tempdir / 'dists')
+        result = plan.sync('1.2.3.4', logging.getLogger())
+        self.assertTrue(result.success)
+        check.assert_called_once_with('1.2.3.4')
+        self.assertEqual(2, mock_check_output.call_count)
+
+    @mock.patch('subprocess.check_output', return_value=b'')
+    def test_check_step_failure(self, mock_check_output):
+        """If a check fails, later steps are skipped."""
+        plan = SyncPlan()
+        plan.add_step(self.tempdir / 'pool')
+        plan.add_check_step(lambda host: 'source changed')
+        plan.add_step(self.tempdir / 'dists', delete=True)
+        result = plan.sync('1.2.3.4', logging.getLogger(), pull=True)
+        self.assertFalse(result.success)
+        self.assertEqual('source changed', result.error)
+        self.assertEqual(1, mock_check_output.call_count)
+        self.assertIn(
+            'sync from 1.2.3.4 stopped: source changed', self.logger.output)
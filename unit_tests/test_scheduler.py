@@ -0,0 +1,107 @@
+import logging
+from subprocess import CalledProcessError
+
+from fixtures import TestWithFixtures, LoggerFixture
+
+from archive_auth_mirror.reprepro import ProgressEvent
+from archive_auth_mirror.scheduler import (
+    SuiteScheduler,
+    SuiteStatus,
+)
+
+
+class FakeReprepro:
+    """A fake Reprepro factory recording executed commands."""
+
+    def __init__(self, fail_suites=(), progress_events=()):
+        self.fail_suites = fail_suites
+        self.progress_events = progress_events
+        self.calls = []
+
+    def __call__(self, logger, progress=None):
+        return _FakeRepreproRun(self, logger, progress)
+
+
+class _FakeRepreproRun:
+
+    def __init__(self, factory, logger, progress):
+        self._factory = factory
+        self._logger = logger
+        self._progress = progress
+
+    def execute(self, *args):
+        self._factory.calls.append(args)
+        self._logger.info('running update')
+        for percent in self._factory.progress_events:
+            self._progress(ProgressEvent(percent=percent, message=''))
+        if args[-1] in self._factory.fail_suites:
+            raise CalledProcessError(1, ['reprepro'])
+
+
+class SuiteSchedulerTest(TestWithFixtures):
+
+    def setUp(self):
+        super().setUp()
+        self.logger = self.useFixture(LoggerFixture())
+
+    def test_update(self):
+        """Each suite is updated by a separate reprepro run."""
+        reprepro = FakeReprepro()
+        scheduler = SuiteScheduler(
+            logging.getLogger(), reprepro_factory=reprepro)
+        statuses = scheduler.update(['xenial', 'bionic'])
+        self.assertEqual(
+            {'xenial': ('xenial', True, None),
+             'bionic': ('bionic', True, None)},
+            {suite: status[:3] for suite, status in statuses.items()})
+        self.assertIsInstance(statuses['xenial'], SuiteStatus)
+        self.assertGreaterEqual(statuses['xenial'].seconds, 0)
+        options = (
+            '--show-percent', '--export=never', '--keepunreferencedfiles',
+            'update')
+        self.assertEqual(
+            [options + ('xenial',), options + ('bionic',)], reprepro.calls)
+
+    def test_update_failure(self):
+        """A failing suite doesn't prevent others from being updated."""
+        reprepro = FakeReprepro(fail_suites=['xenial'])
+        scheduler = SuiteScheduler(
+            logging.getLogger(), reprepro_factory=reprepro)
+        statuses = scheduler.update(['xenial', 'bionic'])
+        self.assertFalse(statuses['xenial'].success)
+        self.assertIn(
+            'returned non-zero exit status 1', statuses['xenial'].error)
+        self.assertTrue(statuses['bionic'].success)
+        self.assertIn('[xenial] update failed: ', self.logger.output)
+
+    def test_log_prefix(self):
+        """Log messages are prefixed with the suite name."""
+        scheduler = SuiteScheduler(
+            logging.getLogger(), reprepro_factory=FakeReprepro())
+        scheduler.update(['xenial'])
+        self.assertIn('[xenial] running update\n', self.logger.output)
+
+    def test_progress(self):
+        """Progress is logged in steps of 10%, and on completion."""
+        reprepro = FakeReprepro(progress_events=[0, 5, 10, 12, 25, 97, 100])
+        scheduler = SuiteScheduler(
+            logging.getLogger(), reprepro_factory=reprepro)
+        scheduler.update(['xenial'])
+        self.assertEqual(
+            ['[xenial] progress: 0%', '[xenial] progress: 10%',
+             '[xenial] progress: 25%', '[xenial] progress: 97%',
+             '[xenial] progress: 100%'],
+            [line for line in self.logger.output.splitlines()
+             if 'progress' in line])
+
+    def test_progress_restart(self):
+        """A lower percentage starts a new sequence of progress events."""
+        reprepro = FakeReprepro(progress_events=[50, 100, 3, 4])
+        scheduler = SuiteScheduler(
+            logging.getLogger(), reprepro_factory=reprepro)
+        scheduler.update(['xenial'])
+        self.assertEqual(
+            ['[xenial] progress: 50%', '[xenial] progress: 100%',
+             '[xenial] progress: 3%'],
+            [line for line in self.logger.output.splitlines()
+             if 'progress' in line])
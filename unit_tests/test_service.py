@@ -0,0 +1,54 @@
+from pathlib import Path
+from unittest import mock
+
+from charmtest import CharmTest
+
+from archive_auth_mirror.service import install_service, remove_service
+from archive_auth_mirror.utils import get_paths
+
+
+class ServiceTestBase(CharmTest):
+
+    def setUp(self):
+        super().setUp()
+        root_dir = Path(self.fakes.fs.root.path)
+        (root_dir / 'etc/systemd/system').mkdir(parents=True)
+        self.paths = get_paths(root_dir=root_dir)
+        patcher = mock.patch('subprocess.check_call')
+        self.mock_check_call = patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class InstallServiceTest(ServiceTestBase):
+
+    def test_install_service(self):
+        """install_service creates and starts the service."""
+        install_service(paths=self.paths)
+        content = self.paths['service'].read_text()
+        script = self.paths['bin'] / 'mirror-archive'
+        self.assertIn('ExecStart={} --daemon\n'.format(script), content)
+        self.assertEqual(
+            [mock.call(('systemctl', 'daemon-reload')),
+             mock.call(('systemctl', 'enable', 'archive-auth-mirror')),
+             mock.call(('systemctl', 'restart', 'archive-auth-mirror'))],
+            self.mock_check_call.mock_calls)
+
+
+class RemoveServiceTest(ServiceTestBase):
+
+    def test_remove_service(self):
+        """remove_service stops and removes the service."""
+        install_service(paths=self.paths)
+        self.mock_check_call.reset_mock()
+        remove_service(paths=self.paths)
+        self.assertFalse(self.paths['service'].exists())
+        self.assertEqual(
+            [mock.call(
+                ('systemctl', 'disable', '--now', 'archive-auth-mirror')),
+             mock.call(('systemctl', 'daemon-reload'))],
+            self.mock_check_call.mock_calls)
+
+    def test_remove_service_not_existent(self):
+        """If the service file doesn't exist, remove_service no-ops."""
+        remove_service(paths=self.paths)
+        self.mock_check_call.assert_not_called()
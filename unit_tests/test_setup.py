@@ -159,6 +159,13 @@ class InstallResourcesTests(CharmTest):
         # the file ownership is changed to the gid for www-data
         self.mock_fchown.assert_any_call(mock.ANY, 0, 123)
 
+    @mock.patch('compileall.compile_dir')
+    def test_compile(self, mock_compile_dir):
+        """Modules in the lib directory are precompiled."""
+        install_resources(root_dir=Path(self.root_dir.path))
+        mock_compile_dir.assert_called_once_with(
+            str(Path.cwd() / 'lib'), quiet=1)
+
 
 class CreateScriptFileTest(CharmTest):
 
@@ -175,6 +182,14 @@ class CreateScriptFileTest(CharmTest):
         self.assertIn('foo.main()', content)
         self.assertEqual(0o100755, script.stat().st_mode)
 
+    def test_create_script_file_no_site(self):
+        """Some scripts are run without the site module."""
+        bindir = Path(self.fakes.fs.root.path)
+        create_script_file('reprepro-sign-helper', bindir)
+        content = (bindir / 'reprepro-sign-helper').read_text()
+        shebang = '#!{}/.venv/bin/python3 -S\n'.format(Path.cwd().parent)
+        self.assertTrue(content.startswith(shebang))
+
 
 class MissingOptionsTest(TestCase):
 
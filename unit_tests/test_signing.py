@@ -0,0 +1,124 @@
+import logging
+from pathlib import Path
+import shutil
+import stat
+import tempfile
+import unittest
+
+from fixtures import LoggerFixture, TestWithFixtures
+
+from archive_auth_mirror.signing import (
+    AgentUnavailable,
+    read_spool,
+    request_signature,
+    SigningAgent,
+    SigningError,
+    spool_request,
+)
+
+
+class SigningAgentTest(TestWithFixtures):
+
+    def setUp(self):
+        super().setUp()
+        self.logger = self.useFixture(LoggerFixture())
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+        self.socket_path = self.tempdir / 'sign-agent.sock'
+        self.calls = []
+
+    def sign(self, unsigned_file, inline_sign_file, detach_sign_file):
+        self.calls.append((unsigned_file, inline_sign_file, detach_sign_file))
+        if unsigned_file.name == 'broken':
+            raise OSError('cannot sign')
+
+    def test_request_signature(self):
+        """Clients can request signatures to the agent."""
+        with SigningAgent(self.socket_path, self.sign, logging.getLogger()):
+            request_signature(
+                self.socket_path, self.tempdir / 'Release',
+                self.tempdir / 'InRelease', self.tempdir / 'Release.gpg')
+            request_signature(
+                self.socket_path, self.tempdir / 'Release',
+                None, self.tempdir / 'Release.gpg')
+        self.assertEqual(
+            [(self.tempdir / 'Release', self.tempdir / 'InRelease',
+              self.tempdir / 'Release.gpg'),
+             (self.tempdir / 'Release', None, self.tempdir / 'Release.gpg')],
+            self.calls)
+
+    def test_request_signature_error(self):
+        """If signing fails, an error is raised and logged."""
+        with SigningAgent(self.socket_path, self.sign, logging.getLogger()):
+            with self.assertRaises(SigningError) as context_manager:
+                request_signature(
+                    self.socket_path, self.tempdir / 'broken', None,
+                    self.tempdir / 'Release.gpg')
+        self.assertEqual('cannot sign', str(context_manager.exception))
+        self.assertIn(
+            'signing {} failed: cannot sign'.format(self.tempdir / 'broken'),
+            self.logger.output)
+
+    def test_agent_not_running(self):
+        """If the agent is not running, AgentUnavailable is raised."""
+        with self.assertRaises(AgentUnavailable):
+            request_signature(
+                self.socket_path, self.tempdir / 'Release', None,
+                self.tempdir / 'Release.gpg')
+
+    def test_socket(self):
+        """The socket is only accessible by the owner, and removed on stop."""
+        agent = SigningAgent(self.socket_path, self.sign, logging.getLogger())
+        agent.start()
+        self.assertEqual(
+            0o600, stat.S_IMODE(self.socket_path.stat().st_mode))
+        agent.stop()
+        self.assertFalse(self.socket_path.exists())
+
+    def test_stale_socket(self):
+        """A stale socket file is replaced."""
+        self.socket_path.touch()
+        with SigningAgent(self.socket_path, self.sign, logging.getLogger()):
+            request_signature(
+                self.socket_path, self.tempdir / 'Release', None,
+                self.tempdir / 'Release.gpg')
+        self.assertEqual(1, len(self.calls))
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+        self.spool = self.tempdir / 'spool'
+
+    def test_spool_request(self):
+        """Spooled requests are saved, and signature files created."""
+        spool_request(
+            self.spool, self.tempdir / 'Release',
+            self.tempdir / 'InRelease', self.tempdir / 'Release.gpg')
+        spool_request(
+            self.spool, self.tempdir / 'Other', None,
+            self.tempdir / 'Other.gpg')
+        self.assertEqual(
+            [(self.tempdir / 'Release', self.tempdir / 'InRelease',
+              self.tempdir / 'Release.gpg'),
+             (self.tempdir / 'Other', None, self.tempdir / 'Other.gpg')],
+            read_spool(self.spool))
+        self.assertEqual('', (self.tempdir / 'InRelease').read_text())
+        self.assertEqual('', (self.tempdir / 'Release.gpg').read_text())
+
+    def test_read_spool_renamed(self):
+        """Files renamed by reprepro are returned with their final name."""
+        spool_request(
+            self.spool, self.tempdir / 'Release',
+            self.tempdir / 'InRelease.new', self.tempdir / 'Release.gpg.new')
+        (self.tempdir / 'InRelease.new').rename(self.tempdir / 'InRelease')
+        self.assertEqual(
+            [(self.tempdir / 'Release', self.tempdir / 'InRelease',
+              self.tempdir / 'Release.gpg.new')],
+            read_spool(self.spool))
+
+    def test_read_spool_not_existent(self):
+        """If there's no spool file, there are no requests."""
+        self.assertEqual([], read_spool(self.spool))
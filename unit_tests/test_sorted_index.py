@@ -0,0 +1,108 @@
+from pathlib import Path
+import shutil
+import tempfile
+from unittest import TestCase
+
+from archive_auth_mirror.sorted_index import (
+    get_stamp,
+    index_contains,
+    index_count,
+    index_prefix,
+    write_index,
+)
+
+
+class SortedIndexTest(TestCase):
+
+    def setUp(self):
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+        self.indexed_path = self.tempdir / 'file'
+        self.indexed_path.write_text('content')
+        self.index_path = self.tempdir / 'file.index'
+        self.stamp = get_stamp(self.indexed_path)
+
+    def test_get_stamp_not_existent(self):
+        """get_stamp returns None if the file doesn't exist."""
+        self.assertIsNone(get_stamp(self.tempdir / 'other'))
+
+    def test_contains(self):
+        """index_contains looks up keys in the index."""
+        keys = ['user{}'.format(i) for i in range(100)] + ['ùser', 'a']
+        write_index(self.index_path, keys, self.stamp)
+        for key in keys:
+            self.assertIs(
+                True, index_contains(self.index_path, key, self.stamp))
+        for key in ('', 'user', 'user100', 'user5 ', 'zzz', 'ù'):
+            self.assertIs(
+                False, index_contains(self.index_path, key, self.stamp))
+
+    def test_contains_empty(self):
+        """An index can be empty."""
+        write_index(self.index_path, [], self.stamp)
+        self.assertIs(
+            False, index_contains(self.index_path, 'user', self.stamp))
+
+    def test_count(self):
+        """index_count returns the number of unique keys."""
+        write_index(self.index_path, ['b', 'a', 'b'], self.stamp)
+        self.assertEqual(2, index_count(self.index_path, self.stamp))
+
+    def test_prefix(self):
+        """index_prefix returns sorted keys starting with the prefix."""
+        keys = ['user{}'.format(i) for i in range(20)] + ['ùser', 'a', 'us']
+        write_index(self.index_path, keys, self.stamp)
+        self.assertEqual(
+            ['user1'] + ['user1{}'.format(i) for i in range(10)],
+            index_prefix(self.index_path, 'user1', self.stamp))
+        self.assertEqual(
+            ['ùser'], index_prefix(self.index_path, 'ù', self.stamp))
+        self.assertEqual(
+            sorted(keys, key=lambda key: key.encode('utf8')),
+            index_prefix(self.index_path, '', self.stamp))
+        for prefix in ('0', 'user20', 'usf', 'zzz'):
+            self.assertEqual(
+                [], index_prefix(self.index_path, prefix, self.stamp))
+
+    def test_prefix_empty(self):
+        """index_prefix returns an empty list for an empty index."""
+        write_index(self.index_path, [], self.stamp)
+        self.assertEqual([], index_prefix(self.index_path, 'a', self.stamp))
+
+    def test_mode(self):
+        """The index is only readable by the owner."""
+        write_index(self.index_path, ['a'], self.stamp)
+        self.assertEqual(0o600, self.index_path.stat().st_mode & 0o777)
+
+    def test_mode_indexed_path(self):
+        """The index gets the ownership and mode of the indexed file."""
+        self.indexed_path.chmod(0o640)
+        write_index(
+            self.index_path, ['a'], self.stamp,
+            indexed_path=self.indexed_path)
+        index_stat = self.index_path.stat()
+        indexed_stat = self.indexed_path.stat()
+        self.assertEqual(0o640, index_stat.st_mode & 0o777)
+        self.assertEqual(
+            (indexed_stat.st_uid, indexed_stat.st_gid),
+            (index_stat.st_uid, index_stat.st_gid))
+
+    def test_not_existent(self):
+        """If the index doesn't exist, None is returned."""
+        self.assertIsNone(index_contains(self.index_path, 'a', self.stamp))
+        self.assertIsNone(index_count(self.index_path, self.stamp))
+        self.assertIsNone(index_prefix(self.index_path, 'a', self.stamp))
+
+    def test_stale(self):
+        """If the indexed file changed, the index is not used."""
+        write_index(self.index_path, ['a'], self.stamp)
+        self.indexed_path.write_text('new content')
+        stamp = get_stamp(self.indexed_path)
+        self.assertIsNone(index_contains(self.index_path, 'a', stamp))
+        self.assertIsNone(index_count(self.index_path, stamp))
+        self.assertIsNone(index_prefix(self.index_path, 'a', stamp))
+
+    def test_invalid(self):
+        """Invalid indexes are not used."""
+        self.index_path.write_text('garbage\n')
+        self.assertIsNone(index_contains(self.index_path, 'a', self.stamp))
@@ -1,12 +1,21 @@
+import logging
 import unittest
+from unittest import mock
 from pathlib import Path
 import shutil
 import stat
+import subprocess
 import tempfile
 
+from fixtures import LoggerFixture, TestWithFixtures
+
 from archive_auth_mirror.ssh import (
+    AUTHORIZED_KEYS_BEGIN,
+    AUTHORIZED_KEYS_END,
     add_authorized_key,
+    ConnectionPool,
     create_key,
+    update_authorized_keys,
 )
 
 
@@ -36,18 +45,22 @@ class AddAuthorizedKey(unittest.TestCase):
         self.addCleanup(shutil.rmtree, str(self.tempdir))
 
     def test_add_authorized_key(self):
-        """add_authorized_key() adds the given key."""
+        """add_authorized_key() adds the given key in the managed block."""
         authorized_keys_path = self.tempdir / 'authorized-keys'
         add_authorized_key('key 1', authorized_keys_path)
         self.assertEqual(
-            ['key 1'], authorized_keys_path.read_text().splitlines())
+            [AUTHORIZED_KEYS_BEGIN, 'key 1', AUTHORIZED_KEYS_END],
+            authorized_keys_path.read_text().splitlines())
+        self.assertEqual(
+            0o600, stat.S_IMODE(authorized_keys_path.stat().st_mode))
 
     def test_add_authorized_key_whitespace(self):
         """Whitespace gets stripped before adding the key."""
         authorized_keys_path = self.tempdir / 'authorized-keys'
         add_authorized_key('\nkey 1\n', authorized_keys_path)
         self.assertEqual(
-            ['key 1'], authorized_keys_path.read_text().splitlines())
+            [AUTHORIZED_KEYS_BEGIN, 'key 1', AUTHORIZED_KEYS_END],
+            authorized_keys_path.read_text().splitlines())
 
     def test_add_authorized_key_multiple(self):
         """Existing keys are preserved."""
@@ -55,7 +68,8 @@ class AddAuthorizedKey(unittest.TestCase):
         add_authorized_key('key 1', authorized_keys_path)
         add_authorized_key('key 2', authorized_keys_path)
         self.assertEqual(
-            ['key 1', 'key 2'], authorized_keys_path.read_text().splitlines())
+            [AUTHORIZED_KEYS_BEGIN, 'key 1', 'key 2', AUTHORIZED_KEYS_END],
+            authorized_keys_path.read_text().splitlines())
 
     def test_add_authorized_key_duplicate(self):
         """If the key already exists in the, it's not added again."""
@@ -63,4 +77,190 @@ class AddAuthorizedKey(unittest.TestCase):
         add_authorized_key('key 1', authorized_keys_path)
         add_authorized_key('key 1', authorized_keys_path)
         self.assertEqual(
-            ['key 1'], authorized_keys_path.read_text().splitlines())
+            [AUTHORIZED_KEYS_BEGIN, 'key 1', AUTHORIZED_KEYS_END],
+            authorized_keys_path.read_text().splitlines())
+
+
+class UpdateAuthorizedKeysTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+        self.authorized_keys_path = self.tempdir / 'authorized-keys'
+
+    def test_add_remove(self):
+        """Keys are added and removed in a single update."""
+        update_authorized_keys(
+            self.authorized_keys_path, add=['key 1', 'key 2', 'key 3'])
+        self.assertTrue(update_authorized_keys(
+            self.authorized_keys_path, add=['key 4'],
+            remove=['key 1', 'key 3']))
+        self.assertEqual(
+            [AUTHORIZED_KEYS_BEGIN, 'key 2', 'key 4', AUTHORIZED_KEYS_END],
+            self.authorized_keys_path.read_text().splitlines())
+
+    def test_remove_all(self):
+        """The block is removed when no keys are left."""
+        self.authorized_keys_path.write_text('other key\n')
+        update_authorized_keys(self.authorized_keys_path, add=['key 1'])
+        update_authorized_keys(self.authorized_keys_path, remove=['key 1'])
+        self.assertEqual(
+            'other key\n', self.authorized_keys_path.read_text())
+
+    def test_other_keys_preserved(self):
+        """Keys outside the managed block are not changed."""
+        self.authorized_keys_path.write_text('other key\n')
+        update_authorized_keys(self.authorized_keys_path, add=['key 1'])
+        with self.authorized_keys_path.open('a') as fh:
+            fh.write('last key\n')
+        update_authorized_keys(self.authorized_keys_path, add=['key 2'])
+        self.assertEqual(
+            ['other key', AUTHORIZED_KEYS_BEGIN, 'key 1', 'key 2',
+             AUTHORIZED_KEYS_END, 'last key'],
+            self.authorized_keys_path.read_text().splitlines())
+
+    def test_migrate_unmanaged(self):
+        """Keys added before the managed block existed are moved into it."""
+        self.authorized_keys_path.write_text('other key\nkey 1\nkey 2\n')
+        update_authorized_keys(
+            self.authorized_keys_path, add=['key 1'], remove=['key 2'])
+        self.assertEqual(
+            ['other key', AUTHORIZED_KEYS_BEGIN, 'key 1',
+             AUTHORIZED_KEYS_END],
+            self.authorized_keys_path.read_text().splitlines())
+
+    def test_unchanged(self):
+        """If keys don't change, the file is not written."""
+        update_authorized_keys(self.authorized_keys_path, add=['key 1'])
+        mtime = self.authorized_keys_path.stat().st_mtime_ns
+        self.assertFalse(update_authorized_keys(
+            self.authorized_keys_path, add=['key 1'], remove=['key 2']))
+        self.assertEqual(mtime, self.authorized_keys_path.stat().st_mtime_ns)
+
+
+class ConnectionPoolTest(TestWithFixtures):
+
+    def setUp(self):
+        super().setUp()
+        self.logger = self.useFixture(LoggerFixture())
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+        self.control_dir = self.tempdir / 'ssh-control'
+        self.pool = ConnectionPool(
+            Path('/ssh-key'), self.control_dir, binary='ssh')
+
+    def test_rsh(self):
+        """rsh returns an ssh command using the control sockets."""
+        self.assertEqual(
+            'ssh -o StrictHostKeyChecking=no -i /ssh-key '
+            '-o ControlPath={}/%C'.format(self.control_dir),
+            self.pool.rsh)
+
+    def get_command(self, *args):
+        return [
+            'ssh', '-o', 'StrictHostKeyChecking=no', '-i', '/ssh-key',
+            '-o', 'ControlPath={}/%C'.format(self.control_dir)] + list(args)
+
+    def fake_call(self, live=()):
+        """Return a fake subprocess.call, with master connections to live."""
+
+        def call(command, **kwargs):
+            if command[-3:-1] == ['-O', 'check']:
+                return 0 if command[-1] in live else 255
+            return 0
+
+        return call
+
+    @mock.patch('subprocess.call')
+    def test_open(self, mock_call):
+        """open starts a background master connection for each host."""
+        mock_call.side_effect = self.fake_call()
+        self.pool.open(['1.2.3.4', '5.6.7.8'], logging.getLogger())
+        self.assertEqual(
+            0o700, stat.S_IMODE(self.control_dir.stat().st_mode))
+        calls = []
+        for host in ('1.2.3.4', '5.6.7.8'):
+            calls.extend([
+                mock.call(
+                    self.get_command('-O', 'check', host),
+                    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL),
+                mock.call(
+                    self.get_command(
+                        '-o', 'ControlMaster=auto',
+                        '-o', 'ControlPersist=10m',
+                        '-o', 'ConnectTimeout=10', '-f', '-N', host),
+                    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL)])
+        self.assertEqual(calls, mock_call.mock_calls)
+
+    @mock.patch('subprocess.call')
+    def test_open_failure(self, mock_call):
+        """If a master connection can't be opened, it's logged."""
+        mock_call.return_value = 255
+        self.assertEqual(
+            ['1.2.3.4'], self.pool.open(['1.2.3.4'], logging.getLogger()))
+        self.assertIn(
+            'cannot open ssh master connection to 1.2.3.4\n',
+            self.logger.output)
+        # no master connection to close
+        mock_call.reset_mock()
+        self.pool.close()
+        mock_call.assert_not_called()
+
+    @mock.patch('subprocess.call')
+    def test_open_reuse(self, mock_call):
+        """Live master connections are not opened again."""
+        mock_call.side_effect = self.fake_call()
+        self.pool.open(['1.2.3.4'], logging.getLogger())
+        mock_call.reset_mock()
+        mock_call.side_effect = self.fake_call(live=['1.2.3.4'])
+        self.pool.open(['1.2.3.4'], logging.getLogger())
+        mock_call.assert_called_once_with(
+            self.get_command('-O', 'check', '1.2.3.4'),
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+
+    @mock.patch('subprocess.call')
+    def test_open_shared(self, mock_call):
+        """Live master connections of other processes are used as they are.
+
+        They're not closed, as they don't belong to the pool.
+        """
+        mock_call.side_effect = self.fake_call(live=['1.2.3.4'])
+        self.assertEqual(
+            [], self.pool.open(['1.2.3.4'], logging.getLogger()))
+        self.assertEqual(1, mock_call.call_count)
+        mock_call.reset_mock()
+        self.pool.close()
+        mock_call.assert_not_called()
+
+    @mock.patch('subprocess.call')
+    def test_open_reconnect(self, mock_call):
+        """Dead master connections are opened again."""
+        mock_call.side_effect = self.fake_call()
+        self.pool.open(['1.2.3.4'], logging.getLogger())
+        mock_call.reset_mock()
+        self.pool.open(['1.2.3.4'], logging.getLogger())
+        self.assertEqual(2, mock_call.call_count)
+        self.assertIn('ControlMaster=auto', mock_call.call_args[0][0])
+        # the connection is closed only once
+        mock_call.reset_mock()
+        self.pool.close()
+        mock_call.assert_called_once_with(
+            mock.ANY, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+
+    @mock.patch('subprocess.call')
+    def test_close(self, mock_call):
+        """close stops the master connections."""
+        mock_call.side_effect = self.fake_call()
+        self.pool.open(['1.2.3.4'], logging.getLogger())
+        mock_call.reset_mock()
+        self.pool.close()
+        mock_call.assert_called_once_with(
+            ['ssh', '-o', 'StrictHostKeyChecking=no', '-i', '/ssh-key',
+             '-o', 'ControlPath={}/%C'.format(self.control_dir),
+             '-O', 'exit', '1.2.3.4'],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
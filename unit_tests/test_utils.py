@@ -1,11 +1,21 @@
+import json
 from pathlib import Path
-from unittest import TestCase
+import shutil
+import tempfile
+from unittest import mock, TestCase
 
 import yaml
 
 from charmtest import CharmTest
 
-from archive_auth_mirror.utils import get_paths, get_config, update_config
+from archive_auth_mirror import utils
+from archive_auth_mirror.utils import (
+    ConfigStore,
+    get_paths,
+    get_config,
+    update_config,
+    write_atomic,
+)
 
 
 class GetPathsTest(TestCase):
@@ -16,15 +26,31 @@ class GetPathsTest(TestCase):
         self.assertEqual(
             {'base': Path('/srv/archive-auth-mirror'),
              'cron': Path('/etc/cron.d/archive-auth-mirror'),
+             'service': Path(
+                 '/etc/systemd/system/archive-auth-mirror.service'),
              'bin': Path('/srv/archive-auth-mirror/bin'),
              'config': Path('/srv/archive-auth-mirror/config.yaml'),
              'static': Path('/srv/archive-auth-mirror/static'),
+             'dists-generations': Path(
+                 '/srv/archive-auth-mirror/dists-generations'),
+             'snapshots': Path('/srv/archive-auth-mirror/snapshots'),
              'basic-auth': Path('/srv/archive-auth-mirror/basic-auth'),
              'sign-passphrase': Path(
                  '/srv/archive-auth-mirror/sign-passphrase'),
+             'sign-agent-socket': Path(
+                 '/srv/archive-auth-mirror/sign-agent.sock'),
              'ssh-key': Path('/srv/archive-auth-mirror/ssh-key'),
+             'ssh-control': Path('/srv/archive-auth-mirror/ssh-control'),
+             'synced-peers': Path('/srv/archive-auth-mirror/synced-peers'),
+             'generation': Path('/srv/archive-auth-mirror/generation.json'),
+             'peer-health': Path(
+                 '/srv/archive-auth-mirror/peer-health.json'),
              'authorized-keys': Path('/root/.ssh/authorized_keys'),
              'lockfile': Path('/srv/archive-auth-mirror/mirror-archive.lock'),
+             'metrics': Path('/srv/archive-auth-mirror/metrics.json'),
+             'metrics-textfile': Path('/srv/archive-auth-mirror/metrics.prom'),
+             'release-fingerprints': Path(
+                 '/srv/archive-auth-mirror/release-fingerprints.json'),
              'reprepro': Path('/srv/archive-auth-mirror/reprepro'),
              'reprepro-conf': Path('/srv/archive-auth-mirror/reprepro/conf'),
              'gnupghome': Path('/srv/archive-auth-mirror/reprepro/.gnupg')},
@@ -61,6 +87,15 @@ class UpdateConfigTest(CharmTest):
         config = get_config(config_path=self.config_path)
         self.assertEqual(config, {'suites': ['bionic']})
 
+    def test_unchanged(self):
+        """If the config doesn't change, the file is not written."""
+        self.assertTrue(
+            update_config(config_path=self.config_path, suites=['bionic']))
+        mtime = self.config_path.stat().st_mtime_ns
+        self.assertFalse(
+            update_config(config_path=self.config_path, suites=['bionic']))
+        self.assertEqual(mtime, self.config_path.stat().st_mtime_ns)
+
     def test_update_existing(self):
         """update_config updates the config file if it exists."""
         update_config(
@@ -69,12 +104,32 @@ class UpdateConfigTest(CharmTest):
             config_path=self.config_path,
             sign_key_id='AABBCC',
             packages_require_auth=True,
+            sync_concurrency=4,
+            daemon_min_interval=30,
+            daemon_max_interval=600,
+            sign_concurrency=0,
+            replication_mode='pull',
+            pull_fanout=2,
+            leader_address='1.2.3.4',
+            unit_address='5.6.7.8',
+            dists_generations=5,
+            snapshot_staging=True,
         )
         config = get_config(config_path=self.config_path)
         self.assertEqual(config, {
             'packages-require-auth': True,
             'sign-key-id': 'AABBCC',
             'suites': ['xenial', 'bionic'],
+            'sync-concurrency': 4,
+            'daemon-min-interval': 30,
+            'daemon-max-interval': 600,
+            'sign-concurrency': 0,
+            'replication-mode': 'pull',
+            'pull-fanout': 2,
+            'leader-address': '1.2.3.4',
+            'unit-address': '5.6.7.8',
+            'dists-generations': 5,
+            'snapshot-staging': True,
         })
 
     def test_update_ssh_peers(self):
@@ -88,3 +143,153 @@ class UpdateConfigTest(CharmTest):
                 '1.2.3.4': 'aabb',
                 '5.6.7.8': 'ccdd'}},
             get_config(config_path=self.config_path))
+
+    def test_remove_ssh_peers(self):
+        """update_config removes departed ssh-peers."""
+        update_config(
+            config_path=self.config_path,
+            new_ssh_peers={'1.2.3.4': 'aabb', '5.6.7.8': 'ccdd'})
+        update_config(
+            config_path=self.config_path,
+            removed_ssh_peers=['1.2.3.4', '9.9.9.9'])
+        self.assertEqual(
+            {'ssh-peers': {'5.6.7.8': 'ccdd'}},
+            get_config(config_path=self.config_path))
+
+
+class ConfigStoreTest(TestCase):
+
+    def setUp(self):
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+        self.path = self.tempdir / 'config.yaml'
+        self.store = ConfigStore(path=self.path)
+
+    def test_load_not_existent(self):
+        """If the file doesn't exist, the config is empty."""
+        self.assertEqual({}, self.store.load())
+
+    def test_load_cached(self):
+        """The config is parsed again only when the file changes."""
+        self.path.write_text('suites: [xenial]\n')
+        with mock.patch('yaml.load', wraps=yaml.load) as mock_load:
+            self.assertEqual({'suites': ['xenial']}, self.store.load())
+            self.assertEqual({'suites': ['xenial']}, self.store.load())
+            self.assertEqual(1, mock_load.call_count)
+            self.path.write_text('suites: [xenial, bionic]\n')
+            self.assertEqual(
+                {'suites': ['xenial', 'bionic']}, self.store.load())
+            self.assertEqual(2, mock_load.call_count)
+
+    def test_load_copy(self):
+        """Modifying the returned config doesn't affect the cache."""
+        self.path.write_text('suites: [xenial]\n')
+        self.store.load()['suites'].append('bionic')
+        self.assertEqual({'suites': ['xenial']}, self.store.load())
+
+    def test_load_unsafe(self):
+        """Arbitrary Python objects are not loaded."""
+        self.path.write_text('foo: !!python/object/apply:os.getcwd []\n')
+        with self.assertRaises(yaml.YAMLError):
+            self.store.load()
+
+    def test_transaction(self):
+        """Changes made in a transaction are written atomically."""
+        with self.store.transaction() as config:
+            config['suites'] = ['xenial']
+            self.assertFalse(self.path.exists())
+        self.assertEqual({'suites': ['xenial']}, self.store.load())
+        self.assertEqual(
+            ['config.json', 'config.yaml'],
+            sorted(path.name for path in self.tempdir.iterdir()))
+
+    def test_transaction_nested(self):
+        """The config is written once, when the outer transaction ends."""
+        with mock.patch.object(ConfigStore, '_write') as mock_write:
+            with self.store.transaction() as config:
+                config['suites'] = ['xenial']
+                update_config(config_path=self.path, sign_key_id='AABBCC')
+                self.assertEqual(
+                    {'suites': ['xenial'], 'sign-key-id': 'AABBCC'},
+                    self.store.load())
+                mock_write.assert_not_called()
+        mock_write.assert_called_once_with(
+            {'suites': ['xenial'], 'sign-key-id': 'AABBCC'})
+
+    def test_transaction_error(self):
+        """If the transaction fails, changes are discarded."""
+        self.path.write_text('suites: [xenial]\n')
+        with self.assertRaises(ValueError):
+            with self.store.transaction() as config:
+                config['suites'] = ['bionic']
+                raise ValueError()
+        self.assertEqual({'suites': ['xenial']}, self.store.load())
+
+    def test_transaction_unchanged(self):
+        """If the config doesn't change, the file is not written."""
+        with self.store.transaction() as config:
+            config['suites'] = ['xenial']
+        mtime = self.path.stat().st_mtime_ns
+        with self.store.transaction() as config:
+            config['suites'] = ['xenial']
+        self.assertEqual(mtime, self.path.stat().st_mtime_ns)
+
+    def test_snapshot(self):
+        """The config is loaded from the snapshot, without parsing YAML."""
+        with self.store.transaction() as config:
+            config['suites'] = ['xenial']
+        utils._configs.clear()
+        with mock.patch('yaml.load') as mock_load:
+            self.assertEqual({'suites': ['xenial']}, self.store.load())
+        mock_load.assert_not_called()
+
+    def test_snapshot_stale(self):
+        """If the YAML file is modified, the snapshot is ignored."""
+        with self.store.transaction() as config:
+            config['suites'] = ['xenial']
+        self.path.write_text('suites: [bionic]\n')
+        self.assertEqual({'suites': ['bionic']}, self.store.load())
+
+    def test_snapshot_format(self):
+        """Snapshots in a different format are ignored."""
+        with self.store.transaction() as config:
+            config['suites'] = ['xenial']
+        snapshot = json.loads(self.store.snapshot_path.read_text())
+        snapshot['format'] = utils.SNAPSHOT_FORMAT + 1
+        snapshot['config'] = {'suites': ['bionic']}
+        self.store.snapshot_path.write_text(json.dumps(snapshot))
+        utils._configs.clear()
+        self.assertEqual({'suites': ['xenial']}, self.store.load())
+
+    def test_snapshot_missing(self):
+        """A transaction writes the snapshot if missing."""
+        self.path.write_text('suites: [xenial]\n')
+        with self.store.transaction():
+            pass
+        snapshot = json.loads(self.store.snapshot_path.read_text())
+        self.assertEqual({'suites': ['xenial']}, snapshot['config'])
+
+
+class WriteAtomicTest(TestCase):
+
+    def setUp(self):
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tempdir))
+
+    def test_write(self):
+        """write_atomic replaces the file content."""
+        path = self.tempdir / 'file'
+        path.write_text('old')
+        write_atomic(path, 'new')
+        self.assertEqual('new', path.read_text())
+        # No temporary file is left behind.
+        self.assertEqual(['file'], [p.name for p in self.tempdir.iterdir()])
+
+    def test_write_mode(self):
+        """The file permissions can be specified."""
+        path = self.tempdir / 'file'
+        path.write_text('old')
+        path.chmod(0o644)
+        write_atomic(path, 'new', mode=0o600)
+        self.assertEqual('new', path.read_text())
+        self.assertEqual(0o600, path.stat().st_mode & 0o777)